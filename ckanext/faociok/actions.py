@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from sqlalchemy import and_, or_
-from ckan.logic import get_or_bust
-from ckanext.faociok.models import VocabularyTerm, Vocabulary, VocabularyLabel
+from sqlalchemy import and_, func, literal, select, union_all
+from ckan.logic import get_or_bust, check_access, ValidationError
+from ckanext.faociok.models import (VocabularyTerm, Vocabulary, VocabularyLabel,
+                                    VocabularyLabelSearch, autocomplete_index)
+from ckanext.faociok.utils import normalize_label
 from ckan.lib.base import c
 
 def fao_autocomplete(context, data_dict):
@@ -12,28 +14,80 @@ def fao_autocomplete(context, data_dict):
     term = (data_dict.get('query') or data_dict.get('q') or '').strip()
     vocabulary_name = get_or_bust(data_dict, 'vocabulary')
     lang = get_or_bust(data_dict, 'lang')
-    offset = data_dict.get('offset')
-    limit = data_dict.get('limit')
-
-    q = model.Session.query(VocabularyLabel.label, VocabularyTerm.name)\
-                     .join(VocabularyTerm,
-                           VocabularyTerm.id == VocabularyLabel.term_id)\
-                     .join(Vocabulary,
-                           Vocabulary.id == VocabularyTerm.vocabulary_id)\
-                     .filter(Vocabulary.name == vocabulary_name)
-
-    q = q.distinct()\
-         .filter(or_(VocabularyTerm.name == term,
-                     and_(VocabularyLabel.label.ilike('%{}%'.format(term)),
-                          VocabularyLabel.lang == lang).self_group()).self_group())\
-         .order_by(VocabularyTerm.name, VocabularyLabel.label)
+    offset = _get_int(data_dict, 'offset')
+    limit = _get_int(data_dict, 'limit')
+
+    if autocomplete_index.enabled:
+        found = autocomplete_index.search(vocabulary_name, lang, term, offset, limit)
+        tags = [{'name': name, 'term': name, 'label': label} for label, name in found]
+        return {'tags': tags,
+                'count': len(tags),
+                'lang': lang}
+
+    S = VocabularyLabelSearch
+    normalized = _escape_like(normalize_label(term, lang))
+
+    def matches(rank, condition):
+        return select([VocabularyLabel.label.label('label'),
+                       VocabularyTerm.name.label('name'),
+                       literal(rank).label('rank'),
+                       S.normalized.label('normalized')])\
+               .where(and_(S.label_id == VocabularyLabel.id,
+                           S.term_id == VocabularyTerm.id,
+                           S.vocabulary_id == Vocabulary.id,
+                           Vocabulary.name == vocabulary_name,
+                           S.lang == lang,
+                           condition))
+
+    # exact term name, then label prefix matches, then substring matches,
+    # ordered as in memory engine (see LabelSuggestIndex.search). Each match
+    # kind is a separate query, so prefix match can use prefix index and
+    # substring match can use trigram index.
+    found = union_all(matches(0, VocabularyTerm.name == term),
+                      matches(1, S.normalized.like(u'{}%'.format(normalized), escape='\\')),
+                      matches(2, S.normalized.like(u'%{}%'.format(normalized), escape='\\')))\
+            .alias('found')
+    rank = func.min(found.c.rank).label('rank')
+    q = model.Session.query(found.c.label, found.c.name, rank, found.c.normalized)\
+                     .group_by(found.c.label, found.c.name, found.c.normalized)\
+                     .order_by(rank, found.c.normalized, found.c.label, found.c.name)
 
     if offset:
         q = q.offset(offset)
     if limit:
         q = q.limit(limit)
-    count = q.count()
+    tags = [{'name': t.name, 'term': t.name, 'label': t.label} for t in q.all()]
 
-    return {'tags': [{'name': t.name, 'term': t.name, 'label': t.label} for t in q.all()],
-            'count':  count,
+    return {'tags': tags,
+            'count':  len(tags),
             'lang': lang}
+
+
+def fao_harvest_job_import_stats(context, data_dict):
+    """
+    Returns time spent in import stages by objects of harvest job, summed
+    from `fao_import_stats` extras of harvest objects.
+    """
+    from ckanext.faociok.harvesters.ddiharvester import get_job_import_stats
+
+    job_id = get_or_bust(data_dict, 'id')
+    check_access('harvest_job_show', context, data_dict)
+    stats = get_job_import_stats(job_id)
+    return {'id': job_id,
+            'count': stats.count,
+            'times': stats.as_dict()}
+
+
+def _get_int(data_dict, key):
+    value = data_dict.get(key) or 0
+    try:
+        value = int(value)
+    except (TypeError, ValueError,):
+        raise ValidationError({key: ['Invalid integer value: {}'.format(value)]})
+    if value < 0:
+        raise ValidationError({key: ['Value must be positive or zero']})
+    return value
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
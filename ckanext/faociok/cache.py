@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import logging
+import threading
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from sqlalchemy import event
+from ckan.lib.base import config
+
+log = logging.getLogger(__name__)
+
+# how long (in seconds) values computed for home page widgets are cached,
+# set to 0 to disable caching
+CONFIG_CACHE_TTL = 'ckanext.faociok.cache.ttl'
+# redis url for cache shared between CKAN processes. If not set,
+# ckan.redis.url is used. Process-local cache is used if neither is set
+# or redis client is not installed.
+CONFIG_CACHE_REDIS_URL = 'ckanext.faociok.cache.redis_url'
+
+NAMESPACE_FEATURED_LOCATIONS = 'featured_locations'
+NAMESPACE_GROUPS = 'groups'
+
+# max time (in seconds) one process may spend computing value, while
+# others wait for it or serve previous value
+LOCK_TIMEOUT = 10
+
+# key in session.info for invalidations pending until commit
+PENDING_KEY = 'ckanext-faociok:cache:pending'
+
+
+def _invalidate_pending(session):
+    for cache, namespace in session.info.pop(PENDING_KEY, ()):
+        cache.invalidate(namespace)
+
+
+def _drop_pending(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+class LocalBackend(object):
+    """
+    Cache storage in process memory
+    """
+
+    def __init__(self):
+        self._items = {}
+        self._locks = set()
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            expires, value = self._items.get(key, (0, None,))
+        if expires < time.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            for k, (expires, v) in self._items.items():
+                if expires < now:
+                    del self._items[k]
+            self._items[key] = (now + ttl, value,)
+
+    def incr(self, key):
+        with self._lock:
+            value = (self.get(key) or 0) + 1
+            self._items[key] = (float('inf'), value,)
+            return value
+
+    def acquire(self, key, timeout):
+        with self._lock:
+            if key in self._locks:
+                return False
+            self._locks.add(key)
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._locks.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._locks.clear()
+
+
+class RedisBackend(object):
+    """
+    Cache storage in redis, shared between processes. Values are stored
+    as json.
+    """
+
+    PREFIX = 'ckanext-faociok:cache:'
+
+    def __init__(self, url):
+        self._redis = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        value = self._redis.get(self.PREFIX + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl):
+        self._redis.setex(self.PREFIX + key, int(ttl), json.dumps(value))
+
+    def incr(self, key):
+        return self._redis.incr(self.PREFIX + key)
+
+    def acquire(self, key, timeout):
+        return bool(self._redis.set(self.PREFIX + 'lock:' + key, '1', nx=True, ex=timeout))
+
+    def release(self, key):
+        self._redis.delete(self.PREFIX + 'lock:' + key)
+
+    def clear(self):
+        keys = list(self._redis.scan_iter(self.PREFIX + '*'))
+        if keys:
+            self._redis.delete(*keys)
+
+
+class WidgetCache(object):
+    """
+    Cache with expiration for values which are expensive to compute on
+    each request, like home page widgets data.
+
+    Keys are grouped in namespaces, so all values in namespace can be
+    invalidated at once (for example, when datasets are changed).
+
+    Only one process (or thread) recomputes expired value. Meanwhile,
+    others serve previous value, or wait for new one if there's none.
+    """
+
+    def __init__(self, backend=None):
+        self._backend = backend
+
+    @property
+    def backend(self):
+        # config is not loaded yet when module is imported
+        if self._backend is None:
+            url = config.get(CONFIG_CACHE_REDIS_URL) or config.get('ckan.redis.url')
+            if url and redis is not None:
+                self._backend = RedisBackend(url)
+            else:
+                self._backend = LocalBackend()
+        return self._backend
+
+    @property
+    def ttl(self):
+        return int(config.get(CONFIG_CACHE_TTL, 300))
+
+    def _key(self, namespace, key):
+        version = self.backend.get('ns:{}'.format(namespace)) or 0
+        return u'{}:{}:{}'.format(namespace, version, key)
+
+    def invalidate(self, namespace):
+        # cache failure shouldn't break dataset changes, values will
+        # expire after ttl anyway
+        try:
+            self.backend.incr('ns:{}'.format(namespace))
+        except Exception, err:
+            log.warning("Cannot invalidate %s cache: %s", namespace, err)
+
+    def invalidate_after_commit(self, session, namespace):
+        """
+        Invalidate namespace once session's transaction is committed, so
+        other processes don't cache values computed from data they can't
+        see yet. Nothing is invalidated if transaction is rolled back.
+
+        @param session sqlalchemy Session instance (not scoped session)
+        @param namespace name of values group
+        """
+        if not event.contains(session, 'after_commit', _invalidate_pending):
+            event.listen(session, 'after_commit', _invalidate_pending)
+            event.listen(session, 'after_rollback', _drop_pending)
+        session.info.setdefault(PENDING_KEY, set()).add((self, namespace,))
+
+    def clear(self):
+        self.backend.clear()
+
+    def get_or_set(self, namespace, key, loader, ttl=None):
+        """
+        Returns cached value for key, or calls loader and caches its result
+
+        @param namespace name of values group
+        @param key key within namespace, should be convertible to string
+        @param loader callable without arguments, returning json-serializable value
+        @param ttl expiration time in seconds (default from config)
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return loader()
+        backend = self.backend
+        try:
+            cache_key = self._key(namespace, key)
+            entry = backend.get(cache_key)
+        except Exception, err:
+            log.warning("Cannot read %s cache: %s", namespace, err)
+            return loader()
+
+        if entry and entry[0] > time.time():
+            return entry[1]
+
+        try:
+            acquired = backend.acquire(cache_key, LOCK_TIMEOUT)
+        except Exception, err:
+            log.warning("Cannot lock %s cache: %s", namespace, err)
+            return loader()
+        if acquired:
+            try:
+                value = loader()
+                # expired entry is kept longer, so it can be served
+                # while value is recomputed
+                try:
+                    backend.set(cache_key, (time.time() + ttl, value,), ttl * 2 + LOCK_TIMEOUT)
+                except Exception, err:
+                    log.warning("Cannot write %s cache: %s", namespace, err)
+            finally:
+                try:
+                    backend.release(cache_key)
+                except Exception, err:
+                    log.warning("Cannot unlock %s cache: %s", namespace, err)
+            return value
+        if entry:
+            return entry[1]
+
+        deadline = time.time() + LOCK_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(0.05)
+            try:
+                entry = backend.get(cache_key)
+            except Exception, err:
+                log.warning("Cannot read %s cache: %s", namespace, err)
+                break
+            if entry:
+                return entry[1]
+        return loader()
+
+
+widget_cache = WidgetCache()
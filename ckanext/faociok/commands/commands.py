@@ -4,6 +4,9 @@ from __future__ import print_function
 
 import logging
 import traceback
+import time
+from multiprocessing import Pool
+from optparse import make_option
 
 from ckan.common import _, ungettext
 import ckan.plugins.toolkit as toolkit
@@ -12,9 +15,29 @@ from pylons import config
 from ckan.lib.cli import CkanCommand
 
 from ckanext.faociok.models import setup_models, Session
+from ckanext.faociok.commands.common import command_parser, init_worker, reindex_batch
 
 log = logging.getLogger(__name__)
 
+
+def _harvest_import_batch(object_ids):
+    """
+    Import batch of harvest objects with FAO NADA harvester.
+
+    Returns tuple of (number of imported objects, list of failed object ids,
+    ImportStats)
+    """
+    from ckan import model
+    from ckan import plugins
+    from ckanext.harvest.model import HarvestObject
+
+    harvester = plugins.get_plugin('faociok_nada_harvester')
+    objects = [HarvestObject.get(obj_id) for obj_id in object_ids]
+    failed, stats = harvester.import_batch(objects)
+    model.Session.remove()
+    return len(object_ids) - len(failed), failed, stats
+
+
 class FAOCIOKCommand(CkanCommand):
     """Misc commands for FAO-CIOK extension.    
     """
@@ -22,6 +45,12 @@ class FAOCIOKCommand(CkanCommand):
     summary = __doc__.split('\n')[0]
     usage = __doc__
 
+    parser = command_parser(
+        make_option('--batch-size', dest='batch_size', type='int', default=None,
+                    help='Number of datasets processed in one batch (reindex, harvest_import)'),
+        make_option('--workers', dest='workers', type='int', default=None,
+                    help='Number of worker processes (reindex, harvest_import)'))
+
     @property
     def usage(self):
         out = [self.__doc__]
@@ -37,6 +66,124 @@ class FAOCIOKCommand(CkanCommand):
         """
         setup_models() 
 
+    def cmd_reindex(self, *args, **kwargs):
+        """Rebuild search index for active datasets in batches.
+
+           syntax: reindex [--batch-size N] [--workers K]
+
+           Vocabulary labels are resolved once per batch, Solr commit is
+           issued once per batch. With more than one worker, batches are
+           indexed in parallel processes. Index is not cleared before,
+           use `search-index rebuild` for that.
+        """
+        from ckan import model
+
+        batch_size = max(kwargs.get('batch_size') or 500, 1)
+        workers = max(kwargs.get('workers') or 1, 1)
+
+        q = Session.query(model.Package.id)\
+                   .filter(model.Package.type=='dataset',
+                           model.Package.state=='active')\
+                   .order_by(model.Package.id)
+        package_ids = [row[0] for row in q]
+        total = len(package_ids)
+        batches = [package_ids[idx:idx+batch_size] for idx in range(0, total, batch_size)]
+        print(_("Indexing {} datasets in {} batches with {} workers").format(total, len(batches), workers))
+
+        if workers > 1:
+            # don't share parent's connections with forked workers
+            Session.remove()
+            model.meta.engine.dispose()
+            pool = Pool(workers, initializer=init_worker)
+            results = pool.imap_unordered(reindex_batch, batches)
+        else:
+            pool = None
+            results = (reindex_batch(batch) for batch in batches)
+
+        started = time.time()
+        indexed = 0
+        failed = []
+        try:
+            for batch_indexed, batch_failed in results:
+                indexed += batch_indexed
+                failed.extend(batch_failed)
+                elapsed = time.time() - started
+                print(_("Indexed {}/{} datasets ({:.1f} datasets/s)").format(
+                      indexed + len(failed), total, (indexed + len(failed)) / (elapsed or 1)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        print(_("Indexed {} datasets, {} failed").format(indexed, len(failed)))
+        for pkg_id in failed:
+            print(_("  failed: {}").format(pkg_id))
+
+    def cmd_harvest_import(self, source_id, *args, **kwargs):
+        """Re-import current harvest objects of FAO NADA harvest source in batches.
+
+           syntax: harvest_import source_id_or_name [--batch-size N] [--workers K]
+
+           Batch size is taken from harvest source config (`batch_size`),
+           unless provided in command line. Packages are written without
+           Solr commit, which is issued once per batch. With more than one
+           worker, batches are imported in parallel processes.
+        """
+        from ckan import model
+        from ckan import plugins
+        from ckanext.harvest.model import HarvestSource, HarvestObject
+        from ckanext.faociok.harvesters.ddiharvester import ImportStats
+
+        pkg = model.Package.get(source_id)
+        source = HarvestSource.get(pkg.id if pkg else source_id)
+        if not source:
+            raise ValueError(_("Harvest source {} doesn't exist").format(source_id))
+
+        harvester = plugins.get_plugin('faociok_nada_harvester')
+        batch_size = max(kwargs.get('batch_size') or harvester.get_batch_size(source), 1)
+        workers = max(kwargs.get('workers') or 1, 1)
+
+        q = Session.query(HarvestObject.id)\
+                   .filter(HarvestObject.harvest_source_id==source.id,
+                           HarvestObject.current==True)\
+                   .order_by(HarvestObject.id)
+        object_ids = [row[0] for row in q]
+        total = len(object_ids)
+        batches = [object_ids[idx:idx+batch_size] for idx in range(0, total, batch_size)]
+        print(_("Importing {} harvest objects in {} batches with {} workers").format(total, len(batches), workers))
+
+        if workers > 1:
+            # don't share parent's connections with forked workers
+            Session.remove()
+            model.meta.engine.dispose()
+            pool = Pool(workers, initializer=init_worker)
+            results = pool.imap_unordered(_harvest_import_batch, batches)
+        else:
+            pool = None
+            results = (_harvest_import_batch(batch) for batch in batches)
+
+        started = time.time()
+        imported = 0
+        failed = []
+        stats = ImportStats()
+        try:
+            for batch_imported, batch_failed, batch_stats in results:
+                imported += batch_imported
+                failed.extend(batch_failed)
+                stats.update(batch_stats)
+                elapsed = time.time() - started
+                print(_("Imported {}/{} objects ({:.1f} objects/s)").format(
+                      imported + len(failed), total, (imported + len(failed)) / (elapsed or 1)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        print(_("Imported {} objects, {} failed").format(imported, len(failed)))
+        print(_("Time spent in import stages (all workers): {}").format(stats))
+        for obj_id in failed:
+            print(_("  failed: {}").format(obj_id))
+
     def get_commands(self):
         """
         Return dictionary of command-> callable 
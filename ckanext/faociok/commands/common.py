@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by FAO-CIOK paster commands
+"""
+
+import copy
+import logging
+
+from ckan.common import _
+import ckan.plugins.toolkit as toolkit
+from ckan.lib.cli import CkanCommand
+
+from ckanext.faociok.models import get_packages_term_labels
+
+log = logging.getLogger(__name__)
+
+
+def command_parser(*options):
+    """
+    Returns copy of standard CKAN command parser (with -c/--config and
+    -f/--file options), extended with given options
+
+    @param options optparse Option instances (see optparse.make_option)
+    """
+    parser = copy.deepcopy(CkanCommand.parser)
+    for option in options:
+        parser.add_option(option)
+    return parser
+
+
+def init_worker():
+    # each worker should open own db connections
+    from ckan import model
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+
+def reindex_batch(package_ids):
+    """
+    Index batch of packages in Solr with one commit at the end.
+
+    Labels for all vocabulary terms used in batch are loaded upfront,
+    so before_index() doesn't need to query them for each package.
+
+    Returns tuple of (number of indexed packages, list of failed package ids)
+    """
+    from ckan import model
+    from ckan import plugins
+    from ckan.lib.search import index_for, commit
+
+    package_index = index_for(model.Package)
+    context = {'model': model,
+               'ignore_auth': True,
+               'validate': False,
+               'use_cache': False}
+    pshow = toolkit.get_action('package_show')
+    plugin = plugins.get_plugin('faociok')
+
+    failed = []
+    labels = get_packages_term_labels(package_ids)
+    with plugin.preloaded_index_labels(labels):
+        for pkg_id in package_ids:
+            try:
+                pkg_dict = pshow(context.copy(), {'id': pkg_id})
+                package_index.update_dict(pkg_dict, defer_commit=True)
+            except Exception, err:
+                log.error(_("Can't index package %s: %s"), pkg_id, err, exc_info=err)
+                failed.append(pkg_id)
+    commit()
+    model.Session.remove()
+    return len(package_ids) - len(failed), failed
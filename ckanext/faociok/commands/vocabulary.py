@@ -4,11 +4,12 @@ from __future__ import print_function
 
 import logging
 import traceback
+import os
 import csv
+import re
+from optparse import make_option
 from cStringIO import StringIO
 from openpyxl import load_workbook
-from rdflib import Graph
-from rdflib.namespace import SKOS, RDF
 
 from ckan.common import _, ungettext
 import ckan.plugins.toolkit as toolkit
@@ -17,11 +18,217 @@ from ckan.lib.base import config
 from ckan.lib.cli import CkanCommand
 
 from ckanext.faociok.models import (Vocabulary, VocabularyTerm,
+                                    VocabularyTermClosure, VocabularyLabelSearch,
+                                    TermUsage, PackageTerm,
                                     Session, load_vocabulary,
-                                    find_unused_terms, setup_models)
+                                    bulk_load_vocabulary, sync_vocabulary,
+                                    find_unused_terms, fix_dangling_terms,
+                                    write_snapshot, load_snapshot, vocabulary_store,
+                                    setup_models)
+from ckanext.faociok.cache import (widget_cache, NAMESPACE_FEATURED_LOCATIONS,
+                                   NAMESPACE_GROUPS)
+from ckanext.faociok.commands.common import command_parser, reindex_batch
 
 log = logging.getLogger(__name__)
 
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+SKOS_CONCEPT = 'http://www.w3.org/2004/02/skos/core#Concept'
+SKOS_PREF_LABEL = 'http://www.w3.org/2004/02/skos/core#prefLabel'
+SKOS_BROADER = 'http://www.w3.org/2004/02/skos/core#broader'
+
+# <subject> <predicate> object .
+NT_TRIPLE = re.compile(r'^<([^>]*)>\s+<([^>]*)>\s+(.*?)\s*\.\s*$')
+# "literal"@lang or "literal"^^<datatype>
+NT_LITERAL = re.compile(r'^"(.*)"(?:@([A-Za-z0-9-]+)|\^\^<[^>]*>)?$')
+NT_ESCAPE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+NT_ESCAPES = {'t': u'\t', 'b': u'\b', 'n': u'\n', 'r': u'\r', 'f': u'\f',
+              '"': u'"', "'": u"'", '\\': u'\\'}
+
+
+def _nt_unescape(value):
+    def replace(match):
+        escaped = match.group(1)
+        if escaped[0] in 'uU':
+            # works for non-BMP chars on narrow python builds too
+            return ('\\' + escaped).decode('unicode-escape')
+        return NT_ESCAPES.get(escaped, match.group(0))
+    return NT_ESCAPE.sub(replace, value)
+
+
+def _iter_agrovoc_concepts(fh, langs):
+    """
+    Read AGROVOC concepts from N-Triples file, line by line.
+
+    Only triples needed for vocabulary are parsed (concept type, preferred
+    labels in requested langs and broader concepts), all other lines are
+    skipped before parsing, similar to files/clean_agrovoc.sh. Data is
+    grouped per subject, so memory usage depends on number of concepts,
+    not on size of input file.
+
+    Yields (concept id, labels dict, list of parent ids) tuples, top-level
+    concepts first.
+    """
+    predicates = set(['<{}>'.format(p) for p in (RDF_TYPE, SKOS_PREF_LABEL, SKOS_BROADER,)])
+    langs = set(langs)
+    # subject id -> [is concept, labels, parents]
+    subjects = {}
+
+    for line in fh:
+        parts = line.split(None, 2)
+        if len(parts) < 3 or parts[1] not in predicates:
+            continue
+        match = NT_TRIPLE.match(line.decode('utf-8'))
+        if not match:
+            log.warning('Cannot parse N-Triples line: %s', line.strip())
+            continue
+        subject, predicate, obj = match.groups()
+        if predicate == RDF_TYPE and obj != '<{}>'.format(SKOS_CONCEPT):
+            continue
+        sid = subject.split('/')[-1]
+        try:
+            data = subjects[sid]
+        except KeyError:
+            data = subjects[sid] = [False, {}, []]
+
+        if predicate == RDF_TYPE:
+            data[0] = True
+        elif predicate == SKOS_BROADER:
+            data[2].append(obj.strip('<>').split('/')[-1])
+        else:
+            literal = NT_LITERAL.match(obj)
+            if not literal or literal.group(2) not in langs:
+                continue
+            data[1][literal.group(2)] = _nt_unescape(literal.group(1))
+
+    log.info('AGROVOC subjects parsed: %s', len(subjects))
+    for top_level in (True, False,):
+        for sid, (is_concept, labels, parents) in subjects.iteritems():
+            if is_concept and (not parents) == top_level:
+                yield sid, labels, parents
+
+
+# columns (1-based) in M49 table, data starts in M49_FIRST_ROW
+M49_FIRST_ROW = 6
+M49_COUNTRY_CODE = 1
+M49_COUNTRY_ISO3 = 2
+M49_COUNTRY_NAME = 3
+M49_L1_CODE = 8
+M49_L1_NAME = 9
+
+# column headers in csv/tsv export of UN M49 overview table
+M49_HEADERS = {M49_COUNTRY_CODE: 'M49 Code',
+               M49_COUNTRY_ISO3: 'ISO-alpha3 Code',
+               M49_COUNTRY_NAME: 'Country or Area',
+               M49_L1_CODE: 'Region Code',
+               M49_L1_NAME: 'Region Name'}
+
+
+def _iter_m49_export(f, delimiter=None):
+    """
+    Yield rows of UN M49 csv/tsv export, with columns found by header
+    name and placed at the same positions as in M49 table. Codes are
+    zero-padded in the export ("008"), so they're stripped to match
+    codes from the table.
+    """
+    header = f.readline()
+    if delimiter is None:
+        try:
+            delimiter = csv.Sniffer().sniff(header, delimiters=',;\t').delimiter
+        except csv.Error:
+            delimiter = ','
+    header = next(csv.reader([header], delimiter=delimiter))
+    header = [name.decode('utf-8-sig').strip().lower() for name in header]
+    positions = {}
+    for idx, name in M49_HEADERS.items():
+        try:
+            positions[idx] = header.index(name.lower())
+        except ValueError:
+            raise ValueError(_("Column {} not found in M49 file").format(name))
+    codes = (M49_COUNTRY_CODE, M49_L1_CODE,)
+    for row in csv.reader(f, delimiter=delimiter):
+        out = [None] * max(M49_HEADERS)
+        for idx, position in positions.items():
+            value = row[position].decode('utf-8').strip() if position < len(row) else u''
+            if idx in codes and value.isdigit():
+                value = unicode(int(value))
+            out[idx-1] = value or None
+        yield out
+
+
+def _iter_m49_table(in_file):
+    """
+    Yield data rows of M49 table as lists of cell values. Xlsx workbook is
+    read in read-only (streaming) mode, csv and tsv exports of UN M49
+    overview table are read directly.
+    """
+    ext = os.path.splitext(in_file)[1].lower()
+    if ext in ('.csv', '.tsv',):
+        with open(in_file, 'rb') as f:
+            for row in _iter_m49_export(f, '\t' if ext == '.tsv' else None):
+                yield row
+        return
+    wb = load_workbook(in_file, read_only=True)
+    try:
+        for row in wb.active.iter_rows(min_row=M49_FIRST_ROW):
+            yield [cell.value for cell in row]
+    finally:
+        wb.close()
+
+
+def _m49_value(row, idx):
+    try:
+        value = row[idx-1]
+    except IndexError:
+        return None
+    if isinstance(value, basestring):
+        value = value.replace('(M49)', '').replace('(MDG=M49)', '')
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+    return value
+
+
+def _m49_labels(name):
+    """
+    Returns en, fr and es labels for M49 name, empty if there's no name
+    """
+    if not name:
+        return [name, None, None]
+    return [name, '{} [FR]'.format(name), '{} [ES]'.format(name)]
+
+
+def _iter_m49_terms(rows):
+    """
+    Convert M49 table rows into vocabulary csv rows in one pass.
+    Level-1 region is emitted when it's first seen, before its first
+    country. Rows are not buffered, so the first row of each code is used
+    (codes are repeated only for regions, with the same name).
+    """
+    yield ['parent', 'term', 'property:country_code', 'lang:en', 'lang:fr', 'lang:es']
+    regions = set()
+    countries = set()
+    for row in rows:
+        region, region_name = _m49_value(row, M49_L1_CODE), _m49_value(row, M49_L1_NAME)
+        if region and region not in regions:
+            regions.add(region)
+            yield [None, region, None] + _m49_labels(region_name)
+        country, name = _m49_value(row, M49_COUNTRY_CODE), _m49_value(row, M49_COUNTRY_NAME)
+        if country and country not in countries:
+            countries.add(country)
+            yield [region, country, _m49_value(row, M49_COUNTRY_ISO3)] + _m49_labels(name)
+
+
+def _csv_lines(rows):
+    """
+    Serialize rows to csv lines one by one, so they can be passed to
+    csv-based vocabulary loaders without building whole csv in memory.
+    """
+    buff = StringIO()
+    w = csv.writer(buff)
+    for row in rows:
+        w.writerow(row)
+        yield buff.getvalue()
+        buff.seek(0)
+        buff.truncate()
+
 
 class VocabularyCommands(CkanCommand):
     """Manage vocabularies in FAO-CIOK extension.
@@ -30,6 +237,19 @@ class VocabularyCommands(CkanCommand):
     summary = __doc__.split('\n')[0]
     usage = __doc__
 
+    parser = command_parser(
+        make_option('--bulk', dest='bulk', action='store_true', default=False,
+                    help='Use bulk loader (load, import_agrovoc, import_m49)'),
+        make_option('--sync', dest='sync', action='store_true', default=False,
+                    help='Apply only differences to existing vocabulary '
+                         '(load, import_agrovoc, import_m49)'),
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False,
+                    help='Only report what would be changed (rename_term)'),
+        make_option('--fix', dest='fix', action='store_true', default=False,
+                    help='Remove or replace terms not present in vocabulary (check_terms)'),
+        make_option('--batch-size', dest='batch_size', type='int', default=None,
+                    help='Number of datasets reindexed in one batch (rename_term, check_terms)'))
+
     @property
     def usage(self):
         out = [self.__doc__]
@@ -67,85 +287,201 @@ class VocabularyCommands(CkanCommand):
         """
         Rename occurences of vocabulary old_term to new_term
 
-        syntax: rename_term vocabulary_name old_term new_term
+        syntax: rename_term vocabulary_name old_term new_term [--dry-run] [--batch-size N]
+
+        Datasets' fields are rewritten in one transaction, then affected
+        datasets are reindexed in batches of N (default 500), with one
+        Solr commit per batch.
         """
         v = Vocabulary.get(vocabulary_name)
-        count = v.rename_term_in_extras(old_term, new_term)
-        print(u'Updated {} datasets.'.format(count))
+        dry_run = kwargs.get('dry_run')
+        package_ids = v.rename_term_in_extras(old_term, new_term, dry_run=dry_run)
+        if dry_run:
+            print(u'{} datasets would be updated.'.format(len(package_ids)))
+            return
+        Session.commit()
+
+        print(u'Updated {} datasets.'.format(len(package_ids)))
+        self._reindex(package_ids, kwargs.get('batch_size'))
+
+    def cmd_check_terms(self, vocabulary_name=None, *args, **kwargs):
+        """
+        List terms used in datasets, which are not present in vocabulary
+
+        syntax: check_terms [vocabulary_name,default=all vocabularies] [old_term=new_term ...] [--fix] [--batch-size N]
+
+        With --fix, such terms are removed from datasets, or replaced
+        if old_term=new_term mapping is given, and affected datasets are
+        reindexed in batches of N (default 500). Vocabulary name is
+        required with --fix or mapping.
+        """
+        args = ((vocabulary_name,) if vocabulary_name else ()) + args
+        names = [arg for arg in args if '=' not in arg]
+        mapping = dict(arg.split('=', 1) for arg in args if '=' in arg)
+        if len(names) > 1:
+            print(_("ERROR: only one vocabulary name can be given, got {}").format(', '.join(names)))
+            return
+        if (mapping or kwargs.get('fix')) and not names:
+            print(_("ERROR: vocabulary name is required with --fix or old_term=new_term mapping"))
+            return
+        if names:
+            try:
+                vocabularies = [Vocabulary.get(names[0])]
+            except ValueError, err:
+                print(_("ERROR: {}").format(err))
+                return
+        else:
+            vocabularies = Vocabulary.get_all()
+
+        package_ids = set()
+        for vocab in vocabularies:
+            bad_terms = find_unused_terms(vocab.name)['terms']
+            print(_('{}: {} terms not present in vocabulary').format(vocab.name, len(bad_terms)))
+            for name, term_package_ids in sorted(bad_terms.items()):
+                print(_('  {} used in {} datasets').format(name, len(term_package_ids)))
+            if kwargs.get('fix') and bad_terms:
+                try:
+                    package_ids.update(fix_dangling_terms(vocab, mapping))
+                except ValueError, err:
+                    print(_("ERROR: {}").format(err))
+                    return
+        if package_ids:
+            Session.commit()
+            print(u'Updated {} datasets.'.format(len(package_ids)))
+            self._reindex(sorted(package_ids), kwargs.get('batch_size'))
+
+    def _reindex(self, package_ids, batch_size=None):
+        """
+        Reindex packages changed directly in db, in batches
+        """
+        batch_size = max(batch_size or 500, 1)
+        failed = []
+        for idx in range(0, len(package_ids), batch_size):
+            failed.extend(reindex_batch(package_ids[idx:idx+batch_size])[1])
+        if package_ids:
+            widget_cache.invalidate(NAMESPACE_FEATURED_LOCATIONS)
+            widget_cache.invalidate(NAMESPACE_GROUPS)
+        for pkg_id in failed:
+            print(_("  failed to reindex: {}").format(pkg_id))
+
+    def cmd_rebuild_closure(self, vocabulary_name=None, *args, **kwargs):
+        """
+        Rebuild terms hierarchy closure table
+
+        syntax: rebuild_closure [vocabulary_name,default=all vocabularies]
+        """
+        if vocabulary_name:
+            vocabularies = [Vocabulary.get(vocabulary_name)]
+        else:
+            vocabularies = Vocabulary.get_all()
+        for voc in vocabularies:
+            VocabularyTermClosure.rebuild(voc)
+            print(_('rebuilt terms closure for {} vocabulary').format(voc.name))
+
+    def cmd_rebuild_search_index(self, vocabulary_name=None, *args, **kwargs):
+        """
+        Rebuild normalized labels used by autocomplete
+
+        syntax: rebuild_search_index [vocabulary_name,default=all vocabularies]
+        """
+        if vocabulary_name:
+            vocabularies = [Vocabulary.get(vocabulary_name)]
+        else:
+            vocabularies = Vocabulary.get_all()
+        for voc in vocabularies:
+            count = VocabularyLabelSearch.rebuild(voc)
+            print(_('rebuilt search index for {} vocabulary: {} labels').format(voc.name, count))
+
+    def cmd_rebuild_package_terms(self, vocabulary_name=None, *args, **kwargs):
+        """
+        Rebuild package-term relations from datasets' extras, and term usage
+
+        syntax: rebuild_package_terms [vocabulary_name,default=all vocabularies]
+        """
+        if vocabulary_name:
+            vocabularies = [Vocabulary.get(vocabulary_name)]
+        else:
+            vocabularies = Vocabulary.get_all()
+        for voc in vocabularies:
+            count = PackageTerm.rebuild(voc)
+            TermUsage.refresh(voc)
+            print(_('rebuilt package terms for {} vocabulary: {} relations').format(voc.name, count))
+
+    def cmd_rebuild_usage(self, vocabulary_name=None, *args, **kwargs):
+        """
+        Recompute number of datasets using each term
+
+        syntax: rebuild_usage [vocabulary_name,default=all vocabularies]
+        """
+        if vocabulary_name:
+            vocabularies = [Vocabulary.get(vocabulary_name)]
+        else:
+            vocabularies = Vocabulary.get_all()
+        for voc in vocabularies:
+            TermUsage.refresh(voc)
+            print(_('rebuilt terms usage for {} vocabulary').format(voc.name))
+
+    def _get_loader(self, bulk=False, sync=False, **kwargs):
+        if sync:
+            return sync_vocabulary
+        return bulk_load_vocabulary if bulk else load_vocabulary
 
     def cmd_load(self, vocabulary_name, path, *args, **kwargs):
         """
         Load vocabulary data
 
-        syntax: load vocabulary_name path_to_source_file
+        syntax: load vocabulary_name path_to_source_file [--bulk|--sync]
+
+        With --bulk, terms are loaded with set-based bulk loader, which is
+        much faster for large vocabularies. With --sync, only differences
+        between source file and vocabulary are applied.
         """
+        loader = self._get_loader(**kwargs)
         with open(path, 'rt') as f:
-            count = load_vocabulary(vocabulary_name, f)
+            count = loader(vocabulary_name, f)
             print(_('loaded {} terms from {} to {} vocabulary').format(count, path, vocabulary_name))
 
     def cmd_import_agrovoc(self, in_file, *args, **kwargs):
         """
         Import AGROVOC terms from RDF file
 
-        syntax: import_agrovoc rdf_file
+        syntax: import_agrovoc rdf_file [--bulk|--sync]
         """
         OFFERED_LANGS = (config.get('ckan.locales_offered') or 'en es fr de it').lower().split(' ')
         
         header = ('parent', 'term',) + tuple(('lang:{}'.format(L) for L in OFFERED_LANGS)) + ( 'property:parents',)
-        rdata = []
-        rdata.append(header)
-
-        g = Graph()
-        g.parse(in_file, format='nt')
-        for o, p, s in g.triples((None, RDF.type, SKOS.Concept)):
-            cid = str(o).split('/')[-1]
-            row = {'term': cid}
-
-            for label_r in g.triples((o, SKOS.prefLabel, None)):
-                label = label_r[2]
-                if not label.language in OFFERED_LANGS:
-                    continue
-                row['lang:{}'.format(label.language)] = label.value
-
-            iparents = g.triples((o, SKOS.broader, None))
-            parents = []
-            for to in iparents:
-                parent = to[-1]
-                row['parent'] = str(parent).split('/')[-1]
-                parents.append(row['parent'])
-            if not parents:
-                row['parent'] = None
-            row['property:parents'] = ','.join(parents)
-
-            row_data = []
-            for col in header:
-                if col.startswith('lang'):
-                    val = row.get(col) or row.get('lang:en') or row.get('lang:fr') 
-                else:
-                    val = row[col]
-                row_data.append(val.encode('utf-8') if isinstance(val, unicode) else val)
-            
-            if row['parent']:
-                rdata.append(row_data)
-            else:
-                # top-level should be first
-                rdata.insert(1, row_data)
-
-        log.info('AGROVOC terms parsed: %s', len(rdata))
-        csvdata = StringIO()
-        w = csv.writer(csvdata)
-        w.writerows(rdata)
-
-        csvdata.seek(0)
+
+        def rows():
+            yield header
+            count = 0
+            with open(in_file, 'rb') as f:
+                for cid, labels, parents in _iter_agrovoc_concepts(f, OFFERED_LANGS):
+                    row = {'term': cid,
+                           'parent': parents[-1] if parents else None,
+                           'property:parents': ','.join(parents)}
+                    for L in OFFERED_LANGS:
+                        row['lang:{}'.format(L)] = labels.get(L)
+
+                    row_data = []
+                    for col in header:
+                        if col.startswith('lang'):
+                            val = row.get(col) or row.get('lang:en') or row.get('lang:fr') 
+                        else:
+                            val = row[col]
+                        row_data.append(val.encode('utf-8') if isinstance(val, unicode) else val)
+                    count += 1
+                    yield row_data
+            log.info('AGROVOC terms parsed: %s', count)
+
         voc_name = Vocabulary.VOCABULARY_AGROVOC
         try:
             voc = Vocabulary.get(voc_name)
         except ValueError:
             voc = Vocabulary.create(voc_name, has_relations=True)
 
-        count = load_vocabulary(voc_name, csvdata)
+        count = self._get_loader(**kwargs)(voc_name, _csv_lines(rows()))
         log.info('AGROVOC terms imported: %s', count)
-        cleanup_stats = find_unused_terms(voc_name, 'fao_agrovoc')
+        cleanup_stats = find_unused_terms(voc_name)
         if cleanup_stats['datasets']:
             print("Following dataset have terms not present in vocabulary:")
             for dname, tvals in sorted(cleanup_stats['datasets'].items()):
@@ -155,58 +491,11 @@ class VocabularyCommands(CkanCommand):
         """
         Convert xlsx file with m49 data into vocabulary
 
-        syntax: import_m49 in_file
-        """
-        wb = load_workbook(in_file)
-        sheet = wb.active
-
-        IDX_COUNTRY_M49 = 1
-        IDX_COUNTRY_ISO3 = 2
-        IDX_COUNTRY_NAME = 3
-        IDX_L1_M49 = 8
-        IDX_L1_NAME = 9
-        #IDX_L2_CODE = 10
-        #IDX_L2_NAME = 11
-
-        level1_cells = (IDX_L1_M49, IDX_L1_NAME,)
-        countries_cells = (IDX_COUNTRY_M49, IDX_COUNTRY_NAME, IDX_COUNTRY_ISO3)
-        countries_parent_cell = IDX_L1_M49
-
-        countries = {}  # key: id , value : row
-        level1 = {}     # key: id , value : row
-
-        for row in sheet.iter_rows(min_row=6):
-            for indexes, parent_idx, container in ((countries_cells, countries_parent_cell, countries,),
-                                                   (level1_cells, None, level1,)):
-                # ( parent, data..)
-                rdata = []
-                rdata.append(row[parent_idx-1].value if parent_idx else None)
-                
-                for idx in indexes:
-                    value = row[idx-1].value
-                    try:
-                        value = value.replace('(M49)', '').replace('(MDG=M49)', '') if value else value
-                    except AttributeError:
-                        # prolly it has been parsed as a number
-                        pass
-                    rdata.append(value.encode('utf-8') if isinstance(value, unicode) else value)
-
-                if not any(rdata):
-                    continue
-
-                id = rdata[1]
-                container[id] = rdata  # l1 and l2 may be repeated
-
-        csvdata = StringIO()
-        w = csv.writer(csvdata)
-        w.writerow(['parent', 'term', 'property:country_code', 'lang:en', 'lang:fr', 'lang:es'])
-        for id,r in level1.iteritems():
-            # print('L1 ROW {}: {}'.format(id,r))
-            w.writerow([r[0]] + [r[1]] + [""] + [r[2]] + [r[2]+" [FR]"] + [r[2]+" [ES]"] )
-        for id,r in countries.iteritems():
-            # print('CNTY ROW {}: {}'.format(id,r))
-            w.writerow([r[0]] + [r[1]] + [r[3]] + [r[2]] + [r[2]+" [FR]"] + [r[2]+" [ES]"] )
-        csvdata.seek(0)
+        syntax: import_m49 in_file [--bulk|--sync]
+
+        in_file can be M49 xlsx workbook, or csv/tsv export of UN M49
+        overview table (columns are found by header name).
+        """
         voc_name = Vocabulary.VOCABULARY_M49_REGIONS
 
         try:
@@ -214,10 +503,55 @@ class VocabularyCommands(CkanCommand):
         except ValueError:
             voc = Vocabulary.create(voc_name, has_relations=True)
 
-        count = load_vocabulary(voc_name, csvdata)
+        rows = _iter_m49_terms(_iter_m49_table(in_file))
+        count = self._get_loader(**kwargs)(voc_name, _csv_lines(rows))
         print(_('loaded {} terms from {} to {} vocabulary').format(count, in_file, voc_name))
 
 
+    def cmd_build_store(self, *args, **kwargs):
+        """
+        Write memory-mapped vocabulary store file shared by CKAN processes
+
+        syntax: build_store
+
+        Store is rebuilt by vocabulary commands after changes are
+        committed, this can be used to build it before CKAN processes
+        start, or after vocabularies were changed otherwise.
+        """
+        if not vocabulary_store.enabled:
+            raise ValueError(_("Vocabulary store path is not configured"))
+        Session.commit()
+        count = vocabulary_store.build()
+        print(_('written {} terms to {}').format(count, vocabulary_store.path))
+
+    def cmd_export_snapshot(self, out_file, *vocabulary_names, **kwargs):
+        """
+        Export vocabularies to snapshot file
+
+        syntax: export_snapshot out_file [vocabulary_name ...]
+
+        Snapshot contains terms, parents, labels and properties, and can be
+        loaded with import_snapshot on other instances.
+        """
+        with open(out_file, 'wb') as f:
+            counts = write_snapshot(f, vocabulary_names)
+        for name, count in sorted(counts.items()):
+            print(_('exported {} terms from {} vocabulary').format(count, name))
+
+    def cmd_import_snapshot(self, in_file, *vocabulary_names, **kwargs):
+        """
+        Load vocabularies from snapshot file
+
+        syntax: import_snapshot in_file [vocabulary_name ...] [--sync]
+
+        Vocabularies are loaded with bulk loader, or with --sync, only
+        differences are applied.
+        """
+        with open(in_file, 'rb') as f:
+            counts = load_snapshot(f, vocabulary_names, sync=kwargs.get('sync'))
+        for name, count in sorted(counts.items()):
+            print(_('loaded {} terms from {} to {} vocabulary').format(count, in_file, name))
+
     def get_commands(self):
         """
         Return dictionary of command-> callable 
@@ -249,6 +583,9 @@ class VocabularyCommands(CkanCommand):
         try:
             out = callable(*self.args[1:], **vars(self.options))
             Session.commit()
+            # store is written from committed vocabularies only
+            if vocabulary_store.enabled:
+                vocabulary_store.build(force=False)
             return out
         except Exception, err:
             log.error(_("Can't execute %s with args %s: %s"), cmd, self.args[1:], err, exc_info=err)
@@ -3,15 +3,23 @@
 
 import json
 import urllib
+import hashlib
 
 from ckan import model
 from ckan.plugins import toolkit
 from ckan.lib.i18n import get_lang
 from ckan.logic import get_action
-from ckan.common import request, response, c
+from ckan.common import request, response, c, config
 
 from ckan.controllers.api import ApiController
 
+from ckanext.faociok.models import (VocabularyVersion, CONFIG_AUTOCOMPLETE_ENGINE,
+                                    autocomplete_index)
+
+# how long (in seconds) autocomplete responses can be cached by clients
+# and proxies, 0 disables caching
+CONFIG_AUTOCOMPLETE_MAX_AGE = 'ckanext.faociok.autocomplete.max_age'
+
 
 class FaoAutocompleteController(ApiController):
 
@@ -20,6 +28,17 @@ class FaoAutocompleteController(ApiController):
         q = unicode(urllib.unquote(q), 'utf-8')
         limit = request.params.get('limit', 10)
         lang = request.params.get('lang') or get_lang()
+
+        if autocomplete_index.enabled:
+            # generation checked by index each check_interval, no db query
+            generation, updated = autocomplete_index.get_generation(_vocabulary), None
+        else:
+            generation, updated = VocabularyVersion.get_stamp(_vocabulary)
+        etag = self._get_etag(_vocabulary, generation, q, lang, limit)
+        if self._set_cache_headers(etag, updated):
+            response.status_int = 304
+            return ''
+
         tag_names = []
         if q:
             context = {'model': model, 'session': model.Session,
@@ -40,3 +59,33 @@ class FaoAutocompleteController(ApiController):
             'Lang': lang,
         }
         return self._finish_ok(resultSet)
+
+    def _get_etag(self, vocabulary_name, generation, *params):
+        """
+        Strong ETag for autocomplete response. Response depends only on
+        request params and vocabulary content, which changes with
+        vocabulary generation.
+        """
+        data = [vocabulary_name, generation,
+                config.get(CONFIG_AUTOCOMPLETE_ENGINE, 'db')] + list(params)
+        return '"{}"'.format(hashlib.sha1(json.dumps(data)).hexdigest())
+
+    def _set_cache_headers(self, etag, updated):
+        """
+        Set validation and caching headers for response.
+
+        @rtype bool True if client has current response already
+        """
+        max_age = int(config.get(CONFIG_AUTOCOMPLETE_MAX_AGE, 60))
+        if 'Pragma' in response.headers:
+            del response.headers['Pragma']
+        if max_age > 0:
+            response.headers['Cache-Control'] = 'public, max-age={}'.format(max_age)
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        response.headers['ETag'] = etag
+        if updated:
+            response.last_modified = updated
+
+        if_none_match = request.headers.get('If-None-Match') or ''
+        return etag in [v.strip() for v in if_none_match.split(',')] or if_none_match.strip() == '*'
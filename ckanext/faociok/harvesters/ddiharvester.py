@@ -1,17 +1,124 @@
 # -*- coding: utf-8 -*-
 
+import json
+import time
+import logging
+from contextlib import contextmanager
+
+from sqlalchemy.exc import SQLAlchemyError as SAError
+
 from ckan import model
-from ckan.model import Session
+from ckan.model import Session, PackageExtra
 from ckan.plugins import toolkit
+from ckan.lib.search import commit as solr_commit
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
 
-from ckanext.faociok.models import VocabularyTerm, Vocabulary
+from ckanext.faociok.models import country_resolver
 from ckanext.faociok.plugin import FaociokPlugin
 
 from ckanext.ddi.harvesters.ddiharvester import NadaHarvester
-from ckanext.ddi.importer import DdiCkanMetadata
+
+log = logging.getLogger(__name__)
+
+# harvest object states before import is finished
+PENDING_STATES = ('WAITING', 'FETCH', 'IMPORT',)
+
+# harvest object extra with time spent in import stages
+STATS_KEY = 'fao_import_stats'
+
+SOLR_COMMIT_KEY = 'ckan.search.solr_commit'
+
+
+@contextmanager
+def deferred_solr_commit():
+    """
+    Skip Solr commit of packages written in this block. CKAN indexes
+    packages on write and reads `ckan.search.solr_commit` from global
+    config, so the setting is overridden only while the block runs.
+    Caller should issue Solr commit after the block.
+    """
+    from ckan.common import config
+    previous = config.get(SOLR_COMMIT_KEY)
+    config[SOLR_COMMIT_KEY] = 'false'
+    try:
+        yield
+    finally:
+        if previous is None:
+            config.pop(SOLR_COMMIT_KEY, None)
+        else:
+            config[SOLR_COMMIT_KEY] = previous
+
+
+def get_job_import_stats(job_id):
+    """
+    Returns ImportStats summed from all imported objects of harvest job
+    """
+    stats = ImportStats()
+    q = Session.query(HarvestObjectExtra.value)\
+               .join(HarvestObject, HarvestObject.id==HarvestObjectExtra.harvest_object_id)\
+               .filter(HarvestObject.harvest_job_id==job_id,
+                       HarvestObjectExtra.key==STATS_KEY)
+    for (value,) in q:
+        stats.update(ImportStats.from_dict(json.loads(value)))
+    return stats
+
+
+class ImportStats(object):
+    """
+    Time spent in each import stage
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.count = 0
+
+    @classmethod
+    def from_dict(cls, times):
+        stats = cls()
+        stats.times = dict(times)
+        stats.count = 1
+        return stats
+
+    @contextmanager
+    def measure(self, stage):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.times[stage] = self.times.get(stage, 0) + time.time() - started
+
+    def update(self, other):
+        self.count += other.count
+        for stage, elapsed in other.times.items():
+            self.times[stage] = self.times.get(stage, 0) + elapsed
+
+    def as_dict(self):
+        return dict((stage, round(elapsed, 3),) for stage, elapsed in self.times.items())
+
+    def __str__(self):
+        return ', '.join('{}: {:.2f}s'.format(stage, elapsed)
+                         for stage, elapsed in sorted(self.times.items()))
 
 
 class FaoNadaHarvester(NadaHarvester):
+    """
+    Batched import can be enabled in harvest source config:
+
+        {"batch_size": 100}
+
+    Packages are then written without Solr commit, and Solr commit is
+    issued once per batch_size imported objects (and after the last
+    object of a job). Objects are still imported one by one, by harvest
+    consumer, there's no parallel import in harvest runs (see
+    `harvest_import` command for that).
+
+    Time spent in each import stage is stored in `fao_import_stats`
+    harvest object extra, see also `fao_harvest_job_import_stats` action.
+    """
+
+    # (job id, number of objects imported without solr commit, stats)
+    _batch = (None, 0, None,)
+    _stats = None
 
     def info(self):
         return {
@@ -47,6 +154,71 @@ class FaoNadaHarvester(NadaHarvester):
         return context
 
     def import_stage(self, harvest_object):
+        batch_size = self.get_batch_size(harvest_object.source)
+        stats = ImportStats()
+        if batch_size <= 1:
+            return self._import_with_stats(harvest_object, stats)
+
+        job_id, pending, batch_stats = self._batch
+        if job_id != harvest_object.harvest_job_id:
+            pending, batch_stats = 0, ImportStats()
+        try:
+            with deferred_solr_commit():
+                return self._import_with_stats(harvest_object, stats)
+        finally:
+            # failed object still counts, so the last batch is committed
+            # even if the last object of job fails
+            pending += 1
+            batch_stats.update(stats)
+            if pending >= batch_size or not self._has_pending_objects(harvest_object):
+                with batch_stats.measure('solr_commit'):
+                    solr_commit()
+                log.info("Imported batch of %s objects for job %s: %s",
+                         pending, harvest_object.harvest_job_id, batch_stats)
+                pending, batch_stats = 0, ImportStats()
+            self._batch = (harvest_object.harvest_job_id, pending, batch_stats,)
+
+    def get_batch_size(self, source):
+        """
+        Returns batch_size from harvest source config
+        """
+        try:
+            source_config = json.loads(source.config or '{}')
+            return int(source_config.get('batch_size') or 1)
+        except (ValueError, TypeError, AttributeError,):
+            return 1
+
+    def import_batch(self, harvest_objects, defer_solr_commit=True):
+        """
+        Import harvest objects with one Solr commit at the end.
+
+        @param harvest_objects list of HarvestObject instances
+        @param defer_solr_commit skip Solr commits of each package write
+        @rtype tuple of (list of failed object ids, ImportStats)
+        """
+        stats = ImportStats()
+        failed = []
+        try:
+            for harvest_object in harvest_objects:
+                try:
+                    if defer_solr_commit:
+                        with deferred_solr_commit():
+                            imported = self._import_with_stats(harvest_object, stats)
+                    else:
+                        imported = self._import_with_stats(harvest_object, stats)
+                    if not imported:
+                        failed.append(harvest_object.id)
+                    Session.commit()
+                except Exception, err:
+                    log.error("Can't import harvest object %s: %s", harvest_object.id, err, exc_info=err)
+                    Session.rollback()
+                    failed.append(harvest_object.id)
+        finally:
+            with stats.measure('solr_commit'):
+                solr_commit()
+        return failed, stats
+
+    def _import_with_stats(self, harvest_object, stats):
         content = harvest_object.content
         # when xml is unicode and has charset declaration in <?xml.. part
         # this will raise exception in lxml
@@ -60,54 +232,96 @@ class FaoNadaHarvester(NadaHarvester):
                 pass
         harvest_object.content = content
 
-        ret = super(FaoNadaHarvester, self).import_stage(harvest_object)
-        if not ret:
-            return ret
-        # datatype
-        pkg_id = harvest_object.package_id
-        context = self._get_context()
-        pget = toolkit.get_action('package_show')
-        pupd = toolkit.get_action('package_update')
-
-        ret = pget(context, {'name_or_id': pkg_id})
-
-        # get locations/m49
-        ckan_metadata = DdiCkanMetadata()
-
-        _pkg_dict = ckan_metadata.load(harvest_object.content)
-        
-        region_name = _pkg_dict.get('country')
-        region = None
-        if region_name:
-            region = VocabularyTerm.get_term(Vocabulary.VOCABULARY_M49_REGIONS, region_name).first()
-            if region:
-                region = region[0]
-        extras = ret.get('extras') or []
-
-        # force microdata datatype for imported packages
-        ret['fao_datatype'] = 'microdata'
-
-        # agrovoc is local, so we need to preserve
-        found_in_extras = -1
-        for idx, ex in enumerate(extras):
-            if ex['key'] == 'fao_agrovoc':
-                found_in_extras = idx
-                break
-        if found_in_extras > -1:
-            orig_agrovoc = extras[found_in_extras]
-            # might be Missing instance
-            if isinstance(orig_agrovoc['value'], (str, unicode,)):
-                ret['fao_agrovoc'] = orig_agrovoc['value']
-            else:
-                ret['fao_agrovoc'] = '{}'
+        object_stats = ImportStats()
+        self._stats = object_stats
+        try:
+            with object_stats.measure('import'):
+                ret = super(FaoNadaHarvester, self).import_stage(harvest_object)
+        finally:
+            self._stats = None
+        object_stats.count = 1
+        stats.update(object_stats)
+        # one stats extra per object, replaced on re-import
+        extra = Session.query(HarvestObjectExtra)\
+                       .filter(HarvestObjectExtra.harvest_object_id==harvest_object.id,
+                               HarvestObjectExtra.key==STATS_KEY).first()
+        if extra is None:
+            extra = HarvestObjectExtra(harvest_object_id=harvest_object.id, key=STATS_KEY)
+            Session.add(extra)
+        extra.value = json.dumps(object_stats.as_dict())
+        return ret
+
+    def _has_pending_objects(self, harvest_object):
+        q = Session.query(HarvestObject.id)\
+                   .filter(HarvestObject.harvest_job_id==harvest_object.harvest_job_id,
+                           HarvestObject.state.in_(PENDING_STATES),
+                           HarvestObject.id!=harvest_object.id)
+        try:
+            return Session.query(q.exists()).scalar()
+        except SAError, err:
+            # session can't be used after failed import, assume job is done
+            log.warning("Cannot check pending objects of job %s: %s",
+                        harvest_object.harvest_job_id, err)
+            return False
+
+    @contextmanager
+    def _measure(self, stage):
+        if self._stats is None:
+            yield
         else:
-            ret['fao_agrovoc'] = '{}'
-        
+            with self._stats.measure(stage):
+                yield
+
+    def _create_or_update_package(self, package_dict, harvest_object, *args, **kwargs):
+        """
+        Add FAO-CIOK fields to harvested package before it's written,
+        so each harvest object is saved and indexed once.
+        """
         # remove duplicated extras
-        ret['extras'] = [ex for ex in extras if not ex['key'].startswith('fao_')]
+        with self._measure('fao_fields'):
+            package_dict['extras'] = [ex for ex in package_dict.get('extras') or []
+                                      if not ex['key'].startswith('fao_')]
+            package_dict.update(self._get_fao_fields(package_dict, harvest_object))
+        with self._measure('package_write'):
+            return super(FaoNadaHarvester, self)._create_or_update_package(package_dict,
+                                                                          harvest_object,
+                                                                          *args, **kwargs)
 
-        ret['fao_m49_regions'] = '{{{}}}'.format(region.name) if region else '{}'
-        ret['metadata_modified'] = None
-        out = pupd(self._get_context(), ret)
-        
-        return ret
+    def _get_fao_fields(self, package_dict, harvest_object):
+        """
+        Returns FAO-CIOK fields for harvested package:
+         * datatype is always microdata
+         * m49 region is matched with DDI country name
+         * AGROVOC terms are set locally, so they're preserved
+        """
+        region = self._get_region(package_dict.get('country'))
+        return {'fao_datatype': 'microdata',
+                'fao_m49_regions': '{{{}}}'.format(region) if region else '{}',
+                'fao_agrovoc': self._get_local_agrovoc(package_dict, harvest_object)}
+
+    def _get_region(self, region_name):
+        """
+        Returns M49 region name matching country name (or ISO3 code)
+        """
+        region = country_resolver.resolve(region_name)
+        if region_name and not region:
+            log.info("No M49 region matching country %s", region_name)
+        return region
+
+    def _get_local_agrovoc(self, package_dict, harvest_object):
+        package_id = package_dict.get('id') or harvest_object.package_id
+        if not package_id:
+            previous = Session.query(HarvestObject.package_id)\
+                              .filter(HarvestObject.guid==harvest_object.guid,
+                                      HarvestObject.current==True).first()
+            package_id = previous[0] if previous else None
+        if not package_id:
+            return '{}'
+        value = Session.query(PackageExtra.value)\
+                       .filter(PackageExtra.package_id==package_id,
+                               PackageExtra.key=='fao_agrovoc',
+                               PackageExtra.state=='active').scalar()
+        # might be Missing instance
+        if isinstance(value, (str, unicode,)):
+            return value
+        return '{}'
@@ -10,6 +10,8 @@ from ckan.plugins import toolkit as t
 from ckan.lib import helpers as h
 from ckan.lib.base import config
 from ckanext.faociok.models import Vocabulary, VocabularyTerm
+from ckanext.faociok.cache import (widget_cache, NAMESPACE_FEATURED_LOCATIONS,
+                                   NAMESPACE_GROUPS)
 
 DEFAULT_LANG = config.get('ckan.locale_default')
 
@@ -18,25 +20,24 @@ FAOCIOK_DATATYPE_FIXED = 'ckanext.faociok.datatype.fixed'
 
 def get_fao_datatype(name):
     lang = get_lang()
-    term = VocabularyTerm.get(Vocabulary.VOCABULARY_DATATYPE, name)
-    label = term.get_label(lang) or term.get_label(DEFAULT_LANG) or term.get_label('en')
-    return (label.label or term.name) if term else None
+    term = VocabularyTerm.get_cached(Vocabulary.VOCABULARY_DATATYPE, name)
+    if not term:
+        return None
+    return term.get_label_text(lang, DEFAULT_LANG, 'en') or term.name
 
 
 def get_fao_m49_region(name):
     lang = get_lang()
-    term = VocabularyTerm.get(Vocabulary.VOCABULARY_M49_REGIONS, name)
+    term = VocabularyTerm.get_cached(Vocabulary.VOCABULARY_M49_REGIONS, name)
     if term:
-        label = term.get_label(lang) or term.get_label(DEFAULT_LANG) or term.get_label('en')
-        return label.label
+        return term.get_label_text(lang, DEFAULT_LANG, 'en') or name
     return name
 
 def get_fao_agrovoc_term(name):
     lang = get_lang()
-    term = VocabularyTerm.get(Vocabulary.VOCABULARY_AGROVOC, name)
+    term = VocabularyTerm.get_cached(Vocabulary.VOCABULARY_AGROVOC, name)
     if term:
-        label = term.get_label(lang) or term.get_label(DEFAULT_LANG) or term.get_label('en')
-        return label.label
+        return term.get_label_text(lang, DEFAULT_LANG, 'en') or name
     return name
 
 def format_term(term, depth):
@@ -62,17 +63,19 @@ def load_json(value, fail=False):
 
 def most_popular_groups(n):
     '''Return a sorted list of the groups with the most datasets.'''
-    # Get a list of all the site's groups from CKAN, sorted by number of
-    # datasets.
-    groups = toolkit.get_action('group_list')(
-        data_dict={ 'all_fields': True})
+    def load():
+        # group_list sorted by package count skips groups without datasets
+        groups = _group_list('group', sort='package_count', limit=n)
+        if len(groups) < n:
+            names = set(g['name'] for g in groups)
+            groups.extend(g for g in _group_list('group', limit=n) if g['name'] not in names)
+        return groups[:n]
+    return widget_cache.get_or_set(NAMESPACE_GROUPS, 'popular:{}'.format(n), load)
 
-    # Truncate the list to the n most popular groups only.
-    groups = sorted(groups, key=lambda k: k['package_count'], reverse=True) 
-    groups = groups[:n]
-     
 
-    return groups
+def _group_list(group_type, **params):
+    params['all_fields'] = True
+    return t.get_action('{}_list'.format(group_type))({}, params)
 
 
 def get_field_data(data, field, lang=None):
@@ -83,14 +86,12 @@ def get_field_data(data, field, lang=None):
         for val in values:
             if not val:
                 continue
-            term = VocabularyTerm.get(Vocabulary.VOCABULARY_AGROVOC, val)
+            term = VocabularyTerm.get_cached(Vocabulary.VOCABULARY_AGROVOC, val)
             if not term:
                 out.append(u'{}|{}'.format(val, val))
                 continue
-            label = term.get_label(lang)
-            if not label:
-                label = term.get_label('en') 
-            out.append(u'{}|{}'.format(val, label.label or val))
+            label = term.get_label_text(lang, 'en')
+            out.append(u'{}|{}'.format(val, label or val))
         print('out', out)
         return out
         
@@ -109,7 +110,10 @@ def get_vocabulary_items_annotated(vocabulary_name, is_multiple=False, filters=N
 
 def get_locations_featured():
     lang = get_lang()
-    return VocabularyTerm.get_most_frequent_parent(Vocabulary.VOCABULARY_M49_REGIONS, lang=lang, multiple=True, limit=4)
+    def load():
+        return VocabularyTerm.get_most_frequent_parent(Vocabulary.VOCABULARY_M49_REGIONS,
+                                                       lang=lang, limit=4)
+    return widget_cache.get_or_set(NAMESPACE_FEATURED_LOCATIONS, lang, load)
     #return get_vocabulary_items_annotated('m49_regions', is_multiple=True, filters={'depth':0})[:4]
 
 
@@ -122,23 +126,19 @@ def get_organizations_featured():
 
 
 def _get_featured(group_type, max_results=4):
-    params_with_pkg = {'limit': 4,
-                       'all_fields': True,
-                       'sort': 'package_count'}
-    params_any = {'limit': 4, 'all_fields': True}
-    call_name = '{}_list'.format(group_type)
-    action = t.get_action(call_name)
-
-    data = action({}, params_with_pkg)\
-        or action({}, params_any)
-    return data[:max_results]
+    def load():
+        return _group_list(group_type, sort='package_count', limit=max_results)\
+            or _group_list(group_type, limit=max_results)
+    return widget_cache.get_or_set(NAMESPACE_GROUPS,
+                                   'featured:{}:{}'.format(group_type, max_results),
+                                   load)
 
 def get_url_for_location(location_code):
     lang = get_lang()
-    term = VocabularyTerm.get(Vocabulary.VOCABULARY_M49_REGIONS, location_code)
+    term = VocabularyTerm.get_cached(Vocabulary.VOCABULARY_M49_REGIONS, location_code)
     if not term:
         return h.url_for('search')
-    label = term.get_label(lang).label or term.get_label('en').label
+    label = term.get_label_text(lang, 'en')
     qdict = {'fao_m49_regions_l{}_{}'.format(term.depth, lang): label}
     return h.url_for('search', **qdict)
 
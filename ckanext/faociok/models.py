@@ -1,26 +1,55 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import re
 import logging
 import json
 import csv
+import time
+import zlib
+import struct
+import hashlib
+import os
+import fcntl
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import chain, groupby, islice
+from collections import OrderedDict, namedtuple, deque
+from cStringIO import StringIO
+from datetime import datetime
+from difflib import get_close_matches
 
 from ckan.plugins import toolkit as t
 from ckan.common import _, ungettext
 from ckan.model import Package, PackageExtra, Session
 
-from sqlalchemy import types, Column, ForeignKey, Index, Table, select
-from sqlalchemy import orm, and_, or_, desc, distinct, func, cast, literal, inspect, case, desc
+from sqlalchemy import types, Column, ForeignKey, Index, Table, select, text, bindparam
+from sqlalchemy import event, orm, and_, or_, desc, distinct, func, cast, literal, inspect, case, desc
 from sqlalchemy.exc import SQLAlchemyError as SAError
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 
 from ckan.lib.base import config
 from ckan.model import Session, Tag, Vocabulary, Package, PackageExtra
-from ckan.model import meta, repo
+from ckan.model import meta, repo, package_table, package_extra_table
 
 
 log = logging.getLogger(__name__)
-from ckanext.faociok.utils import _get_user
+from ckanext.faociok.utils import _get_user, normalize_label
+from ckanext.faociok.store import VocabularyStore, write_store
+
+# max number of entries (terms and labels) kept in process-local term cache,
+# set to 0 to disable caching
+CONFIG_CACHE_SIZE = 'ckanext.faociok.cache.size'
+# how often (in seconds) term cache checks if vocabularies were changed
+# by other processes
+CONFIG_CACHE_CHECK_INTERVAL = 'ckanext.faociok.cache.check_interval'
+# autocomplete engine: `db` (default) queries label search table,
+# `memory` uses process-local suggestion index
+CONFIG_AUTOCOMPLETE_ENGINE = 'ckanext.faociok.autocomplete.engine'
+# path of memory-mapped vocabulary store file shared by CKAN processes,
+# store is not used if not set
+CONFIG_STORE_PATH = 'ckanext.faociok.store.path'
 
 
 DeclarativeBase = declarative_base(metadata=meta.metadata)
@@ -57,9 +86,22 @@ class Vocabulary(DeclarativeBase):
                                           ' with relations' if self.has_relations else '')
 
     def valid_term(self, term):
-        q = Session.query(VocabularyTerm).filter(VocabularyTerm.name==term)
+        q = Session.query(VocabularyTerm).filter(VocabularyTerm.vocabulary_id==self.id,
+                                                 VocabularyTerm.name==term)
         return Session.query(q.exists()).scalar()
 
+    def valid_terms(self, terms):
+        """
+        Returns set of names from terms which exist in this vocabulary
+        """
+        out = set()
+        for chunk in _chunked(set(terms)):
+            q = Session.query(VocabularyTerm.name)\
+                       .filter(VocabularyTerm.vocabulary_id==self.id,
+                               VocabularyTerm.name.in_(chunk))
+            out.update(row[0] for row in q)
+        return out
+
     @classmethod
     def create(cls, name, has_relations=False):
         inst = cls(name=name, has_relations=has_relations)
@@ -76,6 +118,10 @@ class Vocabulary(DeclarativeBase):
 
     def clear(self):
         sq = Session.query(VocabularyTerm.id).filter(VocabularyTerm.vocabulary_id==self.id)
+        TermUsage.clear(self)
+        PackageTerm.clear(self)
+        VocabularyTermClosure.clear(self)
+        VocabularyLabelSearch.clear(self)
         Session.query(VocabularyLabel)\
                    .filter(VocabularyLabel.term_id.in_(sq.subquery())).delete(synchronize_session=False)
 
@@ -86,58 +132,92 @@ class Vocabulary(DeclarativeBase):
         #for vl in q:
         #    Session.delete(vl)
         Session.flush()
+        VocabularyVersion.bump(self)
+
+    # package_extra rows of active datasets which use term (by package term table)
+    _RENAME_WHERE = """
+        package_extra.key = :key
+        AND package_extra.state = 'active'
+        AND package_extra.package_id IN (
+            SELECT pt.package_id FROM faociok_package_term pt
+            JOIN package p ON p.id = pt.package_id
+            WHERE pt.term_id = :old_id AND p.type = 'dataset' AND p.state = 'active')
+        """
+    # exact match of array element, values not in {a,b} notation are skipped
+    _RENAME_ARRAY_WHERE = _RENAME_WHERE + """
+        AND CASE WHEN package_extra.value LIKE '{%}'
+                 THEN :old = ANY(package_extra.value::text[])
+                 ELSE false END
+        """
+    _RENAME_VALUE_WHERE = _RENAME_WHERE + """
+        AND package_extra.value = :old
+        """
+    # new term is not added twice if package already has it
+    _RENAME_ARRAY_SET = """
+        value = '{' || array_to_string(
+                    CASE WHEN :new = ANY(value::text[])
+                         THEN array_remove(value::text[], :old)
+                         ELSE array_replace(value::text[], :old, :new) END, ',') || '}'
+        """
 
-    def rename_term_in_extras(self, old_term, new_term):
+    def rename_term_in_extras(self, old_term, new_term, dry_run=False):
+        """
+        Replace old_term with new_term in vocabulary field of all active
+        datasets. Extras are rewritten with one statement in current
+        transaction, bypassing package_update, so search index is not
+        updated: caller should reindex returned packages after commit.
+
+        @param old_term name of term to replace
+        @param new_term name of replacement term
+        @param dry_run if True, only find affected datasets
+        @rtype list of ids of affected packages
+        """
 
-        if not self.valid_term(old_term):
+        old = VocabularyTerm.get(self, old_term)
+        if not old:
             raise ValueError(u"Old term {} is not valid".format(old_term))
-        if not self.valid_term(new_term):
+        new = VocabularyTerm.get(self, new_term)
+        if not new:
             raise ValueError(u"New term {} is not valid".format(new_term))
+        if old.id == new.id:
+            return []
+
+        params = {'key': self.field_name,
+                  'old': old_term,
+                  'new': new_term,
+                  'old_id': old.id}
+        where = self._RENAME_ARRAY_WHERE if self.is_multivalued else self._RENAME_VALUE_WHERE
+        if dry_run:
+            q = text('SELECT package_id FROM package_extra WHERE {}'.format(where))
+            return [row[0] for row in Session.execute(q, params)]
+
+        set_value = self._RENAME_ARRAY_SET if self.is_multivalued else 'value = :new'
+        q = text('UPDATE package_extra SET {} WHERE {} RETURNING package_id'.format(set_value, where))
+        package_ids = [row[0] for row in Session.execute(q, params)]
+        before = PackageTerm.get_package_terms(self, package_ids)
+
+        now = datetime.utcnow()
+        pt_table = PackageTerm.__table__
+        for chunk in _chunked(package_ids):
+            Session.execute(package_table.update()
+                                         .where(package_table.c.id.in_(chunk))
+                                         .values(metadata_modified=now))
+            Session.execute(pt_table.delete()
+                                    .where(and_(pt_table.c.term_id==old.id,
+                                                pt_table.c.package_id.in_(chunk))))
+        with_new = set(row[0] for row in
+                       Session.query(PackageTerm.package_id)
+                              .filter(PackageTerm.term_id==new.id))
+        _bulk_insert(pt_table, [{'package_id': package_id,
+                                 'term_id': new.id,
+                                 'vocabulary_id': self.id}
+                                for package_id in package_ids if package_id not in with_new])
+        Session.flush()
+        after = PackageTerm.get_package_terms(self, package_ids)
+        TermUsage.apply_changes(self, [(before[package_id], after[package_id],)
+                                       for package_id in package_ids])
+        return package_ids
 
-        if self.is_multivalued:
-            q = Session.query(PackageExtra.package_id).join(Package, Package.id==PackageExtra.package_id)\
-                                           .filter(PackageExtra.key==self.field_name,
-                                                   PackageExtra.value.like('%{}%'.format(old_term)),
-                                                   Package.type=='dataset',
-                                                   Package.state=='active')
-
-        else:
-            q = Session.query(PackageExtra.package_id).join(Package, Package.id==PackageExtra.package_id)\
-                                           .filter(PackageExtra.key==self.field_name,
-                                                   PackageExtra.value==old_term,
-                                                   Package.type=='dataset',
-                                                   Package.state=='active')
-        
-        # import in function to avoid circular dependencies
-        from ckanext.faociok.validators import _serialize_to_array, _deserialize_from_array
-
-        ctx = {'ignore_auth': True,
-               'user': _get_user()['name']}
-
-        pshow = t.get_action('package_show')
-        pupdate = t.get_action('package_update')
-        counter = 0
-        for pdata in q:
-            pkg = pshow(ctx.copy(), {'name_or_id': pdata[0]})
-            fdata = pkg.get(self.field_name)
-            affected = False
-            if self.is_multivalued:
-                fdata = _deserialize_from_array(fdata)
-                if old_term in fdata:
-                    fdata.remove(old_term)
-                    fdata.append(new_term)
-                    fdata = _serialize_to_array(fdata)
-                    affected = True
-            else:
-                fdata = new_term
-                affected = True
-            if affected:
-                pkg[self.field_name] = fdata
-                pkg.pop('metadata_modified', None)
-                pupdate(ctx.copy(), pkg)
-                counter += 1
-        return counter
-    
     @classmethod
     def get_all(cls):
         q = Session.query(cls).all()
@@ -167,6 +247,7 @@ class VocabularyTerm(DeclarativeBase):
         self._properties = json.dumps(value)
 
     def clear_labels(self):
+        Session.query(VocabularyLabelSearch).filter(VocabularyLabelSearch.term_id==self.id).delete()
         Session.query(VocabularyLabel).filter(VocabularyLabel.term_id==self.id).delete()
         Session.flush()
 
@@ -178,15 +259,51 @@ class VocabularyTerm(DeclarativeBase):
         return Session.query(VocabularyLabel).filter(VocabularyLabel.term_id==self.id,
                                                      VocabularyLabel.lang==lang).first()
     def get_path(self):
-        parent = self
-        old_parent = None
-        out = []
+        if self.id is not None:
+            names = [a.name for a in self.get_ancestors(include_self=True)]
+            if names:
+                return '/'.join(names)
+        # not yet stored, build path from parent
+        parent = self.parent
+        if parent is None or parent is self:
+            return self.name
+        return u'{}/{}'.format(parent.path or parent.get_path(), self.name)
+
+    def get_ancestors(self, include_self=False):
+        """
+        Returns list of term's ancestors, starting from top-level one.
+        """
+        q = Session.query(VocabularyTerm)\
+                   .join(VocabularyTermClosure,
+                         VocabularyTermClosure.ancestor_id==VocabularyTerm.id)\
+                   .filter(VocabularyTermClosure.descendant_id==self.id)\
+                   .order_by(desc(VocabularyTermClosure.distance))
+        if not include_self:
+            q = q.filter(VocabularyTermClosure.distance > 0)
+        return q.all()
+
+    def get_descendants_q(self, max_distance=None, include_self=False):
+        """
+        Returns query for term's descendants (subtree), ordered by depth and name.
+
+        @param max_distance optional, limit subtree to descendants that are
+                            at most max_distance levels below term
+        @param include_self include term in results
+        """
+        q = Session.query(VocabularyTerm)\
+                   .join(VocabularyTermClosure,
+                         VocabularyTermClosure.descendant_id==VocabularyTerm.id)\
+                   .filter(VocabularyTermClosure.ancestor_id==self.id)\
+                   .order_by(VocabularyTerm.depth, VocabularyTerm.name)
+        if not include_self:
+            q = q.filter(VocabularyTermClosure.distance > 0)
+        if max_distance is not None:
+            q = q.filter(VocabularyTermClosure.distance <= max_distance)
+        return q
 
-        while parent and parent != old_parent:
-            out.append(parent.name)
-            old_parent = parent
-            parent = parent.parent
-        return '/'.join(reversed(out))
+    def get_descendants(self, max_distance=None, include_self=False):
+        return self.get_descendants_q(max_distance=max_distance,
+                                      include_self=include_self).all()
 
     def update_path(self):
         path = self.get_path()
@@ -227,14 +344,71 @@ class VocabularyTerm(DeclarativeBase):
         inst.update_path()
         Session.add(inst)
         Session.flush()
+        VocabularyTermClosure.add_term(inst)
         return inst
 
-    def update(self, labels=labels, parent=None, properties=None):
+    def update(self, labels=None, parent=None, properties=None):
+        """
+        Replace term's labels and properties, and set its parent
+
+        @param labels dict of lang -> label
+        @param parent VocabularyTerm instance, None for top-level term
+        @param properties dict of term properties
+        """
         self.clear_labels()
-        self.set_labels(labels)
+        self.set_labels(labels or {})
         self.properties = properties or {}
         Session.add(self)
+        if (parent.id if parent else None) != self.parent_id:
+            self.move(parent)
         Session.flush()
+        VocabularyVersion.bump(self.vocabulary)
+
+    def move(self, parent):
+        """
+        Move term with its subtree under new parent. Depth and path of
+        subtree terms, closure rows and term usage counts are updated.
+
+        @param parent VocabularyTerm instance, None for top-level term
+        """
+        if parent is not None:
+            if parent.vocabulary_id != self.vocabulary_id:
+                raise ValueError(_("Parent {} is not in vocabulary of term {}")
+                                 .format(parent.name, self.name))
+            if parent.id == self.id or self.id in [a.id for a in parent.get_ancestors()]:
+                raise ValueError(_("Term {} cannot be moved under its own descendant {}")
+                                 .format(self.name, parent.name))
+        if not self.vocabulary.has_relations and parent is not None:
+            raise ValueError(_("Vocabulary {} doesn't support relations").format(self.vocabulary.name))
+
+        old_depth, old_path = self.depth, self.path
+        self.parent = parent
+        self.parent_id = parent.id if parent else None
+        self.depth = parent.depth + 1 if parent else 0
+        self.path = u'{}/{}'.format(parent.path, self.name) if parent else self.name
+        Session.flush()
+
+        subtree = Session.query(VocabularyTermClosure.descendant_id)\
+                         .filter(VocabularyTermClosure.ancestor_id==self.id,
+                                 VocabularyTermClosure.distance > 0)
+        Session.query(VocabularyTerm)\
+               .filter(VocabularyTerm.id.in_(subtree.subquery()))\
+               .update({'depth': VocabularyTerm.depth + (self.depth - old_depth),
+                        'path': literal(self.path) + func.substr(VocabularyTerm.path,
+                                                                 len(old_path) + 1)},
+                       synchronize_session='fetch')
+        VocabularyTermClosure.move_term(self)
+        TermUsage.refresh(self.vocabulary)
+
+    @classmethod
+    def get_cached(cls, vocab, name):
+        """
+        Returns CachedTerm for given vocabulary and term name, or None
+        if term doesn't exist. Lookup is served from process-local term cache.
+        """
+        if isinstance(vocab, Vocabulary):
+            vocab = vocab.name
+        return term_cache.get_term(vocab, name)
 
     @classmethod
     def get_term(cls, vocabulary_name, *names):
@@ -271,26 +445,14 @@ class VocabularyTerm(DeclarativeBase):
             else:
                 q = q.order_by(cls.name)
         else:
-            if is_multiple:
-                oth = inspect(PackageExtra)
-                value_cond = '{} =any({}::varchar[])'.format(cls.__table__.c['name'],
-                                                                oth.c['value'])
-            else:
-                #value_cond = PackageExtra.value == cls.name
-                value_cond = PackageExtra.value == cls.name
-
-            q = s.query(cls.name, VocabularyLabel.label, cls.depth, cls.id, func.count(distinct(Package.id)).label('cnt')).join(Vocabulary)\
-                                                        .outerjoin(VocabularyLabel)\
-                                                        .outerjoin(PackageExtra,
-                                                              and_(PackageExtra.key=='fao_{}'.format(vocabulary_name),
-                                                                   value_cond))\
-                                                        .outerjoin(Package, 
-                                                                and_(Package.id==PackageExtra.package_id,
-                                                                     Package.type=='dataset',
-                                                                     Package.state=='active'))\
-                                                        .filter(Vocabulary.name==vocabulary_name,
-                                                                VocabularyLabel.lang==lang)\
-                                                        .group_by(cls.name, VocabularyLabel.label, cls.depth, cls.id)
+            # counts are precomputed in term usage table
+            q = s.query(cls.name, VocabularyLabel.label, cls.depth, cls.id,
+                        func.coalesce(TermUsage.dataset_count, 0).label('cnt'))\
+                 .join(Vocabulary)\
+                 .outerjoin(VocabularyLabel)\
+                 .outerjoin(TermUsage, TermUsage.term_id==cls.id)\
+                 .filter(Vocabulary.name==vocabulary_name,
+                         VocabularyLabel.lang==lang)
             if order_by:
                 q = q.order_by(*order_by)
             else:
@@ -359,41 +521,47 @@ class VocabularyTerm(DeclarativeBase):
         return out
 
     @classmethod
-    def get_most_frequent_parent(cls, vocabulary, lang, multiple=False, limit=None):
+    def get_most_frequent_parent(cls, vocabulary, lang, limit=None):
 
+        """
+        Returns terms with children, ordered by number of active datasets
+        using the term or any of its descendants (TermUsage.total_count),
+        with labels in given lang. Each dataset is counted once per term,
+        also when it uses several of its descendants, and descendants
+        below direct children are counted too.
+
+        @param vocabulary name of vocabulary
+        @param lang language of labels (with fallback to en)
+        @param limit max number of terms returned
+        """
         children = orm.aliased(VocabularyTerm, name='children_vocab_term')
-        oth = inspect(PackageExtra)
-
-        if multiple:
-            value_cond = '{} =any({}::varchar[])'.format('children_vocab_term.name',
-                                                         oth.c.value)
-        else:
-            #value_cond = PackageExtra.value == cls.name
-            value_cond = PackageExtra.value == children.name
-        
-        q = Session.query(VocabularyTerm.id, VocabularyTerm.name, func.count(1).label('cnt'))\
+        has_children = Session.query(children.id).filter(children.parent_id==VocabularyTerm.id)
+        label = orm.aliased(VocabularyLabel, name='label')
+        label_en = orm.aliased(VocabularyLabel, name='label_en')
+
+        q = Session.query(VocabularyTerm.name,
+                          TermUsage.total_count.label('cnt'),
+                          label.label,
+                          label_en.label)\
                    .join(Vocabulary, and_(Vocabulary.id==VocabularyTerm.vocabulary_id,
                                           Vocabulary.name==vocabulary))\
-                   .join(children, VocabularyTerm.id==children.parent_id)\
-                   .join(PackageExtra,
-                              and_(PackageExtra.key=='fao_{}'.format(vocabulary),
-                                     value_cond))\
-                   .group_by(VocabularyTerm.id, VocabularyTerm.name)\
+                   .join(TermUsage, TermUsage.term_id==VocabularyTerm.id)\
+                   .outerjoin(label, and_(label.term_id==VocabularyTerm.id,
+                                          label.lang==lang))\
+                   .outerjoin(label_en, and_(label_en.term_id==VocabularyTerm.id,
+                                             label_en.lang=='en'))\
+                   .filter(TermUsage.total_count > 0,
+                           has_children.exists())\
                    .order_by(desc('cnt'), VocabularyTerm.name)
         if limit:
             q = q.limit(limit)
 
         out = []
-        for item in q:
-            parent_id = item[0]
-            parent_name = item[1]
-            count = item[2]
-            parent = VocabularyTerm.get_by_id(parent_id)
-            text = parent.get_label(lang).label or parent.get_label('en').label or v
+        for parent_name, count, text, text_en in q:
             out.append({'name': parent_name,
                         'dataset_count': count,
                         'value': parent_name,
-                        'text': text})
+                        'text': text or text_en or parent_name})
         return out
 
 class VocabularyLabel(DeclarativeBase):
@@ -411,57 +579,1351 @@ class VocabularyLabel(DeclarativeBase):
                    lang=lang)
         Session.add(inst)
         Session.flush()
+        Session.execute(VocabularyLabelSearch.__table__.insert()
+                                             .values(VocabularyLabelSearch.make_row(inst)))
         return inst
 
 
+class VocabularyLabelSearch(DeclarativeBase):
+    """
+    Normalized (lowercased, without accents) copy of labels, used
+    by autocomplete to search with prefix and trigram indexes.
+    """
+    __tablename__ = 'faociok_vocabulary_label_search'
+    label_id = Column(types.Integer, ForeignKey(VocabularyLabel.id), primary_key=True)
+    term_id = Column(types.Integer, ForeignKey(VocabularyTerm.id), nullable=False)
+    vocabulary_id = Column(types.Integer, ForeignKey(Vocabulary.id), nullable=False)
+    lang = Column(types.Unicode, nullable=False)
+    normalized = Column(types.Unicode, nullable=False)
+
+    __table_args__ = (Index('faociok_vocabulary_label_search_prefix_idx',
+                            'vocabulary_id', 'lang', 'normalized',
+                            postgresql_ops={'normalized': 'varchar_pattern_ops'}),
+                      Index('faociok_vocabulary_label_search_term_idx', 'term_id'),)
+
+    TRIGRAM_INDEX = 'faociok_vocabulary_label_search_trgm_idx'
+
+    @classmethod
+    def make_row(cls, label, term=None, vocabulary_id=None):
+        """
+        Returns search row values for given label
+        """
+        term = term or label.term
+        return {'label_id': label.id,
+                'term_id': term.id,
+                'vocabulary_id': vocabulary_id or term.vocabulary_id,
+                'lang': label.lang,
+                'normalized': normalize_label(label.label, label.lang)}
+
+    @classmethod
+    def clear(cls, vocab):
+        Session.query(cls).filter(cls.vocabulary_id==vocab.id)\
+                          .delete(synchronize_session=False)
+
+    @classmethod
+    def rebuild(cls, vocab):
+        """
+        Rebuild search rows for all labels in vocabulary
+        """
+        cls.clear(vocab)
+        q = Session.query(VocabularyLabel.id, VocabularyLabel.term_id,
+                          VocabularyLabel.lang, VocabularyLabel.label)\
+                   .join(VocabularyTerm, VocabularyTerm.id==VocabularyLabel.term_id)\
+                   .filter(VocabularyTerm.vocabulary_id==vocab.id)
+        rows = [{'label_id': label_id,
+                 'term_id': term_id,
+                 'vocabulary_id': vocab.id,
+                 'lang': lang,
+                 'normalized': normalize_label(label, lang)}
+                for label_id, term_id, lang, label in q]
+        _bulk_insert(cls.__table__, rows)
+        Session.flush()
+        return len(rows)
+
+    @classmethod
+    def setup_trigram_index(cls):
+        """
+        Create trigram index for substring search, or verify existing one.
+        Invalid index (left by failed build) is recreated. This requires
+        pg_trgm extension, which may be not available, so failure is not
+        fatal.
+        """
+        engine = meta.engine
+        if engine.dialect.name != 'postgresql':
+            return False
+        valid = engine.execute(text('SELECT i.indisvalid FROM pg_class c '
+                                    'JOIN pg_index i ON i.indexrelid = c.oid '
+                                    'WHERE c.relname = :name AND c.relkind = \'i\''),
+                               name=cls.TRIGRAM_INDEX).scalar()
+        if valid:
+            return True
+        try:
+            if valid is not None:
+                log.warning(_("Trigram index %s is invalid, recreating"), cls.TRIGRAM_INDEX)
+                engine.execute('DROP INDEX {}'.format(cls.TRIGRAM_INDEX))
+            engine.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            engine.execute('CREATE INDEX {} ON {} USING gin (normalized gin_trgm_ops)'
+                           .format(cls.TRIGRAM_INDEX, cls.__tablename__))
+        except SAError, err:
+            log.warning(_("Cannot create trigram index for label search: %s"), err)
+            return False
+        return True
+
+
+class VocabularyTermClosure(DeclarativeBase):
+    """
+    Materialized transitive closure of term -> parent relation. Each term
+    has a row for itself (distance 0) and for each of its ancestors (distance
+    is a number of levels between ancestor and descendant).
+    """
+    __tablename__ = 'faociok_vocabulary_term_closure'
+    ancestor_id = Column(types.Integer, ForeignKey(VocabularyTerm.id), primary_key=True)
+    descendant_id = Column(types.Integer, ForeignKey(VocabularyTerm.id), primary_key=True)
+    distance = Column(types.Integer, nullable=False)
+
+    __table_args__ = (Index('faociok_vocabulary_term_closure_descendant_idx',
+                            'descendant_id', 'distance'),)
+
+    @classmethod
+    def add_term(cls, term):
+        """
+        Add closure rows for newly created term. Term's parent should
+        already have closure rows.
+        """
+        table = cls.__table__
+        Session.execute(table.insert().values(ancestor_id=term.id,
+                                              descendant_id=term.id,
+                                              distance=0))
+        if term.parent_id is not None:
+            parents = select([table.c.ancestor_id,
+                              literal(term.id),
+                              table.c.distance + 1])\
+                      .where(table.c.descendant_id==term.parent_id)
+            Session.execute(table.insert().from_select(['ancestor_id', 'descendant_id', 'distance'],
+                                                       parents))
+
+    @classmethod
+    def move_term(cls, term):
+        """
+        Replace closure rows linking term's subtree with its former
+        ancestors, after term's parent was changed.
+        """
+        table = cls.__table__
+        subtree = select([table.c.descendant_id]).where(table.c.ancestor_id==term.id)
+        Session.execute(table.delete().where(and_(table.c.descendant_id.in_(subtree),
+                                                  ~table.c.ancestor_id.in_(subtree))))
+        if term.parent_id is not None:
+            above = table.alias('above')
+            below = table.alias('below')
+            rows = select([above.c.ancestor_id,
+                           below.c.descendant_id,
+                           above.c.distance + below.c.distance + 1])\
+                   .where(and_(above.c.descendant_id==term.parent_id,
+                               below.c.ancestor_id==term.id))
+            Session.execute(table.insert().from_select(['ancestor_id', 'descendant_id', 'distance'],
+                                                       rows))
+
+    @classmethod
+    def clear(cls, vocab):
+        terms = Session.query(VocabularyTerm.id).filter(VocabularyTerm.vocabulary_id==vocab.id)
+        Session.query(cls).filter(cls.descendant_id.in_(terms.subquery()))\
+                          .delete(synchronize_session=False)
+
+    @classmethod
+    def rebuild(cls, vocab):
+        """
+        Rebuild closure for whole vocabulary, one statement per depth level.
+        """
+        cls.clear(vocab)
+        table = cls.__table__
+        terms = VocabularyTerm.__table__
+        columns = ['ancestor_id', 'descendant_id', 'distance']
+
+        self_rows = select([terms.c.id, terms.c.id, literal(0)])\
+                    .where(terms.c.vocabulary_id==vocab.id)
+        Session.execute(table.insert().from_select(columns, self_rows))
+
+        max_depth = Session.query(func.max(VocabularyTerm.depth))\
+                           .filter(VocabularyTerm.vocabulary_id==vocab.id).scalar() or 0
+        for depth in range(1, max_depth + 1):
+            parent_rows = select([table.c.ancestor_id, terms.c.id, table.c.distance + 1])\
+                          .select_from(terms.join(table, table.c.descendant_id==terms.c.parent_id))\
+                          .where(and_(terms.c.vocabulary_id==vocab.id,
+                                      terms.c.depth==depth))
+            Session.execute(table.insert().from_select(columns, parent_rows))
+        Session.flush()
+
+
+class PackageTerm(DeclarativeBase):
+    """
+    Terms used by package, as stored in package's vocabulary field extras.
+    Rows are kept for active datasets only, so rows of a package are
+    removed when it's deleted.
+    """
+    __tablename__ = 'faociok_package_term'
+    package_id = Column(types.UnicodeText, ForeignKey('package.id', ondelete='CASCADE'),
+                        primary_key=True)
+    term_id = Column(types.Integer, ForeignKey(VocabularyTerm.id), primary_key=True)
+    vocabulary_id = Column(types.Integer, ForeignKey(Vocabulary.id), nullable=False)
+
+    __table_args__ = (Index('faociok_package_term_term_idx', 'term_id', 'package_id'),
+                      Index('faociok_package_term_vocabulary_idx', 'vocabulary_id'),)
+
+    @classmethod
+    def _get_names(cls, vocab, value):
+        from ckanext.faociok.validators import _deserialize_from_array
+        if vocab.is_multivalued:
+            return [n for n in _deserialize_from_array(value) if n]
+        return [value] if value else []
+
+    @classmethod
+    def clear(cls, vocab):
+        Session.query(cls).filter(cls.vocabulary_id==vocab.id)\
+                          .delete(synchronize_session=False)
+
+    @classmethod
+    def rebuild(cls, vocab):
+        """
+        Rebuild rows for vocabulary from extras of active datasets
+        """
+        cls.clear(vocab)
+        term_ids = dict(Session.query(VocabularyTerm.name, VocabularyTerm.id)
+                               .filter(VocabularyTerm.vocabulary_id==vocab.id))
+        extras = Session.query(PackageExtra.package_id, PackageExtra.value)\
+                        .join(Package, Package.id==PackageExtra.package_id)\
+                        .filter(PackageExtra.key==vocab.field_name,
+                                PackageExtra.state=='active',
+                                Package.type=='dataset',
+                                Package.state=='active')
+        rows = []
+        for package_id, value in extras:
+            found = set(term_ids[name] for name in cls._get_names(vocab, value) if name in term_ids)
+            rows.extend({'package_id': package_id,
+                         'term_id': term_id,
+                         'vocabulary_id': vocab.id} for term_id in found)
+        _bulk_insert(cls.__table__, rows)
+        Session.flush()
+        return len(rows)
+
+    @classmethod
+    def update_package(cls, package_id):
+        """
+        Sync rows for package with its extras, and refresh usage of terms
+        package stopped or started using. Deleted packages and packages
+        which are not datasets don't use any term.
+        """
+        vocabularies = Vocabulary.get_all()
+        package = Session.query(Package.type, Package.state)\
+                         .filter(Package.id==package_id).first()
+        extras = {}
+        if package is not None and tuple(package) == ('dataset', 'active',):
+            extras = dict(Session.query(PackageExtra.key, PackageExtra.value)
+                                 .filter(PackageExtra.package_id==package_id,
+                                         PackageExtra.state=='active',
+                                         PackageExtra.key.in_([v.field_name for v in vocabularies])))
+        for vocab in vocabularies:
+            names = cls._get_names(vocab, extras.get(vocab.field_name))
+            current = set()
+            if names:
+                current = set(row[0] for row in
+                              Session.query(VocabularyTerm.id)
+                                     .filter(VocabularyTerm.vocabulary_id==vocab.id,
+                                             VocabularyTerm.name.in_(names)))
+            stored = set(row[0] for row in
+                         Session.query(cls.term_id).filter(cls.package_id==package_id,
+                                                           cls.vocabulary_id==vocab.id))
+            removed = stored - current
+            if removed:
+                Session.query(cls).filter(cls.package_id==package_id,
+                                          cls.term_id.in_(list(removed)))\
+                                  .delete(synchronize_session=False)
+            for term_id in current - stored:
+                Session.add(cls(package_id=package_id, term_id=term_id, vocabulary_id=vocab.id))
+            Session.flush()
+            TermUsage.apply_changes(vocab, [(stored, current,)])
+
+    @classmethod
+    def get_package_terms(cls, vocab, package_ids):
+        """
+        Returns dictionary of package id -> set of ids of terms
+        from vocabulary used by package
+        """
+        out = dict((package_id, set(),) for package_id in package_ids)
+        for chunk in _chunked(package_ids):
+            q = Session.query(cls.package_id, cls.term_id)\
+                       .filter(cls.vocabulary_id==vocab.id,
+                               cls.package_id.in_(chunk))
+            for package_id, term_id in q:
+                out[package_id].add(term_id)
+        return out
+
+
+class TermUsage(DeclarativeBase):
+    """
+    Number of active datasets using a term directly (dataset_count), and
+    using the term or any of its descendants (total_count). Full refresh
+    creates a row for each term of vocabulary, including unused ones, so
+    dataset changes only update existing rows.
+    """
+    __tablename__ = 'faociok_term_usage'
+    term_id = Column(types.Integer, ForeignKey(VocabularyTerm.id), primary_key=True)
+    vocabulary_id = Column(types.Integer, ForeignKey(Vocabulary.id), nullable=False)
+    dataset_count = Column(types.Integer, nullable=False, default=0)
+    total_count = Column(types.Integer, nullable=False, default=0)
+
+    __table_args__ = (Index('faociok_term_usage_vocabulary_idx', 'vocabulary_id'),)
+
+    @classmethod
+    def clear(cls, vocab):
+        Session.query(cls).filter(cls.vocabulary_id==vocab.id)\
+                          .delete(synchronize_session=False)
+
+    @classmethod
+    def apply_changes(cls, vocab, changes):
+        """
+        Update usage counts by difference of terms used by packages before
+        and after change. Counts are changed in place, so concurrent
+        transactions changing the same term wait for each other's row
+        lock instead of overwriting counts.
+
+        @param vocab Vocabulary instance
+        @param changes iterable of (before, after) tuples of sets of ids
+               of terms used by one package
+        """
+        changes = [(set(before), set(after),) for before, after in changes]
+        changes = [(before, after,) for before, after in changes if before != after]
+        if not changes:
+            return
+        term_ids = set()
+        for before, after in changes:
+            term_ids.update(before | after)
+        # closure contains term itself with distance 0
+        ancestors = {}
+        for chunk in _chunked(term_ids):
+            q = Session.query(VocabularyTermClosure.descendant_id,
+                              VocabularyTermClosure.ancestor_id)\
+                       .filter(VocabularyTermClosure.descendant_id.in_(chunk))
+            for descendant_id, ancestor_id in q:
+                ancestors.setdefault(descendant_id, set()).add(ancestor_id)
+
+        def _covered(terms):
+            return set(chain(*[ancestors.get(term_id, [term_id]) for term_id in terms]))
+
+        deltas = {}
+        for before, after in changes:
+            for idx, (old, new) in enumerate(((before, after,),
+                                              (_covered(before), _covered(after),),)):
+                for term_id in new - old:
+                    deltas.setdefault(term_id, [0, 0])[idx] += 1
+                for term_id in old - new:
+                    deltas.setdefault(term_id, [0, 0])[idx] -= 1
+        deltas = dict((term_id, delta,) for term_id, delta in deltas.items() if any(delta))
+        if not deltas:
+            return
+        # rows are locked in the same order by all transactions
+        existing = set()
+        for chunk in _chunked(sorted(deltas)):
+            q = Session.query(cls.term_id)\
+                       .filter(cls.term_id.in_(chunk))\
+                       .order_by(cls.term_id)\
+                       .with_for_update()
+            existing.update(row[0] for row in q)
+        table = cls.__table__
+        updates = [{'_term_id': term_id,
+                    '_dataset_count': deltas[term_id][0],
+                    '_total_count': deltas[term_id][1]}
+                   for term_id in sorted(existing)]
+        if updates:
+            Session.execute(table.update()
+                                 .where(table.c.term_id==bindparam('_term_id'))
+                                 .values(dataset_count=table.c.dataset_count + bindparam('_dataset_count'),
+                                         total_count=table.c.total_count + bindparam('_total_count')),
+                            updates)
+        # terms added after last full refresh
+        missing = [{'term_id': term_id,
+                    'vocabulary_id': vocab.id,
+                    'dataset_count': max(deltas[term_id][0], 0),
+                    'total_count': max(deltas[term_id][1], 0)}
+                   for term_id in sorted(set(deltas) - existing)]
+        if missing:
+            Session.execute(table.insert(), missing)
+        Session.flush()
+
+    @classmethod
+    def refresh(cls, vocab):
+        """
+        Recompute usage for all terms in vocabulary
+
+        @param vocab Vocabulary instance
+        """
+        closure = VocabularyTermClosure.__table__
+        package_terms = PackageTerm.__table__
+        packages = package_table
+
+        terms = VocabularyTerm.__table__
+
+        cls.clear(vocab)
+        direct = case([(closure.c.distance==0, packages.c.id)])
+        usage = select([closure.c.ancestor_id.label('term_id'),
+                        func.count(distinct(direct)).label('dataset_count'),
+                        func.count(distinct(packages.c.id)).label('total_count')])\
+            .select_from(closure.join(package_terms, package_terms.c.term_id==closure.c.descendant_id)
+                                .join(packages, and_(packages.c.id==package_terms.c.package_id,
+                                                     packages.c.type=='dataset',
+                                                     packages.c.state=='active')))\
+            .where(package_terms.c.vocabulary_id==vocab.id)\
+            .group_by(closure.c.ancestor_id)\
+            .alias('usage')
+        # unused terms get a row as well
+        q = select([terms.c.id,
+                    literal(vocab.id),
+                    func.coalesce(usage.c.dataset_count, 0),
+                    func.coalesce(usage.c.total_count, 0)])\
+            .select_from(terms.outerjoin(usage, usage.c.term_id==terms.c.id))\
+            .where(terms.c.vocabulary_id==vocab.id)
+        columns = ['term_id', 'vocabulary_id', 'dataset_count', 'total_count']
+        Session.execute(cls.__table__.insert().from_select(columns, q))
+        Session.flush()
+
+
+# session info key set when local caches should be dropped at the end
+# of transaction
+CLEAR_PENDING_KEY = 'ckanext-faociok:local-caches:pending'
+
+
+def _clear_local_caches(session):
+    if session.info.pop(CLEAR_PENDING_KEY, None):
+        term_cache.clear()
+        vocabulary_store.clear()
+        autocomplete_index.clear()
+        country_resolver.clear()
+
+
+class VocabularyVersion(DeclarativeBase):
+    """
+    Generation counter for vocabulary. It's bumped each time vocabulary
+    content is changed, so processes can detect if their caches are stale.
+    """
+    __tablename__ = 'faociok_vocabulary_version'
+    vocabulary_id = Column(types.Integer, ForeignKey(Vocabulary.id), primary_key=True)
+    generation = Column(types.Integer, nullable=False, default=0)
+    updated = Column(types.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def bump(cls, vocab):
+        """
+        Increase generation for given vocabulary. Local caches are dropped
+        once transaction is committed (or rolled back, as they may have
+        been filled with uncommitted terms meanwhile), so other threads
+        don't cache old terms again with new generation.
+        """
+        updated = Session.query(cls).filter(cls.vocabulary_id==vocab.id)\
+                                    .update({'generation': cls.generation + 1,
+                                             'updated': datetime.utcnow()},
+                                            synchronize_session=False)
+        if not updated:
+            Session.add(cls(vocabulary_id=vocab.id, generation=1, updated=datetime.utcnow()))
+        Session.flush()
+        session = Session()
+        if not event.contains(session, 'after_commit', _clear_local_caches):
+            event.listen(session, 'after_commit', _clear_local_caches)
+            event.listen(session, 'after_rollback', _clear_local_caches)
+        session.info[CLEAR_PENDING_KEY] = True
+
+    @classmethod
+    def get_generations(cls):
+        """
+        Returns dictionary of vocabulary name -> generation
+        """
+        q = Session.query(Vocabulary.name, cls.generation)\
+                   .join(cls, cls.vocabulary_id==Vocabulary.id)
+        return dict(q)
+
+    @classmethod
+    def get_stamp(cls, vocabulary_name):
+        """
+        Returns (generation, updated) tuple for given vocabulary,
+        (0, None) if vocabulary was never changed.
+        """
+        row = Session.query(cls.generation, cls.updated)\
+                     .join(Vocabulary, Vocabulary.id==cls.vocabulary_id)\
+                     .filter(Vocabulary.name==vocabulary_name).first()
+        return tuple(row) if row else (0, None,)
+
+
+class CachedTerm(namedtuple('CachedTerm', 'id vocabulary_name name parent_id depth path')):
+    """
+    Read-only snapshot of VocabularyTerm, which is not bound to db session,
+    so it can be safely kept in term cache.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_term(cls, term):
+        return cls(term.id, term.vocabulary.name, term.name,
+                   term.parent_id, term.depth, term.path)
+
+    @property
+    def parent(self):
+        if self.parent_id is None:
+            return None
+        return term_cache.get_term_by_id(self.parent_id)
+
+    def get_label_text(self, *langs):
+        """
+        Returns label text for first lang from langs that has non-empty label
+        """
+        for lang in langs:
+            if not lang:
+                continue
+            label = term_cache.get_label(self.id, lang)
+            if label:
+                return label
+
+
+class TermCache(object):
+    """
+    Process-local, bounded LRU cache of vocabulary terms and labels.
+
+    Entries are keyed by (vocabulary name, term name), term id and
+    (term id, lang). Whole cache is dropped when generation of any vocabulary
+    changes, either locally (see VocabularyVersion.bump) or in other process
+    (checked each `check_interval` seconds).
+    """
+
+    _MISSING = object()
+
+    def __init__(self, size=None, check_interval=None):
+        self._size = size
+        self._check_interval = check_interval
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+        self._generations = None
+        self._checked_at = 0
+
+    # config values are read on first use, because cache instance
+    # is created before paster commands load configuration
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = int(config.get(CONFIG_CACHE_SIZE, 10000))
+        return self._size
+
+    @property
+    def check_interval(self):
+        if self._check_interval is None:
+            self._check_interval = int(config.get(CONFIG_CACHE_CHECK_INTERVAL, 30))
+        return self._check_interval
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._generations = None
+            self._checked_at = 0
+
+    def _validate(self):
+        now = time.time()
+        if now - self._checked_at < self.check_interval:
+            return
+        generations = VocabularyVersion.get_generations()
+        with self._lock:
+            if generations != self._generations:
+                self._items.clear()
+                self._generations = generations
+            self._checked_at = now
+
+    def _get(self, key):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return self._MISSING
+            self._items[key] = value
+            return value
+
+    def _set(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def _lookup(self, key, loader):
+        if self.enabled:
+            self._validate()
+            value = self._get(key)
+            if value is not self._MISSING:
+                return value
+        value = loader()
+        self._set(key, value)
+        return value
+
+    def _term_loader(self, term_q):
+        def load():
+            term = term_q.first()
+            if not term:
+                return
+            cached = CachedTerm.from_term(term)
+            # keep alternative key in sync
+            self._set(('term', cached.vocabulary_name, cached.name,), cached)
+            self._set(('id', cached.id,), cached)
+            return cached
+        return load
+
+    def get_term(self, vocabulary_name, name):
+        store = vocabulary_store.get()
+        if store is not None:
+            idx = store.find(vocabulary_name, name)
+            return CachedTerm(*store.term(idx)) if idx is not None else None
+        q = Session.query(VocabularyTerm).join(Vocabulary)\
+                   .filter(Vocabulary.name==vocabulary_name, VocabularyTerm.name==name)
+        return self._lookup(('term', vocabulary_name, name,), self._term_loader(q))
+
+    def get_term_by_id(self, term_id):
+        store = vocabulary_store.get()
+        if store is not None:
+            idx = store.find_by_id(term_id)
+            return CachedTerm(*store.term(idx)) if idx is not None else None
+        q = Session.query(VocabularyTerm).filter(VocabularyTerm.id==term_id)
+        return self._lookup(('id', term_id,), self._term_loader(q))
+
+    def get_label(self, term_id, lang):
+        store = vocabulary_store.get()
+        if store is not None:
+            idx = store.find_by_id(term_id)
+            return store.label(idx, lang) if idx is not None else None
+
+        def load():
+            return Session.query(VocabularyLabel.label)\
+                          .filter(VocabularyLabel.term_id==term_id,
+                                  VocabularyLabel.lang==lang)\
+                          .limit(1).scalar()
+        return self._lookup(('label', term_id, lang,), load)
+
+
+term_cache = TermCache()
+
+
+class SharedVocabularyStore(object):
+    """
+    Memory-mapped vocabulary store (see ckanext.faociok.store), shared by
+    all CKAN processes on the host through page cache.
+
+    File is written from committed vocabularies by vocabulary commands
+    (or `build_store` command), CKAN processes only map it. Each
+    `check_interval` seconds, generations stored in the file are compared
+    with vocabularies' generations; if they don't match, database is used
+    until the file is rebuilt.
+    """
+
+    def __init__(self, check_interval=None):
+        self._check_interval = check_interval
+        self._lock = threading.RLock()
+        self._store = None
+        self._checked_at = 0
+
+    @property
+    def path(self):
+        return config.get(CONFIG_STORE_PATH)
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    @property
+    def check_interval(self):
+        if self._check_interval is None:
+            self._check_interval = int(config.get(CONFIG_CACHE_CHECK_INTERVAL, 30))
+        return self._check_interval
+
+    def clear(self):
+        with self._lock:
+            # mapping is closed when last reference is dropped, so threads
+            # using it now are not affected
+            self._store = None
+            self._checked_at = 0
+
+    def _write(self, session, force):
+        generations = dict(session.query(Vocabulary.name, VocabularyVersion.generation)
+                                  .join(VocabularyVersion,
+                                        VocabularyVersion.vocabulary_id==Vocabulary.id))
+        if not force:
+            store = self._open()
+            if store is not None and store.generations == generations:
+                return None
+        terms = session.query(VocabularyTerm.id, Vocabulary.name, VocabularyTerm.name,
+                              VocabularyTerm.parent_id, VocabularyTerm.depth, VocabularyTerm.path)\
+                       .join(Vocabulary, Vocabulary.id==VocabularyTerm.vocabulary_id)
+        labels = session.query(VocabularyLabel.term_id, VocabularyLabel.lang, VocabularyLabel.label)
+        return write_store(self.path, generations, terms, labels)
+
+    def build(self, force=True):
+        """
+        Write store file from committed vocabularies. Data is read in
+        separate transaction, so changes of current session are not written
+        until they're committed. Should be called after vocabularies are
+        changed and committed.
+
+        @param force if False, file is written only if it doesn't match
+                     committed vocabularies
+        @rtype int number of terms written, None if file was up to date
+        """
+        engine = meta.engine
+        connection = engine.connect()
+        bind = connection
+        # generations and terms are read from the same snapshot
+        if engine.dialect.name == 'postgresql':
+            bind = connection.execution_options(isolation_level='REPEATABLE READ')
+        session = orm.Session(bind=bind)
+        try:
+            with open('{}.lock'.format(self.path), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    return self._write(session, force)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        finally:
+            session.close()
+            connection.close()
+            self.clear()
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            return VocabularyStore(self.path)
+        except (ValueError, EnvironmentError,), err:
+            log.warning("Cannot open vocabulary store %s: %s", self.path, err)
+
+    def get(self):
+        """
+        Returns VocabularyStore matching current vocabularies' generations,
+        None if store is disabled or not available.
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        if now - self._checked_at < self.check_interval:
+            return self._store
+        with self._lock:
+            if now - self._checked_at < self.check_interval:
+                return self._store
+            generations = VocabularyVersion.get_generations()
+            store = self._store
+            if store is None or store.generations != generations:
+                store = self._open()
+                if store is not None and store.generations != generations:
+                    # not rebuilt yet, or written from data which is not
+                    # visible to this session yet
+                    store = None
+            self._store = store
+            self._checked_at = now
+            return store
+
+
+vocabulary_store = SharedVocabularyStore()
+
+
+def _trigrams(value):
+    return set(value[idx:idx+3] for idx in range(len(value) - 2))
+
+
+class LabelSuggestIndex(object):
+    """
+    Suggestion index for labels of one vocabulary in one language.
+
+    Labels are kept in arrays sorted by normalized label, so prefix
+    lookup is a bisect. Substring lookup uses trigram postings to narrow
+    candidates (or scans all labels for queries shorter than 3 chars).
+    """
+
+    def __init__(self, rows):
+        """
+        @param rows iterable of (normalized label, label, term name)
+        """
+        entries = sorted(set(rows))
+        self.keys = [e[0] for e in entries]
+        self.labels = [e[1] for e in entries]
+        self.names = [e[2] for e in entries]
+        self.by_name = {}
+        self.trigrams = {}
+        for idx, (key, label, name) in enumerate(entries):
+            self.by_name.setdefault(name, []).append(idx)
+            for gram in _trigrams(key):
+                self.trigrams.setdefault(gram, array('i')).append(idx)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _prefix(self, value):
+        for idx in xrange(bisect_left(self.keys, value), len(self.keys)):
+            if not self.keys[idx].startswith(value):
+                break
+            yield idx
+
+    def _infix(self, value):
+        grams = _trigrams(value)
+        if grams:
+            postings = [self.trigrams.get(gram, ()) for gram in grams]
+            candidates = min(postings, key=len)
+        else:
+            candidates = xrange(len(self.keys))
+        for idx in candidates:
+            key = self.keys[idx]
+            if value in key and not key.startswith(value):
+                yield idx
+
+    def search(self, term, normalized, offset=0, limit=None):
+        """
+        Returns list of (label, term name) for labels of term named `term`,
+        then for labels starting with `normalized`, then for labels
+        containing it.
+        """
+        seen = set()
+        out = []
+        for idx in chain(self.by_name.get(term, ()),
+                         self._prefix(normalized),
+                         self._infix(normalized)):
+            if idx in seen:
+                continue
+            seen.add(idx)
+            out.append(idx)
+            if limit and len(out) >= offset + limit:
+                break
+        return [(self.labels[idx], self.names[idx],) for idx in out[offset:]]
+
+
+class AutocompleteIndex(object):
+    """
+    Process-local registry of LabelSuggestIndex instances, built lazily
+    per (vocabulary name, lang). Indexes of a vocabulary are dropped when its
+    generation changes; generations are checked each `check_interval` seconds,
+    so lookups between checks don't use db at all.
+    """
+
+    def __init__(self, check_interval=None):
+        self._check_interval = check_interval
+        self._indexes = {}
+        self._lock = threading.RLock()
+        self._generations = None
+        self._checked_at = 0
+
+    @property
+    def check_interval(self):
+        if self._check_interval is None:
+            self._check_interval = int(config.get(CONFIG_CACHE_CHECK_INTERVAL, 30))
+        return self._check_interval
+
+    @property
+    def enabled(self):
+        return config.get(CONFIG_AUTOCOMPLETE_ENGINE, 'db') == 'memory'
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self._generations = None
+            self._checked_at = 0
+
+    def _validate(self):
+        now = time.time()
+        if now - self._checked_at < self.check_interval:
+            return
+        generations = VocabularyVersion.get_generations()
+        with self._lock:
+            previous = self._generations or {}
+            for key in self._indexes.keys():
+                if previous.get(key[0]) != generations.get(key[0]):
+                    del self._indexes[key]
+            self._generations = generations
+            self._checked_at = now
+
+    def get_generation(self, vocabulary_name):
+        """
+        Returns generation of vocabulary which indexes are valid for,
+        0 if vocabulary was never changed.
+        """
+        self._validate()
+        return (self._generations or {}).get(vocabulary_name, 0)
+
+    def _load(self, vocabulary_name, lang):
+        q = Session.query(VocabularyLabelSearch.normalized,
+                          VocabularyLabel.label,
+                          VocabularyTerm.name)\
+                   .join(VocabularyLabel, VocabularyLabel.id==VocabularyLabelSearch.label_id)\
+                   .join(VocabularyTerm, VocabularyTerm.id==VocabularyLabelSearch.term_id)\
+                   .join(Vocabulary, Vocabulary.id==VocabularyLabelSearch.vocabulary_id)\
+                   .filter(Vocabulary.name==vocabulary_name,
+                           VocabularyLabelSearch.lang==lang)
+        return LabelSuggestIndex(q)
+
+    def get(self, vocabulary_name, lang):
+        """
+        Returns LabelSuggestIndex for given vocabulary and lang
+        """
+        self._validate()
+        key = (vocabulary_name, lang,)
+        index = self._indexes.get(key)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(key)
+                if index is None:
+                    index = self._indexes[key] = self._load(vocabulary_name, lang)
+        return index
+
+    def search(self, vocabulary_name, lang, term, offset=0, limit=None):
+        index = self.get(vocabulary_name, lang)
+        return index.search(term, normalize_label(term, lang), offset, limit)
+
+
+autocomplete_index = AutocompleteIndex()
+
+
+# common country names and abbreviations, which are not present in M49
+# labels, mapped to ISO3 codes
+COUNTRY_ALIASES = {
+    u'bolivia': u'BOL',
+    u'britain': u'GBR',
+    u'burma': u'MMR',
+    u'cape verde': u'CPV',
+    u'czech republic': u'CZE',
+    u'democratic republic of congo': u'COD',
+    u'democratic republic of the congo': u'COD',
+    u'drc': u'COD',
+    u'east timor': u'TLS',
+    u'great britain': u'GBR',
+    u'iran': u'IRN',
+    u'ivory coast': u'CIV',
+    u'korea': u'KOR',
+    u'kyrgyzstan': u'KGZ',
+    u'laos': u'LAO',
+    u'macedonia': u'MKD',
+    u'micronesia': u'FSM',
+    u'moldova': u'MDA',
+    u'north korea': u'PRK',
+    u'palestine': u'PSE',
+    u'russia': u'RUS',
+    u'south korea': u'KOR',
+    u'swaziland': u'SWZ',
+    u'syria': u'SYR',
+    u'tanzania': u'TZA',
+    u'turkey': u'TUR',
+    u'uk': u'GBR',
+    u'united kingdom': u'GBR',
+    u'united states': u'USA',
+    u'us': u'USA',
+    u'usa': u'USA',
+    u'venezuela': u'VEN',
+    u'vietnam': u'VNM',
+}
+
+# minimal similarity ratio (0..1) for fuzzy country name matching,
+# set to 0 to disable fuzzy matching
+CONFIG_COUNTRY_FUZZY_CUTOFF = 'ckanext.faociok.m49.fuzzy_cutoff'
+
+
+def _country_keys(value):
+    """
+    Returns set of normalized lookup keys for country name: whole name,
+    name without parenthesized part and name with comma-separated parts
+    swapped ("Korea, Republic of" -> "republic of korea").
+    """
+    value = normalize_label(value)
+    keys = set()
+    for candidate in (value,
+                      re.sub(r'\(.*?\)|\[.*?\]', ' ', value),
+                      u' '.join(reversed(value.split(u',', 1)))):
+        key = u' '.join(re.sub(r'[^\w]+', u' ', candidate, flags=re.UNICODE).split())
+        if key.startswith(u'the '):
+            key = key[4:]
+        if key:
+            keys.add(key)
+    return keys
+
+
+class CountryResolver(object):
+    """
+    Process-local index of M49 terms by normalized name, labels in all
+    languages, ISO3 `country_code` property and common aliases, so
+    country names from harvested records are resolved with dict lookups.
+    Index is rebuilt when M49 vocabulary generation changes.
+    """
+
+    def __init__(self, vocabulary_name=Vocabulary.VOCABULARY_M49_REGIONS, check_interval=None):
+        self.vocabulary_name = vocabulary_name
+        self._check_interval = check_interval
+        self._lock = threading.RLock()
+        self.clear()
+
+    @property
+    def check_interval(self):
+        if self._check_interval is None:
+            self._check_interval = int(config.get(CONFIG_CACHE_CHECK_INTERVAL, 30))
+        return self._check_interval
+
+    @property
+    def fuzzy_cutoff(self):
+        return float(config.get(CONFIG_COUNTRY_FUZZY_CUTOFF, 0.9))
+
+    def clear(self):
+        with self._lock:
+            self._index = None
+            self._fuzzy = {}
+            self._generation = None
+            self._checked_at = 0
+
+    def _validate(self):
+        now = time.time()
+        if now - self._checked_at < self.check_interval:
+            return
+        generation = VocabularyVersion.get_stamp(self.vocabulary_name)[0]
+        with self._lock:
+            if generation != self._generation:
+                self._index = None
+                self._fuzzy = {}
+                self._generation = generation
+            self._checked_at = now
+
+    def _load(self):
+        q = Session.query(VocabularyTerm.name, VocabularyTerm._properties, VocabularyLabel.label)\
+                   .join(Vocabulary, Vocabulary.id==VocabularyTerm.vocabulary_id)\
+                   .outerjoin(VocabularyLabel, VocabularyLabel.term_id==VocabularyTerm.id)\
+                   .filter(Vocabulary.name==self.vocabulary_name)\
+                   .order_by(VocabularyTerm.name)
+        # countries take precedence over regions with the same label
+        countries = {}
+        regions = {}
+        by_code = {}
+        for name, properties, label in q:
+            code = json.loads(properties or '{}').get('country_code')
+            target = countries if code else regions
+            if code:
+                by_code[code.upper()] = name
+                target.setdefault(code.lower(), name)
+            for value in (name, label):
+                if value:
+                    for key in _country_keys(value):
+                        target.setdefault(key, name)
+        index = {}
+        for alias, code in COUNTRY_ALIASES.iteritems():
+            if code in by_code:
+                index[alias] = by_code[code]
+        index.update(regions)
+        index.update(countries)
+        return index
+
+    @property
+    def index(self):
+        self._validate()
+        index = self._index
+        if index is None:
+            with self._lock:
+                index = self._index
+                if index is None:
+                    index = self._index = self._load()
+        return index
+
+    def resolve(self, value):
+        """
+        Returns name of M49 term matching country name or ISO3 code,
+        None if there's no match.
+
+        @param value country name, label in any language or ISO3 code
+        """
+        if not value:
+            return
+        index = self.index
+        keys = _country_keys(value)
+        for key in sorted(keys, key=len, reverse=True):
+            if key in index:
+                return index[key]
+        return self._resolve_fuzzy(index, max(keys, key=len) if keys else None)
+
+    def _resolve_fuzzy(self, index, key):
+        cutoff = self.fuzzy_cutoff
+        if not key or cutoff <= 0:
+            return
+        if key not in self._fuzzy:
+            matches = get_close_matches(key, index.keys(), n=1, cutoff=cutoff)
+            self._fuzzy[key] = index[matches[0]] if matches else None
+        return self._fuzzy[key]
+
+
+country_resolver = CountryResolver()
+
+
 def setup_models():
+    created = []
     for t in (Vocabulary.__table__,
               VocabularyTerm.__table__,
-              VocabularyLabel.__table__):
+              VocabularyLabel.__table__,
+              VocabularyVersion.__table__,
+              VocabularyTermClosure.__table__,
+              VocabularyLabelSearch.__table__,
+              PackageTerm.__table__,
+              TermUsage.__table__):
         if not t.exists():
             t.create()
+            created.append(t)
+
+    # populate tables derived from existing vocabularies
+    if VocabularyTermClosure.__table__ in created:
+        for vocab in Vocabulary.get_all():
+            VocabularyTermClosure.rebuild(vocab)
+    if VocabularyLabelSearch.__table__.exists():
+        VocabularyLabelSearch.setup_trigram_index()
+    if VocabularyLabelSearch.__table__ in created:
+        for vocab in Vocabulary.get_all():
+            VocabularyLabelSearch.rebuild(vocab)
+    if PackageTerm.__table__ in created:
+        for vocab in Vocabulary.get_all():
+            PackageTerm.rebuild(vocab)
+    if PackageTerm.__table__ in created or TermUsage.__table__ in created:
+        for vocab in Vocabulary.get_all():
+            TermUsage.refresh(vocab)
+
+def _chunked(items, size=1000):
+    items = iter(items)
+    chunk = list(islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
+
+
+def get_term_labels(vocabulary_name, names, with_parents=False):
+    """
+    Fetch all labels for given terms, and optionally for their parents,
+    in constant number of queries.
+
+    @param vocabulary_name name of vocabulary
+    @param names list of term names
+    @param with_parents include labels of all term's parents
+
+    @rtype dict of term name -> list of (depth, lang, label) tuples. depth
+           is a depth of term which owns the label (term itself or parent).
+           Names of terms that don't exist in vocabulary (or have no labels)
+           are not present.
+    """
+    names = set(n for n in names if n)
+    out = {}
+    if not names:
+        return out
+
+    store = vocabulary_store.get()
+    if store is not None:
+        for name in names:
+            idx = store.find(vocabulary_name, name)
+            labels = []
+            while idx is not None:
+                depth = store.term(idx)[4]
+                labels.extend((depth, lang, label,) for lang, label in store.labels(idx))
+                idx = store.parent(idx) if with_parents else None
+            if labels:
+                out[name] = labels
+        return out
+
+    owner = orm.aliased(VocabularyTerm, name='label_owner')
+    for chunk in _chunked(names):
+        q = Session.query(VocabularyTerm.name, owner.depth,
+                          VocabularyLabel.lang, VocabularyLabel.label)\
+                   .join(Vocabulary, Vocabulary.id==VocabularyTerm.vocabulary_id)\
+                   .filter(Vocabulary.name==vocabulary_name,
+                           VocabularyTerm.name.in_(chunk))
+        if with_parents:
+            q = q.join(VocabularyTermClosure,
+                       VocabularyTermClosure.descendant_id==VocabularyTerm.id)\
+                 .join(owner, owner.id==VocabularyTermClosure.ancestor_id)
+        else:
+            q = q.join(owner, owner.id==VocabularyTerm.id)
+        q = q.join(VocabularyLabel, VocabularyLabel.term_id==owner.id)
+
+        for name, depth, lang, label in q:
+            try:
+                out[name].append((depth, lang, label,))
+            except KeyError:
+                out[name] = [(depth, lang, label,)]
+    return out
+
+
+def get_packages_term_labels(package_ids):
+    """
+    Preload labels for all terms used in fao fields by given packages.
+
+    @param package_ids list of package ids
+    @rtype dict of vocabulary name -> get_term_labels() result. Terms
+           that are not in vocabulary are mapped to empty list.
+    """
+    from ckanext.faociok.validators import _deserialize_from_array
+
+    vocabularies = (Vocabulary.VOCABULARY_DATATYPE,
+                    Vocabulary.VOCABULARY_M49_REGIONS,
+                    Vocabulary.VOCABULARY_AGROVOC,)
+    fields = dict(('fao_{}'.format(vname), vname,) for vname in vocabularies)
+    names = dict((vname, set(),) for vname in vocabularies)
+
+    for chunk in _chunked(package_ids):
+        q = Session.query(PackageExtra.key, PackageExtra.value)\
+                   .filter(PackageExtra.package_id.in_(chunk),
+                           PackageExtra.state=='active',
+                           PackageExtra.key.in_(fields.keys()))
+        for key, value in q:
+            vname = fields[key]
+            if vname == Vocabulary.VOCABULARY_DATATYPE:
+                names[vname].add(value)
+            else:
+                names[vname].update(_deserialize_from_array(value))
+
+    out = {}
+    for vname, vnames in names.items():
+        labels = get_term_labels(vname, vnames,
+                                 with_parents=vname == Vocabulary.VOCABULARY_M49_REGIONS)
+        out[vname] = dict((name, labels.get(name, []),) for name in vnames)
+    return out
+
+
+# (package id, term name) for each term in active datasets' vocabulary
+# field, which is not present in vocabulary. Multivalued fields are
+# unnested in sql, values not in {a,b} notation are skipped.
+_DANGLING_TERMS_Q = """
+    SELECT used.package_id, used.name FROM (
+        SELECT e.package_id, {names} AS name
+        FROM package_extra e
+        JOIN package p ON p.id = e.package_id
+        WHERE e.key = :key AND e.state = 'active'
+              AND p.type = 'dataset' AND p.state = 'active'
+              {values_filter}) used
+    WHERE used.name <> ''
+          AND NOT EXISTS (SELECT 1 FROM faociok_vocabulary_term t
+                          WHERE t.vocabulary_id = :vocabulary_id AND t.name = used.name)
+    ORDER BY used.package_id
+    """
+
 
-def find_unused_terms(vocabulary_name, field_name):
+def iter_dangling_terms(vocab):
+    """
+    Yields (package id, term name) for terms used in active datasets,
+    which are not present in vocabulary. Rows are streamed with
+    server-side cursor.
+
+    @param vocab Vocabulary instance
+    """
+    if vocab.is_multivalued:
+        q = _DANGLING_TERMS_Q.format(names='unnest(e.value::text[])',
+                                     values_filter="AND e.value LIKE '{%}'")
+    else:
+        q = _DANGLING_TERMS_Q.format(names='e.value', values_filter='')
+    conn = Session.connection().execution_options(stream_results=True)
+    result = conn.execute(text(q), {'key': vocab.field_name, 'vocabulary_id': vocab.id})
+    try:
+        for row in result:
+            yield row[0], row[1]
+    finally:
+        result.close()
+
+
+def find_unused_terms(vocabulary_name, field_name=None):
     """
     Find unused terms for specific vocabulary. Assumption is terms
-    are in package's extras under provided field_name, and are stored
+    are in package's extras under vocabulary's field name, and are stored
     as an array ({item1,item2} notation).
 
-    This will unpack all terms and verify if any of them doesn't have 
-    accompanying VocabularyTerm.
-
     Return is a dictionary with keys:
      * datasets - list of datasets with vocabulary
        terms that are not used by any term
      * list of terms unused
     """
-    from ckanext.faociok.validators import _deserialize_from_array, _serialize_to_array
     datasets = {}
     bad_terms = {}
     out = {'datasets': datasets,
            'terms': bad_terms}
-
-    extras = Session.query(PackageExtra).filter(PackageExtra.state=='active',
-                                                PackageExtra.key==field_name)\
-                                        .join(Package, and_(Package.id==PackageExtra.package_id,
-                                                            Package.type=='dataset',
-                                                            Package.state=='active'))
-    for ex in extras:
-        keys = _deserialize_from_array(ex.value)
-        new_keys = []
-        for k in keys:
-            term = VocabularyTerm.get(vocabulary_name, k)
-            if not term:
-                try:
-                    datasets[ex.package_id].add(k)
-                except KeyError:
-                    datasets[ex.package_id] = set([k])
-                try:
-                    bad_terms[k].add(ex.package_id)
-                except KeyError:
-                    bad_terms[k] = set([ex.package_id])
+    vocab = Vocabulary.get(vocabulary_name)
+    for package_id, name in iter_dangling_terms(vocab):
+        datasets.setdefault(package_id, set()).add(name)
+        bad_terms.setdefault(name, set()).add(package_id)
     return out
 
+
+def fix_dangling_terms(vocab, mapping=None):
+    """
+    Remove terms which are not present in vocabulary from active datasets'
+    vocabulary field, or replace them according to mapping. Extras are
+    updated in current transaction, bypassing package_update, so search
+    index is not updated: caller should reindex returned packages after
+    commit.
+
+    @param vocab Vocabulary instance
+    @param mapping dictionary of dangling term name -> replacement term name
+    @rtype list of ids of affected packages
+    """
+    from ckanext.faociok.validators import _serialize_to_array
+
+    mapping = mapping or {}
+    invalid = set(mapping.values()) - vocab.valid_terms(mapping.values())
+    if invalid:
+        raise ValueError(u"Replacement terms {} are not valid".format(u', '.join(sorted(invalid))))
+
+    package_ids = sorted(set(package_id for package_id, name in iter_dangling_terms(vocab)))
+    before = PackageTerm.get_package_terms(vocab, package_ids)
+    term_ids = dict(Session.query(VocabularyTerm.name, VocabularyTerm.id)
+                           .filter(VocabularyTerm.vocabulary_id==vocab.id,
+                                   VocabularyTerm.name.in_(set(mapping.values()))))\
+               if mapping else {}
+    extras = package_extra_table
+    updates = []
+    new_rows = set()
+    for chunk in _chunked(package_ids):
+        values = Session.query(PackageExtra.package_id, PackageExtra.value)\
+                        .filter(PackageExtra.key==vocab.field_name,
+                                PackageExtra.state=='active',
+                                PackageExtra.package_id.in_(chunk))
+        values = list(values)
+        names = dict((package_id, PackageTerm._get_names(vocab, value),) for package_id, value in values)
+        valid = vocab.valid_terms(chain(*names.values()))
+        for package_id, used in names.iteritems():
+            fixed = []
+            for name in used:
+                if name not in valid:
+                    name = mapping.get(name)
+                    if name:
+                        new_rows.add((package_id, term_ids[name],))
+                if name and name not in fixed:
+                    fixed.append(name)
+            if vocab.is_multivalued:
+                value = _serialize_to_array(fixed)
+            else:
+                value = fixed[0] if fixed else u''
+            updates.append({'_package_id': package_id, 'value': value})
+
+    if updates:
+        Session.execute(extras.update().where(and_(extras.c.package_id==bindparam('_package_id'),
+                                                   extras.c.key==vocab.field_name,
+                                                   extras.c.state=='active')),
+                        updates)
+    now = datetime.utcnow()
+    for chunk in _chunked(package_ids):
+        Session.execute(package_table.update()
+                                     .where(package_table.c.id.in_(chunk))
+                                     .values(metadata_modified=now))
+    if new_rows:
+        existing = set(Session.query(PackageTerm.package_id, PackageTerm.term_id)
+                              .filter(PackageTerm.vocabulary_id==vocab.id,
+                                      PackageTerm.term_id.in_(term_ids.values())))
+        _bulk_insert(PackageTerm.__table__, [{'package_id': package_id,
+                                              'term_id': term_id,
+                                              'vocabulary_id': vocab.id}
+                                             for package_id, term_id in new_rows - existing])
+        Session.flush()
+        after = PackageTerm.get_package_terms(vocab, package_ids)
+        TermUsage.apply_changes(vocab, [(before[package_id], after[package_id],)
+                                        for package_id in package_ids])
+    return package_ids
+
+
 def load_vocabulary(vocabulary_name, fh, **vocab_config):
     """
     Load Vocabulary terms and lang values
@@ -499,8 +1961,64 @@ def load_vocabulary(vocabulary_name, fh, **vocab_config):
     
     print(_("Using {}").format(vocab))
 
-    rows = csv.reader(fh)
     counter = 0
+    no_parent_yet = []
+    input_finished = False
+
+    def rows_generator():
+        input_row_count = 0
+        no_parent_count = 0
+        for r in _read_vocabulary_rows(vocab, fh):
+            input_row_count += 1
+            yield r
+        input_finished = True
+        while no_parent_yet:
+            no_parent_count += 1
+            yield no_parent_yet.pop(0)
+            if len(no_parent_yet) > input_row_count:
+                raise ValueError("no parent count {} above input count: {}".format(no_parent_count,
+                                                                                   input_row_count))
+
+    for row in rows_generator():
+        term, parent, labels, properties = row
+
+        parent_from_db = VocabularyTerm.get(vocab, parent) if parent else None
+        if parent and not parent_from_db:
+            log.info(_("Postpoining %s term - no %s parent in db yet"), term, parent)
+            no_parent_yet.append(row)
+            continue
+
+        term_from_db = VocabularyTerm.get(vocab, term)
+        if term_from_db:
+            # duplicated term updates labels and properties only, as in bulk loader
+            term_from_db.update(labels=labels, parent=term_from_db.parent, properties=properties)
+        else:
+            VocabularyTerm.create(vocab, term, labels, parent=parent_from_db, properties=properties)
+            if not VocabularyTerm.get(vocab, term):
+                log.error(_("ERROR: TERM NOT CREATED  vocab[%s] term[%s] labels[%s]"), vocab, term, labels)
+        
+        counter += 1
+        if counter % 1000 == 0:
+            # csv.reader doesn't know how much rows it has, so we have to use
+            # input_finished flag which is populated from generator
+            if input_finished:
+                print('Processed {} items, {} to go'.format(counter, len(no_parent_yet)))
+            else:
+                print('Processed {} items'.format(counter))
+
+    PackageTerm.rebuild(vocab)
+    TermUsage.refresh(vocab)
+    VocabularyVersion.bump(vocab)
+    return counter
+
+
+def _read_vocabulary_rows(vocab, fh):
+    """
+    Parse csv data in load_vocabulary() format.
+
+    Yields (term, parent, labels, properties) tuples for each row with term.
+    """
+    rows = csv.reader(fh)
     # first row is a header
     headers = list(rows.next())
 
@@ -526,31 +2044,15 @@ def load_vocabulary(vocabulary_name, fh, **vocab_config):
 
     if term_idx is None:
         raise ValueError(_("Term column not found"))
-    
-    no_parent_yet = []
-    input_finished = False
 
-    def rows_generator():
-        input_row_count = 0
-        no_parent_count = 0
-        for r in rows:
-            input_row_count += 1
-            yield r
-        input_finished = True
-        while no_parent_yet:
-            no_parent_count += 1
-            yield no_parent_yet.pop(0)
-            if len(no_parent_yet) > input_row_count:
-                raise ValueError("no parent count {} above input count: {}".format(no_parent_count,
-                                                                                   input_row_count))
-
-    for row in rows_generator():
+    for row in rows:
         # all data for row
         _data = dict(zip(headers, row))
         # properties are cells for which header starts with 'property:' prefix
         properties = dict( (k[len('property:'):],v,) for k,v in _data.items() if k.startswith('property:') and v)
-        # labels are cells for which header starts with 'lang:'
-        labels = dict( (k[len('lang:'):],v,) for k,v in _data.items() if k.startswith('lang:'))
+        # labels are non-empty cells for which header starts with 'lang:',
+        # empty cell means term has no label in that language
+        labels = dict( (k[len('lang:'):],v,) for k,v in _data.items() if k.startswith('lang:') and v)
 
         term = row[term_idx]
         parent = row[parent_idx] if parent_idx is not None else None
@@ -558,29 +2060,665 @@ def load_vocabulary(vocabulary_name, fh, **vocab_config):
         if not term:
             # print(_("Skipping row with no term: {}").format(_data))
             continue
+        yield term, parent or None, labels, properties
 
-        parent_from_db = VocabularyTerm.get(vocab, parent) if parent else None
-        if parent and not parent_from_db:
-            log.info(_("Postpoining %s term - no %s parent in db yet"), _data['term'], _data['parent'])
-            no_parent_yet.append(row)
-            continue
 
-        term_from_db = VocabularyTerm.get(vocab, term)
-        if term_from_db:
-            term_from_db.update(labels=labels, parent=parent_from_db, properties=properties)
+def _copy_value(value):
+    # format value for COPY .. WITH CSV: unquoted empty value is NULL
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, long,)):
+        return str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '"{}"'.format(str(value).replace('"', '""'))
+
+
+def _check_bulk_support():
+    """
+    Bulk loaders use COPY and id sequences, so they work with PostgreSQL
+    only (as CKAN itself).
+    """
+    if Session.connection().dialect.name != 'postgresql':
+        raise ValueError(_("Bulk vocabulary loading requires PostgreSQL"))
+
+
+def _bulk_insert(table, rows, batch_size=5000):
+    """
+    Insert rows into table with PostgreSQL COPY.
+
+    @param table sqlalchemy Table
+    @param rows list of dictionaries with the same keys
+    """
+    if not rows:
+        return
+    conn = Session.connection()
+    columns = list(rows[0].keys())
+    for chunk in _chunked(rows, batch_size):
+        data = StringIO()
+        for row in chunk:
+            data.write(','.join(_copy_value(row[c]) for c in columns))
+            data.write('\n')
+        data.seek(0)
+        cursor = conn.connection.cursor()
+        cursor.copy_expert('COPY {} ({}) FROM STDIN WITH CSV'.format(table.name, ', '.join(columns)),
+                           data)
+        cursor.close()
+
+
+def _allocate_ids(table, count):
+    """
+    Reserve count values from table's id sequence (PostgreSQL)
+    """
+    if not count:
+        return []
+    q = text("SELECT nextval('{}_id_seq') FROM generate_series(1, :count)".format(table.name))
+    return [row[0] for row in Session.execute(q, {'count': count})]
+
+
+def _bulk_insert_terms(vocab, term_rows, label_rows):
+    """
+    Insert terms with their labels and label search rows. Term rows
+    should have ids allocated already, and parents inserted before.
+
+    @param vocab Vocabulary instance
+    @param term_rows list of term table rows
+    @param label_rows list of label rows (term_id, lang, label) without ids
+    """
+    label_ids = _allocate_ids(VocabularyLabel.__table__, len(label_rows))
+    search_rows = []
+    for label_id, label in zip(label_ids, label_rows):
+        label['id'] = label_id
+        search_rows.append({'label_id': label_id,
+                            'term_id': label['term_id'],
+                            'vocabulary_id': vocab.id,
+                            'lang': label['lang'],
+                            'normalized': normalize_label(label['label'], label['lang'])})
+    _bulk_insert(VocabularyTerm.__table__, term_rows)
+    _bulk_insert(VocabularyLabel.__table__, label_rows)
+    _bulk_insert(VocabularyLabelSearch.__table__, search_rows)
+
+
+class _Progress(object):
+    """
+    Prints rows/sec progress every `every` rows
+    """
+
+    def __init__(self, label, every=10000):
+        self.label = label
+        self.every = every
+        self.count = 0
+        self.started = time.time()
+
+    def rate(self):
+        return self.count / ((time.time() - self.started) or 1)
+
+    def add(self, count=1):
+        before = self.count
+        self.count += count
+        if before // self.every != self.count // self.every:
+            self.report()
+
+    def report(self):
+        print(_('{}: {} rows ({:.0f} rows/s)').format(self.label, self.count, self.rate()))
+
+
+def _sort_terms(terms):
+    """
+    Order terms so each parent is placed before its children.
+
+    @param terms dict of term name -> (parent name, ...)
+    @rtype list of (term name, depth, path) tuples
+    """
+    children = {}
+    roots = []
+    for name, data in terms.iteritems():
+        parent = data[0]
+        if parent:
+            children.setdefault(parent, []).append(name)
         else:
-            VocabularyTerm.create(vocab, term, labels, parent=parent_from_db, properties=properties)
-            if not VocabularyTerm.get(vocab, term):
-                log.error(_("ERROR: TERM NOT CREATED  vocab[%s] term[%s] data[%s]"), vocab, term, _data)
-        
-        counter += 1
-        if counter % 1000 == 0:
-            # csv.reader doesn't know how much rows it has, so we have to use
-            # input_finished flag which is populated from generator
-            if input_finished:
-                print('Processed {} items, {} to go'.format(counter, len(no_parent_yet)))
+            roots.append(name)
+
+    out = []
+    queue = deque((name, 0, name,) for name in roots)
+    while queue:
+        name, depth, path = queue.popleft()
+        out.append((name, depth, path,))
+        for child in children.get(name, []):
+            queue.append((child, depth + 1, '{}/{}'.format(path, child),))
+
+    if len(out) < len(terms):
+        resolved = set(name for name, depth, path in out)
+        unresolved = sorted(name for name in terms if name not in resolved)
+        raise ValueError(_("{} terms have missing parent or are in a cycle: {}")
+                          .format(len(unresolved), ', '.join(unresolved[:20])))
+    return out
+
+
+def bulk_load_vocabulary(vocabulary_name, fh, **vocab_config):
+    """
+    Load Vocabulary terms and lang values with set-based inserts.
+
+    Works like load_vocabulary(), with the same input format, but rows
+    are parsed into memory first, parents are resolved with one pass over
+    terms and then terms and labels are written with bulk inserts (COPY).
+    This should be used for large vocabularies, like AGROVOC. Requires
+    PostgreSQL.
+
+    Each term should have its parent present in input data.
+
+    @param vocabulary_name Vocabulary instance or name of vocabulary
+    @param file-like object with terms data
+
+    @rtype int number of terms loaded
+    """
+    _check_bulk_support()
+    try:
+        vocab = Vocabulary.get(vocabulary_name)
+        vocab.clear()
+    except ValueError:
+        vocab = Vocabulary.create(vocabulary_name, **vocab_config)
+
+    print(_("Using {}").format(vocab))
+
+    # term name -> (parent name, labels, properties)
+    terms = OrderedDict()
+    progress = _Progress(_('Read'))
+    for term, parent, labels, properties in _read_vocabulary_rows(vocab, fh):
+        if term in terms:
+            # duplicated term updates labels and properties only
+            parent = terms[term][0]
+        terms[term] = (parent, labels, properties,)
+        progress.add()
+    progress.report()
+
+    ordered = _sort_terms(terms)
+    ids = dict(zip([name for name, depth, path in ordered],
+                   _allocate_ids(VocabularyTerm.__table__, len(ordered))))
+
+    progress = _Progress(_('Terms written'))
+    for chunk in _chunked(ordered, 5000):
+        term_rows = []
+        label_rows = []
+        for name, depth, path in chunk:
+            parent, labels, properties = terms[name]
+            term_rows.append({'id': ids[name],
+                              'vocabulary_id': vocab.id,
+                              'parent_id': ids[parent] if parent else None,
+                              'name': name,
+                              'depth': depth,
+                              'path': path,
+                              '_properties': json.dumps(properties or {})})
+            for lang, label in labels.iteritems():
+                label_rows.append({'term_id': ids[name],
+                                   'lang': lang,
+                                   'label': label})
+        _bulk_insert_terms(vocab, term_rows, label_rows)
+        progress.add(len(chunk))
+    progress.report()
+
+    VocabularyTermClosure.rebuild(vocab)
+    PackageTerm.rebuild(vocab)
+    TermUsage.refresh(vocab)
+    VocabularyVersion.bump(vocab)
+    return len(ordered)
+
+
+def _decode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+def sync_vocabulary(vocabulary_name, fh, **vocab_config):
+    """
+    Synchronize Vocabulary terms and lang values with input data.
+
+    Input has the same format as for load_vocabulary(). Instead of
+    clearing vocabulary, a diff between input and stored terms, labels,
+    parents and properties is computed, and only changes are applied.
+    Existing terms keep their ids, and vocabulary is never empty for
+    other db sessions, as all changes are made in current transaction.
+
+    Each term should have its parent present in input data.
+
+    @param vocabulary_name Vocabulary instance or name of vocabulary
+    @param file-like object with terms data
+
+    @rtype int number of terms in vocabulary
+    """
+    _check_bulk_support()
+    try:
+        vocab = Vocabulary.get(vocabulary_name)
+    except ValueError:
+        vocab = Vocabulary.create(vocabulary_name, **vocab_config)
+
+    print(_("Using {}").format(vocab))
+
+    # term name -> (parent name, labels, properties)
+    terms = OrderedDict()
+    progress = _Progress(_('Read'))
+    for term, parent, labels, properties in _read_vocabulary_rows(vocab, fh):
+        term = _decode(term)
+        if term in terms:
+            parent = terms[term][0]
+        labels = dict((lang, _decode(label),) for lang, label in labels.iteritems())
+        properties = dict((k, _decode(v),) for k, v in properties.iteritems())
+        terms[term] = (_decode(parent), labels, properties,)
+        progress.add()
+    progress.report()
+    return _sync_terms(vocab, terms)
+
+
+def _sync_terms(vocab, terms):
+    """
+    Apply differences between terms and stored vocabulary, see
+    sync_vocabulary()
+
+    @param vocab Vocabulary instance
+    @param terms OrderedDict of term name -> (parent name, labels dict, properties)
+    @rtype int number of terms in vocabulary
+    """
+    ordered = _sort_terms(terms)
+
+    # current state
+    stored = {}
+    q = Session.query(VocabularyTerm.id, VocabularyTerm.name, VocabularyTerm.parent_id,
+                      VocabularyTerm.depth, VocabularyTerm.path, VocabularyTerm._properties)\
+               .filter(VocabularyTerm.vocabulary_id==vocab.id)
+    for term_id, name, parent_id, depth, path, props in q:
+        stored[name] = {'id': term_id,
+                        'parent_id': parent_id,
+                        'depth': depth,
+                        'path': path,
+                        'properties': json.loads(props or '{}')}
+    stored_labels = {}
+    q = Session.query(VocabularyLabel.id, VocabularyLabel.term_id,
+                      VocabularyLabel.lang, VocabularyLabel.label)\
+               .join(VocabularyTerm, VocabularyTerm.id==VocabularyLabel.term_id)\
+               .filter(VocabularyTerm.vocabulary_id==vocab.id)
+    for label_id, term_id, lang, label in q:
+        stored_labels.setdefault(term_id, {})[lang] = (label_id, label,)
+
+    # diff
+    added = [name for name, depth, path in ordered if name not in stored]
+    removed = [name for name in stored if name not in terms]
+    ids = dict((name, data['id'],) for name, data in stored.iteritems())
+    ids.update(zip(added, _allocate_ids(VocabularyTerm.__table__, len(added))))
+
+    parent_changed = False
+    new_terms = []
+    changed_terms = []
+    new_labels = []
+    changed_labels = []
+    removed_labels = []
+    for name, depth, path in ordered:
+        parent, labels, properties = terms[name]
+        values = {'parent_id': ids[parent] if parent else None,
+                  'depth': depth,
+                  'path': path}
+        term_id = ids[name]
+        current = stored.get(name)
+        if current is None:
+            values.update({'id': term_id,
+                           'vocabulary_id': vocab.id,
+                           'name': name,
+                           '_properties': json.dumps(properties)})
+            new_terms.append(values)
+        elif any(current[k] != v for k, v in values.items()) or current['properties'] != properties:
+            parent_changed = parent_changed or current['parent_id'] != values['parent_id']
+            values.update({'_id': term_id,
+                           '_properties': json.dumps(properties)})
+            changed_terms.append(values)
+
+        current_labels = stored_labels.get(term_id, {})
+        for lang, label in labels.iteritems():
+            if lang not in current_labels:
+                new_labels.append({'term_id': term_id, 'lang': lang, 'label': label})
+            elif current_labels[lang][1] != label:
+                changed_labels.append({'_id': current_labels[lang][0], '_lang': lang, 'label': label})
+        removed_labels.extend(label_id for lang, (label_id, label,) in current_labels.iteritems()
+                              if lang not in labels)
+
+    removed_ids = [ids[name] for name in removed]
+    for term_id in removed_ids:
+        removed_labels.extend(label_id for label_id, label in stored_labels.get(term_id, {}).values())
+
+    structure_changed = bool(added or removed or parent_changed)
+
+    # apply
+    if structure_changed:
+        TermUsage.clear(vocab)
+        PackageTerm.clear(vocab)
+        VocabularyTermClosure.clear(vocab)
+    terms_table = VocabularyTerm.__table__
+    labels_table = VocabularyLabel.__table__
+
+    search_table = VocabularyLabelSearch.__table__
+    label_ids = _allocate_ids(labels_table, len(new_labels))
+    for label_id, label in zip(label_ids, new_labels):
+        label['id'] = label_id
+    label_terms = dict((label_id, term_id,) for term_id, term_labels in stored_labels.iteritems()
+                       for label_id, label in term_labels.values())
+    search_rows = [{'label_id': label['id'],
+                    'term_id': label['term_id'],
+                    'vocabulary_id': vocab.id,
+                    'lang': label['lang'],
+                    'normalized': normalize_label(label['label'], label['lang'])}
+                   for label in new_labels]
+    for label in changed_labels:
+        search_rows.append({'label_id': label['_id'],
+                            'term_id': label_terms[label['_id']],
+                            'vocabulary_id': vocab.id,
+                            'lang': label['_lang'],
+                            'normalized': normalize_label(label['label'], label['_lang'])})
+
+    stale_search = removed_labels + [label['_id'] for label in changed_labels]
+    for chunk in _chunked(stale_search):
+        Session.execute(search_table.delete().where(search_table.c.label_id.in_(chunk)))
+    for chunk in _chunked(removed_labels):
+        Session.execute(labels_table.delete().where(labels_table.c.id.in_(chunk)))
+    for chunk in _chunked(new_terms, 5000):
+        _bulk_insert(terms_table, chunk)
+    # SET clause is generated from keys of parameters
+    if changed_terms:
+        Session.execute(terms_table.update().where(terms_table.c.id==bindparam('_id')),
+                        changed_terms)
+    # removed terms may be parents of other removed terms
+    for chunk in _chunked(removed_ids):
+        Session.execute(terms_table.update().where(terms_table.c.id.in_(chunk))
+                                            .values(parent_id=None))
+    for chunk in _chunked(removed_ids):
+        Session.execute(terms_table.delete().where(terms_table.c.id.in_(chunk)))
+    for chunk in _chunked(new_labels, 5000):
+        _bulk_insert(labels_table, chunk)
+    if changed_labels:
+        Session.execute(labels_table.update().where(labels_table.c.id==bindparam('_id')),
+                        changed_labels)
+    for chunk in _chunked(search_rows, 5000):
+        _bulk_insert(search_table, chunk)
+    if structure_changed:
+        VocabularyTermClosure.rebuild(vocab)
+        PackageTerm.rebuild(vocab)
+        TermUsage.refresh(vocab)
+    Session.flush()
+
+    print(_('Terms: {} added, {} changed, {} removed').format(len(new_terms),
+                                                             len(changed_terms),
+                                                             len(removed_ids)))
+    print(_('Labels: {} added, {} changed, {} removed').format(len(new_labels),
+                                                              len(changed_labels),
+                                                              len(removed_labels)))
+    if new_terms or changed_terms or removed_ids or new_labels or changed_labels or removed_labels:
+        VocabularyVersion.bump(vocab)
+    return len(ordered)
+
+
+# vocabulary snapshot file: magic, format version (unsigned short),
+# sha256 digest of payload, zlib-compressed payload. Payload is a sequence
+# of json lines: vocabulary header ({"vocabulary": name, ...}) followed by
+# its terms ([name, parent name, labels, properties]). Terms are ordered
+# by depth, so parent is always before its children. Labels are list of
+# [lang, label] pairs (dict of lang -> label in version 1).
+SNAPSHOT_MAGIC = 'FAOCIOKV'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('>8sH32s')
+SNAPSHOT_CHUNK_SIZE = 64 * 1024
+
+
+def write_snapshot(fh, vocabulary_names=None):
+    """
+    Write vocabularies to snapshot file. Payload is compressed as it's
+    written, and header with checksum is written at the end, so fh must
+    be seekable.
+
+    @param fh binary file-like object to write to
+    @param vocabulary_names list of vocabularies to export (default all)
+    @rtype dict of vocabulary name -> number of terms exported
+    """
+    if vocabulary_names:
+        vocabularies = [Vocabulary.get(name) for name in vocabulary_names]
+    else:
+        vocabularies = Vocabulary.get_all()
+
+    start = fh.tell()
+    fh.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, '\0' * 32))
+    compressor = zlib.compressobj(9)
+    checksum = hashlib.sha256()
+
+    def write(data):
+        checksum.update(data)
+        fh.write(data)
+
+    out = {}
+    for vocab in vocabularies:
+        parent = orm.aliased(VocabularyTerm)
+        terms = Session.query(VocabularyTerm.id, VocabularyTerm.name,
+                              parent.name, VocabularyTerm._properties)\
+                       .outerjoin(parent, parent.id==VocabularyTerm.parent_id)\
+                       .filter(VocabularyTerm.vocabulary_id==vocab.id)\
+                       .order_by(VocabularyTerm.depth, VocabularyTerm.name)\
+                       .all()
+        labels = {}
+        langs = set()
+        q = Session.query(VocabularyLabel.term_id, VocabularyLabel.lang, VocabularyLabel.label)\
+                   .join(VocabularyTerm, VocabularyTerm.id==VocabularyLabel.term_id)\
+                   .filter(VocabularyTerm.vocabulary_id==vocab.id)\
+                   .order_by(VocabularyLabel.id)
+        for term_id, lang, label in q:
+            labels.setdefault(term_id, []).append([lang, label])
+            langs.add(lang)
+        rows = []
+        properties = set()
+        for term_id, name, parent_name, term_properties in terms:
+            term_properties = json.loads(term_properties or '{}')
+            properties.update(term_properties.keys())
+            rows.append([name, parent_name, labels.get(term_id, []), term_properties])
+
+        header = {'vocabulary': vocab.name,
+                  'has_relations': vocab.has_relations,
+                  'langs': sorted(langs),
+                  'properties': sorted(properties),
+                  'terms': len(rows)}
+        for item in chain([header], rows):
+            write(compressor.compress(json.dumps(item, separators=(',', ':')) + '\n'))
+        out[vocab.name] = len(rows)
+    write(compressor.flush())
+    end = fh.tell()
+    fh.seek(start)
+    fh.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, checksum.digest()))
+    fh.seek(end)
+    return out
+
+
+def _snapshot_item(line, version):
+    item = json.loads(line)
+    if isinstance(item, dict):
+        return item
+    name, parent, labels, properties = item
+    if version < 2:
+        labels = sorted(labels.items())
+    return name, parent, [tuple(label) for label in labels], properties
+
+
+def read_snapshot(fh):
+    """
+    Read vocabularies from snapshot file. Payload is read and decompressed
+    in chunks, and checksum is verified when all payload was read, so
+    ValueError can be raised after some items were returned. Data loaded
+    from snapshot should be committed only after all items were read.
+
+    @param fh binary file-like object with snapshot
+    @rtype generator of snapshot items: vocabulary header dicts, each
+           followed by its terms as (name, parent name, labels, properties)
+           tuples, where labels is a list of (lang, label) pairs
+    """
+    data = fh.read(SNAPSHOT_HEADER.size)
+    if len(data) < SNAPSHOT_HEADER.size:
+        raise ValueError(_("Not a vocabulary snapshot"))
+    magic, version, digest = SNAPSHOT_HEADER.unpack(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(_("Not a vocabulary snapshot"))
+    if version > SNAPSHOT_VERSION:
+        raise ValueError(_("Unsupported vocabulary snapshot version {}").format(version))
+
+    checksum = hashlib.sha256()
+    decompressor = zlib.decompressobj()
+    pending = ''
+    try:
+        chunk = fh.read(SNAPSHOT_CHUNK_SIZE)
+        while chunk:
+            checksum.update(chunk)
+            lines = (pending + decompressor.decompress(chunk)).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield _snapshot_item(line, version)
+            chunk = fh.read(SNAPSHOT_CHUNK_SIZE)
+        pending += decompressor.flush()
+    except zlib.error, err:
+        raise ValueError(_("Vocabulary snapshot is corrupted: {}").format(err))
+    if checksum.digest() != digest or decompressor.unused_data:
+        raise ValueError(_("Vocabulary snapshot checksum mismatch"))
+    if pending:
+        yield _snapshot_item(pending, version)
+
+
+def _group_snapshot(items):
+    """
+    Group snapshot items into (vocabulary header, terms iterator) pairs.
+    Terms iterator is valid until next pair is taken.
+    """
+    headers = [0]
+
+    def key(item):
+        if isinstance(item, dict):
+            headers[0] += 1
+        return headers[0]
+
+    for idx, group in groupby(items, key):
+        header = next(group)
+        if not isinstance(header, dict):
+            raise ValueError(_("Vocabulary snapshot has terms without vocabulary"))
+        yield header, group
+
+
+def _bulk_load_snapshot_terms(vocab, terms):
+    """
+    Replace vocabulary terms with snapshot terms, written with bulk
+    inserts in chunks, as they're read. Only id, depth and path of written
+    terms are kept in memory, to resolve parents of next terms.
+
+    @param vocab Vocabulary instance
+    @param terms iterable of snapshot terms
+    @rtype int number of terms loaded
+    """
+    vocab.clear()
+    print(_("Using {}").format(vocab))
+
+    # term name -> (id, depth, path)
+    written = {}
+    progress = _Progress(_('Terms written'))
+    for chunk in _chunked(terms, 5000):
+        term_rows = []
+        label_rows = []
+        ids = _allocate_ids(VocabularyTerm.__table__, len(chunk))
+        for term_id, (name, parent, labels, properties) in zip(ids, chunk):
+            if parent:
+                try:
+                    parent_id, depth, path = written[parent]
+                except KeyError:
+                    raise ValueError(_("Parent {} of term {} not found in vocabulary snapshot")
+                                     .format(parent, name))
+                depth, path = depth + 1, u'{}/{}'.format(path, name)
             else:
-                print('Processed {} items'.format(counter))
+                parent_id, depth, path = None, 0, name
+            written[name] = (term_id, depth, path,)
+            term_rows.append({'id': term_id,
+                              'vocabulary_id': vocab.id,
+                              'parent_id': parent_id,
+                              'name': name,
+                              'depth': depth,
+                              'path': path,
+                              '_properties': json.dumps(properties or {})})
+            for lang, label in labels:
+                label_rows.append({'term_id': term_id,
+                                   'lang': lang,
+                                   'label': label})
+        _bulk_insert_terms(vocab, term_rows, label_rows)
+        progress.add(len(chunk))
+    progress.report()
+
+    VocabularyTermClosure.rebuild(vocab)
+    PackageTerm.rebuild(vocab)
+    TermUsage.refresh(vocab)
+    VocabularyVersion.bump(vocab)
+    return len(written)
+
+
+def _sync_snapshot_terms(vocab, terms):
+    """
+    Apply differences between snapshot terms and vocabulary, see
+    sync_vocabulary(). Synchronization supports one label per language.
 
+    @param vocab Vocabulary instance
+    @param terms iterable of snapshot terms
+    @rtype int number of terms in vocabulary
+    """
+    print(_("Using {}").format(vocab))
+    data = OrderedDict()
+    for name, parent, labels, properties in terms:
+        term_labels = dict(labels)
+        if len(term_labels) < len(labels):
+            raise ValueError(_("Term {} has multiple labels in one language, "
+                               "vocabulary {} can't be synchronized").format(name, vocab.name))
+        data[name] = (parent, term_labels, properties,)
+    return _sync_terms(vocab, data)
 
-    return counter
+
+def load_snapshot(fh, vocabulary_names=None, sync=False):
+    """
+    Load vocabularies from snapshot file. Terms are written with bulk
+    inserts as they're read from snapshot, or with sync, only differences
+    are applied.
+
+    Snapshot checksum is verified after all vocabularies were loaded, so
+    on ValueError current transaction should be rolled back.
+
+    @param fh binary file-like object with snapshot
+    @param vocabulary_names list of vocabularies to load (default all in snapshot)
+    @param sync apply differences only (see sync_vocabulary())
+    @rtype dict of vocabulary name -> number of terms loaded
+    """
+    _check_bulk_support()
+    loader = _sync_snapshot_terms if sync else _bulk_load_snapshot_terms
+    out = {}
+    for header, terms in _group_snapshot(read_snapshot(fh)):
+        name = header['vocabulary']
+        if vocabulary_names and name not in vocabulary_names:
+            continue
+        try:
+            vocab = Vocabulary.get(name)
+        except ValueError:
+            vocab = Vocabulary.create(name, has_relations=header['has_relations'])
+        counted = [0]
+
+        def count(terms):
+            for term in terms:
+                counted[0] += 1
+                yield term
+
+        out[name] = loader(vocab, count(terms))
+        if counted[0] != header['terms']:
+            raise ValueError(_("Vocabulary snapshot for {} is incomplete").format(name))
+    return out
+
+
+def update_package_terms(package_id):
+    """
+    Update terms used by package and term usage counts
+    """
+    package = Package.get(package_id)
+    if package:
+        PackageTerm.update_package(package.id)
@@ -4,8 +4,12 @@ from __future__ import print_function
 import logging
 import collections
 import json
+import re
+import threading
+from contextlib import contextmanager
 
 from ckan import plugins
+from ckan.model import Session
 from ckan.lib.i18n import get_lang
 from ckan.lib.base import config
 from ckan.plugins import toolkit as t
@@ -13,7 +17,10 @@ from ckanext.faociok import schema as s
 from ckanext.faociok import helpers as h
 from ckanext.faociok import validators as v
 from ckanext.faociok import actions as a
-from ckanext.faociok.models import VocabularyTerm, Vocabulary
+from ckanext.faociok.cache import (widget_cache, NAMESPACE_FEATURED_LOCATIONS,
+                                   NAMESPACE_GROUPS)
+from ckanext.faociok.models import (VocabularyTerm, Vocabulary, get_term_labels,
+                                    update_package_terms)
 from ckan.lib.plugins import DefaultTranslation
 
 log = logging.getLogger(__name__)
@@ -31,11 +38,38 @@ CONFIG_TRIM_FOR_INDEX = 'ckanext.faociok.trim_for_index'
 
 # get config val once
 TRIM_FOR_INDEX = t.asbool(config.get(CONFIG_TRIM_FOR_INDEX, 'true'))
-TRIM_LIMIT = 32 * 1024
+# max size of indexed term in solr, in bytes of utf-8 encoded value
+TRIM_LIMIT = 32766
 
 # lists of known text type fields - those should not be trimmed, as they are expected to be long
-TRIM_SKIP_FOR_FIELDS = "author author_email child_of dependency_of depends_on derives_from has_derivation linked_from links_to maintainer maintainer_email notes res_description res_name text title urls ckan_url download_url groups license maintainer name notes organization url data_dict validated_data_dict".split(' ')
+TRIM_SKIP_FOR_FIELDS = frozenset("author author_email child_of dependency_of depends_on derives_from has_derivation linked_from links_to maintainer maintainer_email notes res_description res_name text title urls ckan_url download_url groups license maintainer name notes organization url data_dict validated_data_dict".split(' '))
 TRIM_SKIP_FOR_FIELDS_WILDCHAR = 'extras_ res_extras_ vocab_'.split(' ')
+TRIM_SKIP_PREFIXES = re.compile('^(?:{})'.format('|'.join(re.escape(p) for p in TRIM_SKIP_FOR_FIELDS_WILDCHAR)))
+
+
+def _should_trim(field_name):
+    return field_name not in TRIM_SKIP_FOR_FIELDS and not TRIM_SKIP_PREFIXES.match(field_name)
+
+
+def _is_oversized(value):
+    if not isinstance(value, basestring):
+        return False
+    # utf-8 uses at most 4 bytes per character, so short values
+    # don't need to be encoded
+    if isinstance(value, unicode):
+        if len(value) * 4 <= TRIM_LIMIT:
+            return False
+        return len(value.encode('utf-8')) > TRIM_LIMIT
+    return len(value) > TRIM_LIMIT
+
+
+def _trim_value(value):
+    """
+    Cut value to TRIM_LIMIT bytes, without leaving partial utf-8 sequence
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')[:TRIM_LIMIT].decode('utf-8', 'ignore')
+    return value[:TRIM_LIMIT].decode('utf-8', 'ignore').encode('utf-8')
 
 class FaociokPlugin(plugins.SingletonPlugin, t.DefaultDatasetForm, DefaultTranslation):
     plugins.implements(plugins.IRoutes, inherit=True)
@@ -78,30 +112,16 @@ class FaociokPlugin(plugins.SingletonPlugin, t.DefaultDatasetForm, DefaultTransl
     def create_package_schema(self):
         schema = super(FaociokPlugin, self).create_package_schema()
         schema.update(s.get_create_package_schema())
-        self._update_schema(schema, 'convert_to_extras', before=False)
         return schema
 
     def update_package_schema(self):
         schema = super(FaociokPlugin, self).update_package_schema()
         schema.update(s.get_update_package_schema())
-        self._update_schema(schema, 'convert_to_extras', before=False)
         return schema
 
     def show_package_schema(self):
         schema = super(FaociokPlugin, self).show_package_schema()
         schema.update(s.get_show_package_schema())
-        self._update_schema(schema, 'convert_from_extras', before=True)
-        return schema
-
-    def _update_schema(self, schema, converter, before=False):
-        for k in schema.keys():
-            if k.startswith('fao_'):
-                field = schema[k]
-                if before:
-                    schema[k] = [t.get_converter(converter)] + field
-                else:
-                    schema[k] = field + [t.get_converter(converter)]
-
         return schema
 
     # IValidators
@@ -154,46 +174,75 @@ class FaociokPlugin(plugins.SingletonPlugin, t.DefaultDatasetForm, DefaultTransl
 
     # IPackageController
 
-    def get_localized_regions(self, regions):
+    # labels preloaded for bulk indexing, see preloaded_index_labels()
+    _index_labels = threading.local()
+
+    @contextmanager
+    def preloaded_index_labels(self, labels):
+        """
+        Use preloaded term labels in before_index() within context.
+
+        @param labels dictionary of vocabulary name -> get_term_labels() result
+                      for all terms used by indexed packages. If package uses
+                      term not present in labels, it will be fetched from db.
+        """
+        self._index_labels.labels = labels
+        try:
+            yield
+        finally:
+            self._index_labels.labels = None
+
+    def _get_index_labels(self, vocabulary_name, names, with_parents=False):
+        preloaded = (getattr(self._index_labels, 'labels', None) or {}).get(vocabulary_name)
+        if preloaded is not None and all(name in preloaded for name in names):
+            return preloaded
+        return get_term_labels(vocabulary_name, names, with_parents=with_parents)
+
+    def get_localized_regions(self, regions, labels=None):
+        """
+        Returns localized labels for regions and their parent regions,
+        grouped by region level.
+
+        @param regions list of m49 region names
+        @param labels optional, preloaded result of get_term_labels() for m49
+        """
+        if labels is None:
+            labels = self._get_index_labels(Vocabulary.VOCABULARY_M49_REGIONS, regions, with_parents=True)
         out = {'fao_m49_regions': regions}
         for reg in regions:
-            v = VocabularyTerm.get(Vocabulary.VOCABULARY_M49_REGIONS, reg)
-            parent = v
-            while parent:
-                for label in parent.labels:
-                    lname = 'fao_m49_regions_l{}_{}'.format(parent.depth, label.lang)
-                    try:
-                        out[lname].add(label.label)
-                    except KeyError:
-                        out[lname] = set([label.label])
-                parent = parent.parent
+            for depth, lang, label in labels.get(reg, []):
+                lname = 'fao_m49_regions_l{}_{}'.format(depth, lang)
+                try:
+                    out[lname].add(label)
+                except KeyError:
+                    out[lname] = set([label])
         for k,v in out.items():
             if isinstance(v, set):
                 out[k] = list(v)
         return out
 
-    def get_localized_datatype(self, datatype):
+    def get_localized_datatype(self, datatype, labels=None):
+        if labels is None:
+            labels = self._get_index_labels(Vocabulary.VOCABULARY_DATATYPE, [datatype])
         out = {'fao_datatype': datatype}
-        v = VocabularyTerm.get(Vocabulary.VOCABULARY_DATATYPE, datatype)
-        for l in v.labels:
-            lname = 'fao_datatype_{}'.format(l.lang)
-            out[lname] = l.label
+        for depth, lang, label in labels.get(datatype, []):
+            lname = 'fao_datatype_{}'.format(lang)
+            out[lname] = label
         return out
 
-    def get_localized_agrovoc(self, terms):
+    def get_localized_agrovoc(self, terms, labels=None):
         if not isinstance(terms, list):
             terms = v._deserialize_from_array(terms)
+        if labels is None:
+            labels = self._get_index_labels(Vocabulary.VOCABULARY_AGROVOC, terms)
         out = {'fao_agrovoc': terms}
         for term in terms:
-            term = VocabularyTerm.get(Vocabulary.VOCABULARY_AGROVOC, term)
-            if not term:
-                continue
-            for label in term.labels:
-                lname = 'fao_agrovoc_{}'.format(label.lang)
+            for depth, lang, label in labels.get(term, []):
+                lname = 'fao_agrovoc_{}'.format(lang)
                 try:
-                    out[lname].add(label.label)
+                    out[lname].add(label)
                 except KeyError:
-                    out[lname] = set([label.label])
+                    out[lname] = set([label])
 
         for k,val in out.items():
             if isinstance(val, set):
@@ -218,27 +267,39 @@ class FaociokPlugin(plugins.SingletonPlugin, t.DefaultDatasetForm, DefaultTransl
 
         # optional trim values to 32k field size limit
         if TRIM_FOR_INDEX:
-            for k, val in pkg_dict.iteritems():
-                # skip known text fields
-                if k in TRIM_SKIP_FOR_FIELDS:
-                    continue
-                for fname in TRIM_SKIP_FOR_FIELDS_WILDCHAR:
-                    if k.startswith(fname):
-                        continue
+            for k, val in pkg_dict.items():
                 if isinstance(val, basestring):
-                    if len(val) > TRIM_LIMIT:
+                    if _is_oversized(val) and _should_trim(k):
                         log.debug('triming %s to 32k: %s', k, val)
-                    pkg_dict[k] = val[:TRIM_LIMIT] if val else val
+                        pkg_dict[k] = _trim_value(val)
                 elif isinstance(val, (list, set, tuple,)):
-                    if any([len(item) > TRIM_LIMIT for item in val if isinstance(item, basestring)]):
+                    if any(_is_oversized(item) for item in val) and _should_trim(k):
                         log.debug('triming %s to 32k: %s', k, val)
-                    pkg_dict[k] = [item[:TRIM_LIMIT] if isinstance(item, basestring) else item for item in val]
+                        pkg_dict[k] = [_trim_value(item) if _is_oversized(item) else item
+                                       for item in val]
 
         return pkg_dict
 
+    # keep package terms and term usage counts in sync with datasets
+    def after_create(self, context, pkg_dict):
+        self._dataset_changed(pkg_dict['id'])
+
+    def after_update(self, context, pkg_dict):
+        self._dataset_changed(pkg_dict['id'])
+
+    def after_delete(self, context, pkg_dict):
+        self._dataset_changed(pkg_dict['id'])
+
+    def _dataset_changed(self, package_id):
+        update_package_terms(package_id)
+        session = Session()
+        widget_cache.invalidate_after_commit(session, NAMESPACE_FEATURED_LOCATIONS)
+        widget_cache.invalidate_after_commit(session, NAMESPACE_GROUPS)
+
     # IActions
     def get_actions(self):
-        return {'fao_autocomplete': a.fao_autocomplete}
+        return {'fao_autocomplete': a.fao_autocomplete,
+                'fao_harvest_job_import_stats': a.fao_harvest_job_import_stats}
 
     # IRoutes
     def before_map(self, map):
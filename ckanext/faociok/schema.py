@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import copy
 
 from ckan.common import _, ungettext
 import ckan.plugins.toolkit as t
@@ -8,22 +9,28 @@ from ckan.plugins import PluginImplementations
 from ckanext.faociok.models import Vocabulary, VocabularyTerm, VocabularyLabel
 
 
-def _get_package_schema():
-    # name - field name
-    # validators - list of validator instances
-    # element - type of html element (may be arbitrary)
-    # label - localized field label
-    # vocabulary_name - name of vocabulary in faociok.Vocabulary
-    # description - field description
-    # additional_module - additional ckan js module to add to element
-    # autocomplete - use autocomplete module (nam
-    return [
+def N_(value):
+    # marks string for translation, it's translated when schema is used
+    return value
+
+
+# static parts of schema, built once per process (validators can be
+# resolved only after plugins are loaded). See _get_package_schema().
+_FIELDS = None
+# fao fields validators with converters, by (converter, before) key
+_VALIDATORS = {}
+
+
+def _get_fields():
+    global _FIELDS
+    if _FIELDS is None:
+        _FIELDS = [
         {'name': 'fao_datatype',
          'validators': [t.get_validator('fao_datatype')],
          'element': 'select',
-         'label': _("Data type"),
+         'label': N_("Data type"),
          'vocabulary_name': Vocabulary.VOCABULARY_DATATYPE,
-         'description': _("Select data type of dataset"),
+         'description': N_("Select data type of dataset"),
          'multiple': False,
          'additional_module': None,
          'vocabulary_filters': {},
@@ -34,33 +41,72 @@ def _get_package_schema():
           'element': 'select',
           'multiple': True,
           'autocomplete': 'autocomplete',
-          'label': _("M49 Regions"),
+          'label': N_("M49 Regions"),
           'additional_module': 'autocomplete m49_regions',
           'vocabulary_remote': False,
           'vocabulary_name': Vocabulary.VOCABULARY_M49_REGIONS,
           'vocabulary_filters': [VocabularyTerm.depth == 1],
           'vocabulary_order_by': [VocabularyLabel.label],
-          'description': _("Regions according to UN M.49 Standard"),
+          'description': N_("Regions according to UN M.49 Standard"),
           'is_required': False},
          {'name': 'fao_agrovoc',
           'validators': [t.get_validator('fao_agrovoc')],
           'element': 'agrovoc',
           'multiple': True,
-          'label': _("AGROVOC terms"),
+          'label': N_("AGROVOC terms"),
           'additional_module': 'fao-autocomplete',
-          'vocabulary_url': t.url_for('fao_autocomplete', _vocabulary='agrovoc'),
+          # route name and args, resolved to vocabulary_url for each request
+          'vocabulary_route': ('fao_autocomplete', {'_vocabulary': 'agrovoc'},),
           'vocabulary_name': Vocabulary.VOCABULARY_AGROVOC,
           'vocabulary_filters': {},
           'vocabulary_order_by': None,
-          'description': _("AGROVOC terms"),
+          'description': N_("AGROVOC terms"),
           'is_required': False},
-    ]
+        ]
+    return _FIELDS
+
+
+def _get_package_schema():
+    # name - field name
+    # validators - list of validator instances
+    # element - type of html element (may be arbitrary)
+    # label - localized field label
+    # vocabulary_name - name of vocabulary in faociok.Vocabulary
+    # description - field description
+    # additional_module - additional ckan js module to add to element
+    # autocomplete - use autocomplete module (nam
+    out = []
+    for field in _get_fields():
+        # copy lists and dicts too, so callers can't change cached fields
+        field = dict((k, copy.copy(v),) for k, v in field.items())
+        field['label'] = _(field['label'])
+        field['description'] = _(field['description'])
+        route = field.pop('vocabulary_route', None)
+        if route:
+            field['vocabulary_url'] = t.url_for(route[0], **route[1])
+        out.append(field)
+    return out
+
+
+def _get_validators_schema(converter, before=False):
+    key = (converter, before,)
+    if key not in _VALIDATORS:
+        conv = t.get_converter(converter)
+        schema = {}
+        for field in _get_fields():
+            if before:
+                schema[field['name']] = [conv] + field['validators']
+            else:
+                schema[field['name']] = field['validators'] + [conv]
+        _VALIDATORS[key] = schema
+    # schemas may be modified by callers
+    return dict((k, list(v),) for k, v in _VALIDATORS[key].items())
 
 def get_create_package_schema():
-    return dict( (i['name'], i['validators'],) for i in _get_package_schema())
+    return _get_validators_schema('convert_to_extras')
 
 def get_update_package_schema():
-    return dict( (i['name'], i['validators'],) for i in _get_package_schema())
+    return _get_validators_schema('convert_to_extras')
 
 def get_show_package_schema():
-    return dict( (i['name'], i['validators'],) for i in _get_package_schema())
+    return _get_validators_schema('convert_from_extras', before=True)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Read-only, memory-mapped vocabulary store.
+
+Store file contains all vocabulary terms and labels in flat int32 arrays
+and one utf-8 string table, so it can be mmap-ed by each CKAN process,
+and memory is shared between processes through page cache. Values are
+read directly from mapped file, nothing is unpacked on load.
+
+File layout:
+ * header: magic, format version, length of json metadata
+ * json metadata: generations of vocabularies, number of terms and
+   strings, term index ranges of vocabularies, languages, section offsets
+ * int32 sections:
+   * string offsets in string table (strings + 1)
+   * term id, name, parent (term index, -1 for top-level), depth and path
+     (terms are sorted by vocabulary and utf-8 encoded name)
+   * term indexes sorted by term id
+   * label string for each lang (-1 if term has no label in lang)
+ * string table
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+
+MAGIC = 'FAOCSTOR'
+VERSION = 1
+HEADER = struct.Struct('<8sHI')
+INT = struct.Struct('<i')
+INT_PAIR = struct.Struct('<2i')
+
+TERM_SECTIONS = ('term_id', 'term_name', 'term_parent', 'term_depth', 'term_path', 'id_order',)
+
+
+def _int_array(values):
+    out = array('i', values)
+    if sys.byteorder != 'little':
+        out.byteswap()
+    return out.tostring()
+
+
+def write_store(path, generations, terms, labels):
+    """
+    Write vocabulary store file. File is written to temporary file first
+    and renamed, so processes which mapped previous file can still use it.
+
+    @param path store file path
+    @param generations dictionary of vocabulary name -> generation
+    @param terms iterable of (id, vocabulary name, name, parent id, depth, path)
+    @param labels iterable of (term id, lang, label)
+    @rtype int number of terms written
+    """
+    strings = []
+    string_ids = {}
+
+    def intern(value):
+        try:
+            return string_ids[value]
+        except KeyError:
+            string_ids[value] = len(strings)
+            strings.append(value)
+            return string_ids[value]
+
+    terms = sorted(terms, key=lambda t: (t[1], t[2].encode('utf-8'),))
+    index = dict((t[0], idx,) for idx, t in enumerate(terms))
+    vocabularies = {}
+    for idx, term in enumerate(terms):
+        start, end = vocabularies.get(term[1], (idx, idx,))
+        vocabularies[term[1]] = (start, idx + 1,)
+
+    sections = {'term_id': [t[0] for t in terms],
+                'term_name': [intern(t[2]) for t in terms],
+                'term_parent': [index.get(t[3], -1) for t in terms],
+                'term_depth': [t[4] or 0 for t in terms],
+                'term_path': [intern(t[5] or u'') for t in terms],
+                'id_order': sorted(range(len(terms)), key=lambda idx: terms[idx][0])}
+    langs = {}
+    for term_id, lang, label in labels:
+        if term_id not in index or not label:
+            continue
+        if lang not in langs:
+            langs[lang] = [-1] * len(terms)
+        langs[lang][index[term_id]] = intern(label)
+    for lang, values in langs.items():
+        sections['label:{}'.format(lang)] = values
+
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    sections['strings'] = offsets
+
+    names = sorted(sections.keys())
+    meta = {'generations': generations,
+            'terms': len(terms),
+            'strings': len(strings),
+            'vocabularies': vocabularies,
+            'langs': sorted(langs.keys())}
+    # section offsets depend on metadata length, which depends on offsets
+    # values, so they're relative to the end of metadata
+    position = 0
+    meta['sections'] = {}
+    for name in names:
+        meta['sections'][name] = position
+        position += len(sections[name]) * INT.size
+    meta['blob'] = position
+    meta_data = json.dumps(meta)
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(meta_data)))
+        f.write(meta_data)
+        for name in names:
+            f.write(_int_array(sections[name]))
+        for value in encoded:
+            f.write(value)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    return len(terms)
+
+
+class VocabularyStore(object):
+    """
+    Reader for vocabulary store file. Terms are returned as
+    (id, vocabulary name, name, parent id, depth, path) tuples.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, meta_length = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mm.close()
+            raise ValueError("Unsupported vocabulary store file {}".format(path))
+        meta = json.loads(self._mm[HEADER.size:HEADER.size+meta_length])
+        base = HEADER.size + meta_length
+        self.generations = meta['generations']
+        self.langs = meta['langs']
+        self._size = meta['terms']
+        self._vocabularies = dict((name, tuple(idx),) for name, idx in meta['vocabularies'].items())
+        self._sections = dict((name, base + offset,) for name, offset in meta['sections'].items())
+        self._blob = base + meta['blob']
+
+    def __len__(self):
+        return self._size
+
+    def close(self):
+        self._mm.close()
+
+    def _int(self, section, idx):
+        return INT.unpack_from(self._mm, self._sections[section] + idx * INT.size)[0]
+
+    def _bytes(self, string_idx):
+        start, end = INT_PAIR.unpack_from(self._mm, self._sections['strings'] + string_idx * INT.size)
+        return self._mm[self._blob + start:self._blob + end]
+
+    def _str(self, string_idx):
+        return self._bytes(string_idx).decode('utf-8')
+
+    def _vocabulary_name(self, idx):
+        for name, (start, end) in self._vocabularies.iteritems():
+            if start <= idx < end:
+                return name
+
+    def find(self, vocabulary_name, name):
+        """
+        Returns index of term in store, None if there's no such term
+        """
+        try:
+            lo, hi = self._vocabularies[vocabulary_name]
+        except KeyError:
+            return None
+        key = name.encode('utf-8') if isinstance(name, unicode) else name
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(self._int('term_name', mid)) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        end = self._vocabularies[vocabulary_name][1]
+        if lo < end and self._bytes(self._int('term_name', lo)) == key:
+            return lo
+        return None
+
+    def find_by_id(self, term_id):
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._int('term_id', self._int('id_order', mid)) < term_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._size:
+            idx = self._int('id_order', lo)
+            if self._int('term_id', idx) == term_id:
+                return idx
+        return None
+
+    def term(self, idx):
+        parent = self._int('term_parent', idx)
+        return (self._int('term_id', idx),
+                self._vocabulary_name(idx),
+                self._str(self._int('term_name', idx)),
+                self._int('term_id', parent) if parent >= 0 else None,
+                self._int('term_depth', idx),
+                self._str(self._int('term_path', idx)),)
+
+    def parent(self, idx):
+        parent = self._int('term_parent', idx)
+        return parent if parent >= 0 else None
+
+    def label(self, idx, lang):
+        section = 'label:{}'.format(lang)
+        if section not in self._sections:
+            return None
+        string_idx = self._int(section, idx)
+        return self._str(string_idx) if string_idx >= 0 else None
+
+    def labels(self, idx):
+        """
+        Returns list of (lang, label) for term
+        """
+        out = []
+        for lang in self.langs:
+            label = self.label(idx, lang)
+            if label is not None:
+                out.append((lang, label,))
+        return out
@@ -11,7 +11,10 @@ from ckan.model.meta import Session
 from ckan.plugins import toolkit as t
 from ckan.tests import helpers
 
-from ckanext.faociok.models import load_vocabulary, setup_models
+from ckanext.faociok.models import (load_vocabulary, setup_models, term_cache,
+                                    autocomplete_index, country_resolver,
+                                    vocabulary_store)
+from ckanext.faociok.cache import widget_cache
 from ckanext.harvest.model import setup as setup_harvester_models
 from ckanext.faociok.utils import _get_user
 
@@ -83,6 +86,11 @@ class FaoBaseTestCase(unittest.TestCase):
     def setUp(self):
         helpers.reset_db()
         setup_models()
+        term_cache.clear()
+        autocomplete_index.clear()
+        vocabulary_store.clear()
+        country_resolver.clear()
+        widget_cache.clear()
 
     def tearDown(self):
         Session.rollback()
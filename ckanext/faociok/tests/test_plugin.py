@@ -3,25 +3,46 @@
 
 """Tests for plugin.py."""
 
+import os
 import sys
+import csv
+import json
+import tempfile
+import threading
 import gzip
 import logging
+from cStringIO import StringIO
 from ckan.plugins import toolkit as t
 from ckan import model
+from ckan.lib import search
 from ckan.model import Session, Package, PackageExtra
 
 from ckan.logic import ValidationError
 
 from ckan.tests.helpers import change_config, FunctionalTestBase, call_action
 
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
 from ckanext.faociok.validators import CONFIG_FAO_DATATYPE
 from ckanext.faociok.commands.vocabulary import VocabularyCommands
+from ckanext.faociok.commands.commands import FAOCIOKCommand
+from ckanext.faociok.commands.common import reindex_batch
+from ckanext.faociok.utils import _get_user
 from ckanext.faociok.tests import (FaoBaseTestCase, _run_validator_checks,
                                    _load_vocabulary, _get_path,
                                    HarvesterTestCase)
-from ckanext.faociok.models import Vocabulary, VocabularyTerm, VocabularyLabel
-from ckanext.faociok.harvesters.ddiharvester import FaoNadaHarvester
+from ckanext.faociok.models import (Vocabulary, VocabularyTerm, VocabularyLabel,
+                                    PackageTerm, TermUsage, load_vocabulary, bulk_load_vocabulary,
+                                    sync_vocabulary, country_resolver,
+                                    find_unused_terms, fix_dangling_terms,
+                                    load_snapshot, write_snapshot, get_term_labels, vocabulary_store,
+                                    autocomplete_index,
+                                    CONFIG_COUNTRY_FUZZY_CUTOFF, CONFIG_STORE_PATH)
+from ckanext.faociok.harvesters.ddiharvester import FaoNadaHarvester, deferred_solr_commit
+from ckanext.faociok.plugin import FaociokPlugin
+from ckanext.faociok.cache import WidgetCache, LocalBackend, widget_cache
+from ckanext.faociok.store import VocabularyStore
+
+STORE_PATH = os.path.join(tempfile.gettempdir(), 'ckanext-faociok-test.store')
 
 
 # + regular vocabulary import
@@ -82,10 +103,20 @@ class ValidatorsTestCase(FaoBaseTestCase):
                        # south america, not in vocabulary
                        ('{5}', False, None,),
                        ('{9,8,5}', False, None,),
+                       # term from other vocabulary
+                       ('{microdata}', False, None,),
                        )
         
         _run_validator_checks(test_values, t.get_validator('fao_m49_regions'))
 
+        # all invalid terms are reported, valid ones are kept
+        data = {'key': '{9,5,microdata,8}'}
+        errors = {'key': []}
+        t.get_validator('fao_m49_regions')('key', data, errors, {})
+        self.assertEqual(data['key'], ['9', '8'])
+        self.assertEqual(len(errors['key']), 1)
+        self.assertIn('5, microdata', str(errors['key'][0]))
+
     def test_agrovoc_validator(self):
         """
         Test Agrovoc validator
@@ -102,6 +133,27 @@ class ValidatorsTestCase(FaoBaseTestCase):
         
         _run_validator_checks(test_values, t.get_validator('fao_agrovoc'))
 
+    def test_package_schema_cache(self):
+        """
+        Test repeated schema calls return equal schemas, and changes made
+        by callers are not kept in cached parts of schema
+        """
+        plugin = FaociokPlugin()
+        fields = ('fao_datatype', 'fao_m49_regions', 'fao_agrovoc',)
+        for get_schema in (plugin.create_package_schema,
+                           plugin.update_package_schema,
+                           plugin.show_package_schema,):
+            schema = get_schema()
+            expected = dict((name, list(schema[name]),) for name in fields)
+            self.assertEqual(dict((name, get_schema()[name],) for name in fields), expected)
+
+            for name in fields:
+                schema[name].append(t.get_validator('ignore_missing'))
+            schema.pop('fao_agrovoc')
+            schema = get_schema()
+            self.assertEqual(dict((name, schema[name],) for name in fields), expected,
+                             get_schema.__name__)
+
 class CommandTestCase(FaoBaseTestCase):
 
     def test_vocabulary_create(self):
@@ -117,6 +169,171 @@ class CommandTestCase(FaoBaseTestCase):
         usage = cli.usage
         self.assertIsNotNone(usage)
     
+    def test_vocabulary_bulk_load(self):
+        """
+        Test bulk loader gives the same result as row-by-row loader
+        """
+        def _get_terms():
+            return [(t['value'], t['text'], t['depth'],)
+                    for t in VocabularyTerm.get_terms('m49_regions', 'fr')]
+
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+        expected = _get_terms()
+
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'), bulk=True)
+        self.assertEqual(_get_terms(), expected)
+
+        italy = VocabularyTerm.get('m49_regions', '380')
+        self.assertEqual(italy.path, '150/380')
+        self.assertEqual([t.name for t in italy.get_ancestors()], ['150'])
+        self.assertEqual(italy.properties, {'country_code': 'ITA'})
+
+    def test_vocabulary_empty_labels(self):
+        """
+        Test empty label cells are not stored by any loader
+        """
+        data = ('term,lang:en,lang:fr\n'
+                'microdata,Microdata,\n')
+        for loader in (load_vocabulary, bulk_load_vocabulary, sync_vocabulary,):
+            loader('datatype', StringIO(data))
+            term = VocabularyTerm.get('datatype', 'microdata')
+            self.assertEqual([(l.lang, l.label,) for l in term.labels], [('en', 'Microdata',)],
+                             loader.__name__)
+            Vocabulary.get('datatype').clear()
+
+    def test_vocabulary_snapshot(self):
+        """
+        Test vocabularies exported to snapshot are loaded back unchanged
+        """
+        def _get_terms(vocabulary_name):
+            return [(t['value'], t['text'], t['depth'],)
+                    for t in VocabularyTerm.get_terms(vocabulary_name, 'fr')]
+
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+        _load_vocabulary('datatype', 'faociok.datatype.csv')
+        expected = dict((name, _get_terms(name),) for name in ('m49_regions', 'datatype',))
+
+        fd, path = tempfile.mkstemp(suffix='.snapshot')
+        os.close(fd)
+        try:
+            cli.cmd_export_snapshot(path)
+            Vocabulary.get('m49_regions').clear()
+            cli.cmd_import_snapshot(path, 'm49_regions')
+            with open(path, 'rb') as f:
+                data = f.read()
+        finally:
+            os.remove(path)
+
+        for name, terms in expected.items():
+            self.assertEqual(_get_terms(name), terms)
+        italy = VocabularyTerm.get('m49_regions', '380')
+        self.assertEqual(italy.path, '150/380')
+        self.assertEqual(italy.properties, {'country_code': 'ITA'})
+
+        self.assertRaises(ValueError, load_snapshot, StringIO(data[:-1] + 'x'))
+        self.assertRaises(ValueError, load_snapshot, StringIO('not a snapshot'))
+
+    def test_vocabulary_snapshot_labels(self):
+        """
+        Test multiple labels in one language are kept in snapshot
+        """
+        _load_vocabulary('datatype', 'faociok.datatype.csv')
+        microdata = VocabularyTerm.get('datatype', 'microdata')
+        VocabularyLabel.create(microdata, u'Micro data', 'en')
+
+        def _get_labels():
+            term = VocabularyTerm.get('datatype', 'microdata')
+            return sorted((l.lang, l.label,) for l in
+                          Session.query(VocabularyLabel).filter(VocabularyLabel.term_id==term.id))
+
+        expected = _get_labels()
+        self.assertEqual(len([lang for lang, label in expected if lang == 'en']), 2)
+        data = StringIO()
+        write_snapshot(data, ['datatype'])
+        Vocabulary.get('datatype').clear()
+        data.seek(0)
+        load_snapshot(data)
+        self.assertEqual(_get_labels(), expected)
+
+        # sync keeps one label per language
+        data.seek(0)
+        self.assertRaises(ValueError, load_snapshot, data, sync=True)
+
+    def _import_m49_export(self, suffix, delimiter, header_prefix=''):
+        # column layout of UN M49 overview table export
+        header = ['Global Code', 'Global Name', 'Region Code', 'Region Name',
+                  'Sub-region Code', 'Sub-region Name', 'Intermediate Region Code',
+                  'Intermediate Region Name', 'Country or Area', 'M49 Code',
+                  'ISO-alpha2 Code', 'ISO-alpha3 Code']
+        header[0] = header_prefix + header[0]
+        rows = [header,
+                ['001', 'World', '019', 'Americas', '419', 'Latin America and the Caribbean',
+                 '013', 'Central America', 'Costa Rica', '188', 'CR', 'CRI'],
+                ['001', 'World', '150', 'Europe', '154', 'Northern Europe',
+                 '', '', '\xc3\x85land Islands', '248', 'AX', 'ALA'],
+                ['001', 'World', '150', 'Europe', '039', 'Southern Europe',
+                 '', '', 'Italy', '380', 'IT', 'ITA'],
+                ['001', 'World', '002', 'Africa', '015', 'Northern Africa',
+                 '', '', 'Algeria', '012', 'DZ', 'DZA']]
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                csv.writer(f, delimiter=delimiter).writerows(rows)
+            cli = VocabularyCommands('vocabulary')
+            cli.cmd_import_m49(path)
+        finally:
+            os.remove(path)
+
+        names = Session.query(VocabularyTerm.name).join(Vocabulary)\
+                       .filter(Vocabulary.name=='m49_regions')
+        self.assertEqual(set(row[0] for row in names),
+                         set(['19', '188', '150', '248', '380', '2', '12']))
+        italy = VocabularyTerm.get('m49_regions', '380')
+        self.assertEqual(italy.path, '150/380')
+        self.assertEqual(italy.properties, {'country_code': 'ITA'})
+        self.assertEqual(VocabularyTerm.get('m49_regions', '248').get_label('en').label,
+                         u'\xc5land Islands')
+        self.assertEqual(VocabularyTerm.get('m49_regions', '12').path, '2/12')
+
+    def test_import_m49_tsv(self):
+        """
+        Test M49 import from tsv export of UN M49 table
+        """
+        self._import_m49_export('.tsv', '\t')
+
+    def test_import_m49_csv(self):
+        """
+        Test M49 import from csv export of UN M49 table, with BOM and
+        semicolon as delimiter
+        """
+        self._import_m49_export('.csv', ';', header_prefix='\xef\xbb\xbf')
+
+    def test_vocabulary_sync(self):
+        """
+        Test incremental vocabulary update
+        """
+        _load_vocabulary('datatype', 'faociok.datatype.csv')
+        microdata_id = VocabularyTerm.get('datatype', 'microdata').id
+        other_id = VocabularyTerm.get('datatype', 'other').id
+
+        data = StringIO('term,lang:en,lang:fr\n'
+                        'microdata,Microdata,Microdonnees\n'
+                        'other,Other,other FR\n'
+                        'statistics,Statistics,Statistiques\n')
+        count = sync_vocabulary('datatype', data)
+        self.assertEqual(count, 3)
+
+        microdata = VocabularyTerm.get('datatype', 'microdata')
+        self.assertEqual(microdata.id, microdata_id)
+        self.assertEqual(microdata.get_label('fr').label, 'Microdonnees')
+        self.assertIsNone(microdata.get_label('es'))
+        self.assertEqual(VocabularyTerm.get('datatype', 'other').id, other_id)
+        self.assertIsNone(VocabularyTerm.get('datatype', 'geospatial'))
+        self.assertEqual(VocabularyTerm.get('datatype', 'statistics').get_label('en').label,
+                         'Statistics')
+
     def test_vocabulary_term_rename(self):
         """
         Test vocabulary rename_term command
@@ -160,6 +377,13 @@ class CommandTestCase(FaoBaseTestCase):
 
         self.assertEqual(p['fao_datatype'], 'microdata', p)
 
+        cli.cmd_rename_term('m49_regions', '9', '21', dry_run=True)
+        Session.commit()
+        p = package_show({'ignore_auth': True,
+                          'use_cache': False},
+                         {'name_or_id': 'sometitle'})
+        self.assertEqual(set(p['fao_m49_regions']), set(['8', '9']), p.get('fao_m49_regions'))
+
         cli.cmd_rename_term('m49_regions', '9', '21')
         Session.commit()
         p = package_show({'ignore_auth': True,
@@ -167,7 +391,458 @@ class CommandTestCase(FaoBaseTestCase):
                          {'name_or_id': 'sometitle'})
         
         self.assertEqual(set(p['fao_m49_regions']), set(['8', '21']), p.get('fao_m49_regions'))
+        # renaming to already used term doesn't duplicate it
+        cli.cmd_rename_term('m49_regions', '8', '21')
+        Session.commit()
+        p = package_show({'ignore_auth': True,
+                          'use_cache': False},
+                         {'name_or_id': 'sometitle'})
+        self.assertEqual(p['fao_m49_regions'], ['21'], p.get('fao_m49_regions'))
+        found = call_action('package_search', q='fao_m49_regions:21')
+        self.assertEqual(found['count'], 1)
+
+    def test_dangling_terms(self):
+        """
+        Test terms missing from vocabulary are found and fixed
+        """
+        cli = VocabularyCommands('vocabulary')
+        _load_vocabulary('datatype', 'faociok.datatype.csv')
+        cli.cmd_import_agrovoc(_get_path('agrovoc_excerpt.nt'))
+        pkg = self._create_dataset({'title': 'some title',
+                                    'name': 'sometitle',
+                                    'fao_datatype': 'other',
+                                    'fao_agrovoc': ['c_432', 'c_7020'],
+                                    'resources': []})
+        self.assertEqual(find_unused_terms('agrovoc'), {'datasets': {}, 'terms': {}})
+
+        Session.query(PackageExtra).filter(PackageExtra.package_id==pkg['id'],
+                                           PackageExtra.key=='fao_agrovoc')\
+                                   .update({'value': '{c_432,c_missing,c_gone}'},
+                                           synchronize_session=False)
+        out = find_unused_terms('agrovoc')
+        self.assertEqual(out['datasets'], {pkg['id']: set(['c_missing', 'c_gone'])})
+        self.assertEqual(out['terms'], {'c_missing': set([pkg['id']]),
+                                        'c_gone': set([pkg['id']])})
+
+        # invalid command arguments don't change datasets
+        cli.cmd_check_terms('c_missing=c_7020', fix=True)
+        cli.cmd_check_terms(fix=True)
+        cli.cmd_check_terms('unknown', 'c_missing=c_7020', fix=True)
+        cli.cmd_check_terms('agrovoc', 'c_gone=c_invalid', fix=True)
+        self.assertEqual(set(find_unused_terms('agrovoc')['terms']), set(['c_missing', 'c_gone']))
+
+        vocab = Vocabulary.get('agrovoc')
+        self.assertRaises(ValueError, fix_dangling_terms, vocab, {'c_gone': 'c_invalid'})
+        changed = fix_dangling_terms(vocab, {'c_missing': 'c_7020'})
+        self.assertEqual(changed, [pkg['id']])
+        value = Session.query(PackageExtra.value)\
+                       .filter(PackageExtra.package_id==pkg['id'],
+                               PackageExtra.key=='fao_agrovoc').scalar()
+        self.assertEqual(value, '{c_432,c_7020}')
+        self.assertEqual(find_unused_terms('agrovoc')['terms'], {})
+
+
+class TermClosureTestCase(FaoBaseTestCase):
+
+    def test_term_closure(self):
+        """
+        Test ancestors and descendants lookups for m49 regions
+        """
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+
+        italy = VocabularyTerm.get('m49_regions', '380')
+        europe = VocabularyTerm.get('m49_regions', '150')
+        self.assertEqual([t.name for t in italy.get_ancestors()], ['150'])
+        self.assertEqual(italy.get_path(), '150/380')
+        self.assertEqual(italy.path, '150/380')
+
+        descendants = set(t.name for t in europe.get_descendants())
+        self.assertTrue(set(['380', '8']).issubset(descendants), descendants)
+        self.assertFalse('150' in descendants)
+        self.assertEqual(europe.get_descendants(max_distance=0), [])
+        self.assertEqual([t.name for t in europe.get_descendants(max_distance=0, include_self=True)],
+                         ['150'])
+
+        # closure rebuilt from scratch should be the same
+        cli.cmd_rebuild_closure('m49_regions')
+        self.assertEqual(set(t.name for t in europe.get_descendants()), descendants)
+        self.assertEqual([t.name for t in italy.get_ancestors(include_self=True)], ['150', '380'])
+
+    def test_term_update_parent(self):
+        """
+        Test term moved with update() keeps its subtree consistent
+        """
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+
+        europe = VocabularyTerm.get('m49_regions', '150')
+        latam = VocabularyTerm.get('m49_regions', '419')
+        europe.update(labels={'en': 'Europe'}, parent=latam)
+
+        italy = VocabularyTerm.get('m49_regions', '380')
+        self.assertEqual((italy.path, italy.depth,), ('419/150/380', 2,))
+        self.assertEqual([t.name for t in italy.get_ancestors()], ['419', '150'])
+        self.assertTrue('380' in set(t.name for t in latam.get_descendants()))
+        closure = set((t.name for t in latam.get_descendants()))
+
+        cli.cmd_rebuild_closure('m49_regions')
+        self.assertEqual(set(t.name for t in latam.get_descendants()), closure)
+        self.assertRaises(ValueError, latam.update, labels={}, parent=italy)
+
+
+class TermUsageTestCase(FaoBaseTestCase):
+
+    def test_term_usage(self):
+        """
+        Package terms and dataset counts are updated when datasets change
+        """
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+        _load_vocabulary('datatype', 'faociok.datatype.csv')
+
+        def _counts(vocabulary_name):
+            return dict((t['value'], t['dataset_count'],)
+                        for t in VocabularyTerm.get_terms(vocabulary_name, 'en',
+                                                          include_dataset_count=True))
+
+        self._create_dataset({'name': 'first',
+                              'fao_datatype': 'other',
+                              'fao_m49_regions': ['380', '8'],
+                              'resources': []})
+        self._create_dataset({'name': 'second',
+                              'fao_datatype': 'microdata',
+                              'fao_m49_regions': ['380'],
+                              'resources': []})
+
+        first_terms = Session.query(VocabularyTerm.name)\
+                             .join(PackageTerm, PackageTerm.term_id==VocabularyTerm.id)\
+                             .join(Package, Package.id==PackageTerm.package_id)\
+                             .filter(Package.name=='first')
+        self.assertEqual(set(t[0] for t in first_terms), set(['other', '380', '8']))
+
+        counts = _counts('datatype')
+        self.assertEqual((counts['other'], counts['microdata'], counts['geospatial']), (1, 1, 0))
+        counts = _counts('m49_regions')
+        self.assertEqual((counts['380'], counts['8'], counts['150']), (2, 1, 0))
+
+        featured = VocabularyTerm.get_most_frequent_parent('m49_regions', 'en')
+        self.assertEqual([(f['name'], f['dataset_count']) for f in featured], [('150', 2)])
+
+        call_action('package_delete', {'user': _get_user()['name']}, id='second')
+        counts = _counts('m49_regions')
+        self.assertEqual((counts['380'], counts['8']), (1, 1))
+        second = Package.get('second')
+        self.assertEqual(Session.query(PackageTerm).filter(PackageTerm.package_id==second.id).count(), 0)
+
+    def test_package_purge(self):
+        """
+        Datasets using terms can be purged
+        """
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+        _load_vocabulary('datatype', 'faociok.datatype.csv')
+        pkg = self._create_dataset({'name': 'purged',
+                                    'fao_datatype': 'other',
+                                    'fao_m49_regions': ['380'],
+                                    'resources': []})
+        self.assertTrue(Session.query(PackageTerm).filter(PackageTerm.package_id==pkg['id']).count())
+
+        call_action('dataset_purge', {'user': _get_user()['name']}, id=pkg['id'])
+        self.assertIsNone(Package.get(pkg['id']))
+        self.assertEqual(Session.query(PackageTerm).filter(PackageTerm.package_id==pkg['id']).count(), 0)
+
+    def test_term_usage_concurrent(self):
+        """
+        Concurrent changes of datasets sharing an ancestor term don't conflict
+        """
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+        Session.commit()
+        vocab = Vocabulary.get(Vocabulary.VOCABULARY_M49_REGIONS)
+        # italy, france, europe
+        italy, france, europe = [VocabularyTerm.get(vocab, name).id for name in ('380', '250', '150')]
+        errors = []
+
+        def _other_session():
+            try:
+                other_vocab = Vocabulary.get(Vocabulary.VOCABULARY_M49_REGIONS)
+                TermUsage.apply_changes(other_vocab, [(set(), set([france]),)])
+                Session.commit()
+            except Exception, err:
+                errors.append(err)
+            finally:
+                Session.remove()
+
+        TermUsage.apply_changes(vocab, [(set(), set([italy]),)])
+        other = threading.Thread(target=_other_session)
+        other.start()
+        # other session waits for rows of shared ancestors
+        other.join(1)
+        self.assertTrue(other.is_alive(), errors)
+        Session.commit()
+        other.join()
+        self.assertEqual(errors, [])
+
+        usage = dict((row.term_id, (row.dataset_count, row.total_count,))
+                     for row in Session.query(TermUsage))
+        self.assertEqual(usage[italy], (1, 1))
+        self.assertEqual(usage[france], (1, 1))
+        self.assertEqual(usage[europe], (0, 2))
+
+
+class WidgetCacheTestCase(FaoBaseTestCase):
+
+    def test_widget_cache(self):
+        cache = WidgetCache(LocalBackend())
+        calls = []
+
+        def load():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(cache.get_or_set('ns', 'en', load, ttl=60), 1)
+        self.assertEqual(cache.get_or_set('ns', 'en', load, ttl=60), 1)
+        self.assertEqual(cache.get_or_set('ns', 'fr', load, ttl=60), 2)
+        cache.invalidate('ns')
+        self.assertEqual(cache.get_or_set('ns', 'en', load, ttl=60), 3)
+        # ttl 0 disables caching
+        self.assertEqual(cache.get_or_set('ns', 'en', load, ttl=0), 4)
+
+        # expired value is served while other worker recomputes it
+        backend = cache.backend
+        key = cache._key('ns', 'en')
+        backend.set(key, (0, 'stale',), 60)
+        backend.acquire(key, 10)
+        self.assertEqual(cache.get_or_set('ns', 'en', load, ttl=60), 'stale')
+        backend.release(key)
+        self.assertEqual(cache.get_or_set('ns', 'en', load, ttl=60), 5)
+
+    def test_widget_cache_backend_failure(self):
+        """
+        Values are computed and datasets can be changed when cache backend fails
+        """
+        class FailingBackend(LocalBackend):
+            def _fail(self, *args):
+                raise IOError("backend is down")
+            get = set = incr = acquire = release = _fail
+
+        cache = WidgetCache(FailingBackend())
+        self.assertEqual(cache.get_or_set('ns', 'en', lambda: 1, ttl=60), 1)
+        cache.invalidate('ns')
 
+        backend = FailingBackend()
+        backend.get = LocalBackend().get
+        cache = WidgetCache(backend)
+        self.assertEqual(cache.get_or_set('ns', 'en', lambda: 2, ttl=60), 2)
+
+        _load_vocabulary('datatype', 'faociok.datatype.csv')
+        widget_cache._backend, previous = FailingBackend(), widget_cache._backend
+        try:
+            pkg = self._create_dataset({'name': 'cache-down',
+                                        'fao_datatype': 'other',
+                                        'resources': []})
+            call_action('package_delete', {'user': _get_user()['name']}, id=pkg['id'])
+        finally:
+            widget_cache._backend = previous
+
+    def test_widget_cache_invalidate_after_commit(self):
+        cache = WidgetCache(LocalBackend())
+        calls = []
+
+        def load():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(cache.get_or_set('ns', 'en', load, ttl=60), 1)
+        cache.invalidate_after_commit(Session(), 'ns')
+        Session.query(Package).count()
+        Session.rollback()
+        self.assertEqual(cache.get_or_set('ns', 'en', load, ttl=60), 1)
+
+        cache.invalidate_after_commit(Session(), 'ns')
+        self.assertEqual(cache.get_or_set('ns', 'en', load, ttl=60), 1)
+        Session.commit()
+        self.assertEqual(cache.get_or_set('ns', 'en', load, ttl=60), 2)
+
+
+class TermCacheTestCase(FaoBaseTestCase):
+
+    def test_term_cache(self):
+        """
+        Test cached term lookups are refreshed after vocabulary reload
+        """
+        _load_vocabulary('datatype', 'faociok.datatype.csv')
+
+        term = VocabularyTerm.get_cached('datatype', 'microdata')
+        self.assertEqual(term.name, 'microdata')
+        self.assertEqual(term.get_label_text('fr'), 'Microdata FR')
+        self.assertEqual(term.get_label_text('xx', 'en'), 'Microdata')
+        self.assertIsNone(VocabularyTerm.get_cached('datatype', 'missing'))
+
+        db_term = VocabularyTerm.get('datatype', 'microdata')
+        db_term.update(labels={'fr': 'Microdonnees'})
+        # local caches are dropped after commit
+        Session.commit()
+
+        term = VocabularyTerm.get_cached('datatype', 'microdata')
+        self.assertEqual(term.get_label_text('fr'), 'Microdonnees')
+        self.assertIsNone(term.get_label_text('en'))
+
+    @change_config(CONFIG_STORE_PATH, STORE_PATH)
+    def test_vocabulary_store(self):
+        """
+        Test term lookups are served from vocabulary store, which is
+        written from committed vocabularies only
+        """
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+        _load_vocabulary('datatype', 'faociok.datatype.csv')
+        try:
+            # uncommitted vocabularies are not written, lookups use db
+            self.assertEqual(vocabulary_store.build(), 0)
+            self.assertIsNone(vocabulary_store.get())
+            self.assertEqual(VocabularyTerm.get_cached('datatype', 'microdata').name, 'microdata')
+
+            Session.commit()
+            self.assertTrue(vocabulary_store.build(force=False) > 0)
+            self.assertIsNone(vocabulary_store.build(force=False))
+            term = VocabularyTerm.get_cached('datatype', 'microdata')
+            self.assertIsNotNone(vocabulary_store.get())
+            self.assertEqual(term.name, 'microdata')
+            self.assertEqual(term.get_label_text('fr'), 'Microdata FR')
+            self.assertIsNone(VocabularyTerm.get_cached('datatype', 'missing'))
+
+            italy = VocabularyTerm.get_cached('m49_regions', '380')
+            self.assertEqual((italy.path, italy.depth, italy.parent.name,), ('150/380', 1, '150',))
+            europe = [(0, l.lang, l.label,) for l in VocabularyTerm.get('m49_regions', '150').labels]
+            italy = [(1, l.lang, l.label,) for l in VocabularyTerm.get('m49_regions', '380').labels]
+            stored = get_term_labels('m49_regions', ['380', '150', 'missing'], with_parents=True)
+            self.assertEqual(dict((k, sorted(v),) for k, v in stored.items()),
+                             {'150': sorted(europe), '380': sorted(europe + italy)})
+
+            # outdated file is not rebuilt by lookups
+            generations = vocabulary_store.get().generations
+            db_term = VocabularyTerm.get('datatype', 'microdata')
+            db_term.update(labels={'fr': 'Microdonnees'})
+            Session.commit()
+            term = VocabularyTerm.get_cached('datatype', 'microdata')
+            self.assertEqual(term.get_label_text('fr'), 'Microdonnees')
+            self.assertIsNone(vocabulary_store.get())
+            self.assertEqual(VocabularyStore(STORE_PATH).generations, generations)
+        finally:
+            vocabulary_store.clear()
+            os.remove(STORE_PATH)
+
+
+class CountryResolverTestCase(FaoBaseTestCase):
+
+    def test_country_resolver(self):
+        """
+        Test country names, codes and aliases are resolved to M49 terms
+        """
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+
+        # 188 - Costa Rica, 840 - United States of America
+        for value, expected in ((u'Costa Rica', '188',),
+                                (u'  costa RICA ', '188',),
+                                (u'Costa Rica [FR]', '188',),
+                                (u'CRI', '188',),
+                                (u'188', '188',),
+                                (u'Costa Ricca', '188',),
+                                (u'United States of America', '840',),
+                                (u'USA', '840',),
+                                (u'United States', '840',),
+                                (u'Atlantis', None,),
+                                (None, None,)):
+            self.assertEqual(country_resolver.resolve(value), expected, value)
+
+    @change_config(CONFIG_COUNTRY_FUZZY_CUTOFF, '0')
+    def test_country_resolver_no_fuzzy(self):
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+
+        self.assertEqual(country_resolver.resolve(u'costa rica'), '188')
+        self.assertIsNone(country_resolver.resolve(u'Costa Ricca'))
+
+class IndexTestCase(FaoBaseTestCase):
+
+    def test_before_index_localization(self):
+        """
+        Test localized fields added to indexed dataset
+        """
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_load('datatype', _get_path('faociok.datatype.csv'))
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+        cli.cmd_import_agrovoc(_get_path('agrovoc_excerpt.nt'))
+
+        pkg_dict = {'fao_datatype': 'microdata',
+                    # italy, albania, not in vocabulary
+                    'fao_m49_regions': '{380,8,5}',
+                    'fao_agrovoc': '{c_432,c_7020}'}
+        out = FaociokPlugin().before_index(pkg_dict)
+
+        self.assertEqual(out['fao_datatype_fr'], 'Microdata FR')
+        self.assertEqual(set(out['fao_m49_regions_l1_en']), set(['Italy', 'Albania']))
+        self.assertEqual([l.strip() for l in out['fao_m49_regions_l0_en']], ['Europe'])
+        self.assertEqual(out['fao_m49_regions'], ['380', '8', '5'])
+        self.assertEqual(out['fao_agrovoc'], ['c_432', 'c_7020'])
+        self.assertEqual(len(out['fao_agrovoc_en']), 2, out['fao_agrovoc_en'])
+
+
+    def test_before_index_trimming(self):
+        """
+        Long values are trimmed to solr limit in bytes, text fields are kept
+        """
+        long_text = u'\u017c' * 20000
+        pkg_dict = {'notes': long_text,
+                    'extras_description': long_text,
+                    'ddi_abstract': long_text,
+                    'ddi_keywords': ['short', long_text],
+                    'ddi_short': u'short'}
+        out = FaociokPlugin().before_index(pkg_dict)
+
+        self.assertEqual(out['notes'], long_text)
+        self.assertEqual(out['extras_description'], long_text)
+        self.assertEqual(len(out['ddi_abstract'].encode('utf-8')), 32766)
+        self.assertTrue(long_text.startswith(out['ddi_abstract']))
+        self.assertEqual(out['ddi_keywords'][0], 'short')
+        self.assertEqual(len(out['ddi_keywords'][1].encode('utf-8')), 32766)
+        self.assertEqual(out['ddi_short'], u'short')
+
+    def test_reindex(self):
+        """
+        Test datasets are reindexed in batches, with preloaded labels
+        """
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_load('datatype', _get_path('faociok.datatype.csv'))
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+        for idx in range(3):
+            self._create_dataset({'title': 'dataset {}'.format(idx),
+                                  'name': 'dataset-{}'.format(idx),
+                                  'fao_datatype': 'microdata',
+                                  'fao_m49_regions': ['380'],
+                                  'resources': []})
+        package_ids = [row[0] for row in Session.query(Package.id).order_by(Package.name)]
+
+        plugin = FaociokPlugin()
+        with plugin.preloaded_index_labels({'m49_regions': {'380': [(1, 'en', u'Preloaded')]}}):
+            out = plugin.before_index({'fao_m49_regions': '{380}'})
+        self.assertEqual(out['fao_m49_regions_l1_en'], [u'Preloaded'])
+
+        search.clear_all()
+        query = {'q': 'fao_m49_regions_l1_en:Italy'}
+        self.assertEqual(call_action('package_search', **query)['count'], 0)
+
+        indexed, failed = reindex_batch(package_ids + ['missing-id'])
+        self.assertEqual((indexed, failed), (3, ['missing-id']))
+        found = call_action('package_search', **query)
+        self.assertEqual(sorted(p['id'] for p in found['results']), sorted(package_ids))
+
+        search.clear_all()
+        FAOCIOKCommand('faociok').cmd_reindex(batch_size=2)
+        self.assertEqual(call_action('package_search', **query)['count'], 3)
 
 
 class AutocompleteTestCase(FaoBaseTestCase):
@@ -199,6 +874,55 @@ class AutocompleteTestCase(FaoBaseTestCase):
 
         data = {}
         self.assertRaises(ValidationError, autocomplete, ctx, data)
+        for offset in ('abc', -1):
+            data = {'q': 'oth', 'lang': 'en', 'offset': offset, 'vocabulary': 'datatype'}
+            self.assertRaises(ValidationError, autocomplete, ctx, data)
+
+    def test_autocomplete_term_name(self):
+        """
+        Exact term name matches return labels in requested lang only
+        """
+        load_vocabulary('countries', StringIO('term,lang:en,lang:fr\n'
+                                              'fr,France,La France\n'
+                                              'af,Africa,Afrique\n'))
+        autocomplete = t.get_action('fao_autocomplete')
+        ctx = {'mode': model}
+        for lang, expected in (('en', [('fr', 'France'), ('af', 'Africa')]),
+                               ('fr', [('fr', 'La France'), ('af', 'Afrique')]),):
+            out = autocomplete(ctx, {'q': 'fr', 'lang': lang, 'vocabulary': 'countries'})
+            self.assertEqual([(tag['term'], tag['label']) for tag in out['tags']], expected)
+
+    def test_autocomplete_normalized(self):
+        """
+        Autocomplete ignores case and accents, prefix matches go first
+        """
+        autocomplete = t.get_action('fao_autocomplete')
+        ctx = {'mode': model}
+        data = {'q': 'COT', 'lang': 'en', 'vocabulary': 'countries'}
+
+        for loader in (load_vocabulary, bulk_load_vocabulary):
+            loader('countries', StringIO('term,lang:en\n'
+                                         'sc,Scotland\n'
+                                         'ci,C\xc3\xb4te d\'Ivoire\n'
+                                         'fr,France\n'))
+            out = autocomplete(ctx, data)
+            self.assertEqual([tag['term'] for tag in out['tags']], ['ci', 'sc'])
+            self.assertEqual(out['count'], 2)
+
+        sync_vocabulary('countries', StringIO('term,lang:en\n'
+                                              'sc,Scotland\n'
+                                              'ci,Ivory Coast\n'))
+        out = autocomplete(ctx, data)
+        self.assertEqual([tag['term'] for tag in out['tags']], ['sc'])
+
+    @change_config('ckanext.faociok.autocomplete.engine', 'memory')
+    def test_autocomplete_memory_engine(self):
+        """
+        In-memory engine gives the same results as db search
+        """
+        self.test_autocomplete()
+        self.test_autocomplete_normalized()
+        self.test_autocomplete_term_name()
 
 
 class AutocompleteControllerTestCase(FunctionalTestBase, FaoBaseTestCase):
@@ -244,6 +968,38 @@ class AutocompleteControllerTestCase(FunctionalTestBase, FaoBaseTestCase):
         self.assertTrue(isinstance(found_it, dict), resp.json)
         self.assertEqual(found_it['label'].strip(), 'other FR', found_it)
 
+    def test_autocomplete_view_caching(self):
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_load('datatype', _get_path('faociok.datatype.csv'))
+        model.Session.commit()
+
+        app = self._get_test_app()
+        url = '/api/util/fao/autocomplete/datatype?incomplete=oth&lang=en'
+        resp = app.get(url)
+        etag = resp.headers['ETag']
+        self.assertTrue(resp.headers['Cache-Control'].startswith('public, max-age='))
+        if not autocomplete_index.enabled:
+            self.assertTrue(resp.headers.get('Last-Modified'))
+
+        resp = app.get(url, headers={'If-None-Match': etag}, status=304)
+        self.assertEqual(resp.body, '')
+        resp = app.get(url.replace('oth', 'mic'), headers={'If-None-Match': etag})
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        # reloaded vocabulary invalidates previous responses
+        cli.cmd_load('datatype', _get_path('faociok.datatype.csv'))
+        model.Session.commit()
+        resp = app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_int, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    @change_config('ckanext.faociok.autocomplete.engine', 'memory')
+    def test_autocomplete_view_caching_memory_engine(self):
+        """
+        ETag follows generation checked by in-memory index
+        """
+        self.test_autocomplete_view_caching()
+
 class DDIHarvesterTestCase(HarvesterTestCase):
 
     @change_config(CONFIG_FAO_DATATYPE, 'microdata')
@@ -270,10 +1026,86 @@ class DDIHarvesterTestCase(HarvesterTestCase):
             hobj.content = f.read()
         harv = FaoNadaHarvester()
 
-        out = harv.import_stage(hobj)
+        ret = harv.import_stage(hobj)
         
-        self.assertTrue(isinstance(out, dict), [(herr.message, herr.stage, herr.line) for herr in hobj.errors])
+        self.assertTrue(ret, [(herr.message, herr.stage, herr.line) for herr in hobj.errors])
+        out = t.get_action('package_show')({'ignore_auth': True,
+                                            'use_cache': False},
+                                           {'name_or_id': HarvestObject.get(h['id']).package_id})
         self.assertEqual(out.get('fao_datatype'), 'microdata', out.get('fao_datatype'))
         # 188 - Costa Rica
-        self.assertEqual(out.get('fao_m49_regions'), '{188}', out.get('fao_m49_regions'))
+        self.assertEqual(out.get('fao_m49_regions'), ['188'], out.get('fao_m49_regions'))
         self.assertTrue(out.get('fao_agrovoc') in ('{}', []), out.get('fao_agrovoc'))
+
+    @change_config(CONFIG_FAO_DATATYPE, 'microdata')
+    def test_harvester_batch(self):
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_load('datatype', _get_path('faociok.datatype.csv'))
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+
+        h = self._create_harvest_obj('http://test/sourc/a',
+                                     source_type='fao-nada',
+                                     config='{"batch_size": 10}')
+        hobj = HarvestObject.get(h['id'])
+        with gzip.open(_get_path('harvest_object_content.gz'), 'rb') as f:
+            hobj.content = f.read()
+        harv = FaoNadaHarvester()
+        self.assertEqual(harv.get_batch_size(hobj.source), 10)
+
+        ret = harv.import_stage(hobj)
+        self.assertTrue(ret, [(herr.message, herr.stage, herr.line) for herr in hobj.errors])
+
+        stats = Session.query(HarvestObjectExtra.value)\
+                       .filter(HarvestObjectExtra.harvest_object_id==hobj.id,
+                               HarvestObjectExtra.key=='fao_import_stats').scalar()
+        self.assertTrue(set(['import', 'fao_fields', 'package_write']).issubset(json.loads(stats)), stats)
+
+        # last object of the job is committed, so package can be found
+        found = call_action('package_search', q='fao_m49_regions:188')
+        self.assertEqual(found['count'], 1)
+
+    @change_config(CONFIG_FAO_DATATYPE, 'microdata')
+    def test_harvester_batch_reimport(self):
+        """
+        Objects loaded from db (with unicode content) can be re-imported
+        """
+        cli = VocabularyCommands('vocabulary')
+        cli.cmd_load('datatype', _get_path('faociok.datatype.csv'))
+        cli.cmd_import_m49(_get_path('M49_Codes.xlsx'))
+
+        h = self._create_harvest_obj('http://test/sourc/a',
+                                     source_type='fao-nada')
+        hobj = HarvestObject.get(h['id'])
+        with gzip.open(_get_path('harvest_object_content.gz'), 'rb') as f:
+            hobj.content = f.read()
+        hobj.save()
+        Session.remove()
+
+        hobj = HarvestObject.get(h['id'])
+        self.assertTrue(isinstance(hobj.content, unicode))
+        failed, stats = FaoNadaHarvester().import_batch([hobj])
+        self.assertEqual(failed, [], [(herr.message, herr.stage) for herr in hobj.errors])
+        self.assertEqual(stats.count, 1)
+        found = call_action('package_search', q='fao_m49_regions:188')
+        self.assertEqual(found['count'], 1)
+
+        # stats of re-imported object are replaced, and summed in job report
+        failed, stats = FaoNadaHarvester().import_batch([HarvestObject.get(h['id'])])
+        self.assertEqual(failed, [])
+        extras = Session.query(HarvestObjectExtra)\
+                        .filter(HarvestObjectExtra.harvest_object_id==h['id'],
+                                HarvestObjectExtra.key=='fao_import_stats')
+        self.assertEqual(extras.count(), 1)
+        report = call_action('fao_harvest_job_import_stats', id=h['harvest_job_id'])
+        self.assertEqual(report['count'], 1)
+        self.assertTrue('package_write' in report['times'], report)
+
+    @change_config('ckan.search.solr_commit', 'true')
+    def test_deferred_solr_commit(self):
+        """
+        Solr commit setting is overridden only inside the block
+        """
+        from ckan.common import config
+        with deferred_solr_commit():
+            self.assertEqual(config['ckan.search.solr_commit'], 'false')
+        self.assertEqual(config['ckan.search.solr_commit'], 'true')
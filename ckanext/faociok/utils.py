@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import re
+import unicodedata
+
 from ckan.plugins import toolkit as t
 
 def _get_user():
@@ -9,3 +12,29 @@ def _get_user():
         {})
     return user
 
+
+# characters that are not decomposed by NFKD
+LABEL_FOLDING = {u'\xe6': u'ae', u'\u0153': u'oe', u'\xf8': u'o', u'\u0142': u'l',
+                 u'\u0111': u'd', u'\xf0': u'd', u'\xfe': u'th', u'\u0131': u'i'}
+# language-specific folding, applied before generic one
+LANG_LABEL_FOLDING = {'de': {u'\xdf': u'ss'}}
+_SPACES = re.compile(r'\s+', re.UNICODE)
+
+
+def normalize_label(value, lang=None):
+    """
+    Returns label folded for search: lowercased, without accents
+    and with collapsed whitespace.
+    """
+    if value is None:
+        return u''
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    value = value.lower()
+    for src, dst in LANG_LABEL_FOLDING.get(lang, {}).items():
+        value = value.replace(src, dst)
+    value = unicodedata.normalize('NFKD', value)
+    value = u''.join(c for c in value if not unicodedata.combining(c))
+    for src, dst in LABEL_FOLDING.items():
+        value = value.replace(src, dst)
+    return _SPACES.sub(u' ', value).strip()
@@ -22,47 +22,37 @@ def fao_datatype(value, context):
     except Exception, err:
         raise Invalid(_("Invalid datatype value: {}: {}").format(value, err))
 
-def fao_agrovoc(key, flattened_data, errors, context):
+def _validate_terms(vocabulary_name, key, flattened_data, errors):
     # we use extended api to update data dict in-place
     # this way we avoid various errors in harvesters,
     # which don't populate extras properly
     value = flattened_data[key]
     if isinstance(value, Missing) or value is None:
         flattened_data[key] = []
-    else:
-        value = _deserialize_from_array(value)
-        validated = []
-        try:
-            v = Vocabulary.get(Vocabulary.VOCABULARY_AGROVOC)
-            for term in value:
-                if not v.valid_term(term):
-                    errors[key].append(ValueError(_("Term not valid: {}").format(term)))
-                    break
-                validated.append(term)
-            flattened_data[key] = validated
-        except Exception, err:
-            errors[key].append(Invalid(_("Invalid AGROVOC term: {} {}").format(value, err)))
+        return
+    value = _deserialize_from_array(value)
+    v = Vocabulary.get(vocabulary_name)
+    # all terms are checked with one query
+    valid = v.valid_terms(value)
+    invalid = [term for term in value if term not in valid]
+    if invalid:
+        errors[key].append(ValueError(ungettext("Term not valid: {}",
+                                                "Terms not valid: {}",
+                                                len(invalid)).format(', '.join(invalid))))
+    flattened_data[key] = [term for term in value if term in valid]
+
+
+def fao_agrovoc(key, flattened_data, errors, context):
+    try:
+        _validate_terms(Vocabulary.VOCABULARY_AGROVOC, key, flattened_data, errors)
+    except Exception, err:
+        errors[key].append(Invalid(_("Invalid AGROVOC term: {} {}").format(flattened_data[key], err)))
 
 def fao_m49_regions(key, flattened_data, errors, context):
-    # we use extended api to update data dict in-place
-    # this way we avoid various errors in harvesters,
-    # which don't populate extras properly
-    value = flattened_data[key]
-    if isinstance(value, Missing) or value is None:
-        flattened_data[key] = []
-    else:
-        value = _deserialize_from_array(value)
-        validated = []
-        try:
-            v = Vocabulary.get(Vocabulary.VOCABULARY_M49_REGIONS)
-            for term in value:
-                if not v.valid_term(term):
-                    errors[key].append(ValueError(_("Term not valid: {}").format(term)))
-                    break
-                validated.append(term)
-            flattened_data[key] = validated
-        except Exception, err:
-            errors[key].append(Invalid(_("Invalid m49 regions: {} {}").format(value, err)))
+    try:
+        _validate_terms(Vocabulary.VOCABULARY_M49_REGIONS, key, flattened_data, errors)
+    except Exception, err:
+        errors[key].append(Invalid(_("Invalid m49 regions: {} {}").format(flattened_data[key], err)))
 
 def _serialize_to_array(value):
     if isinstance(value, (str, unicode,)) and value.startswith('{') and value.endswith('}'):